@@ -0,0 +1,188 @@
+"""API HTTP sin interfaz para el pipeline RAG (JSON y Server-Sent Events).
+
+Expone el mismo núcleo de servicio que la UI de Gradio (main.atender_pregunta:
+control de admisión, límites de concurrencia y pipeline multi-agente) para que
+otras herramientas internas puedan consultar el sistema de forma programática
+y escalarlo horizontalmente detrás de un balanceador. El servicio no guarda
+estado entre peticiones, así que se pueden añadir workers y nodos libremente.
+
+Endpoints:
+    POST /v1/chat          Respuesta completa en JSON
+    POST /v1/chat/stream   Eventos SSE: 'clasificacion', 'respuesta', 'fin' (o 'error')
+    POST /v1/chat/batch    Varias preguntas en una sola petición
+    GET  /health           Sonda de vida
+    GET  /ready            Sonda de disponibilidad (503 hasta terminar el precalentamiento)
+    GET  /metrics          Estado de los circuitos de OpenAI y contadores del modo degradado
+
+Cabeceras opcionales:
+    X-RAG-Profile: 1       Perfila la petición (ver perfilado.py); la ruta del
+                           perfil se devuelve en X-RAG-Profile-File (en SSE, en el evento 'respuesta')
+    X-Request-ID           Identificador con el que se etiqueta el perfil
+
+Uso:
+    python api.py                                   # RAG_API_WORKERS workers
+    uvicorn api:app --workers 4 --port 8000
+"""
+
+import os
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+
+from fastapi import FastAPI, Header, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+import main
+
+# --- CONFIGURACIÓN ---
+API_HOST = os.getenv("RAG_API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("RAG_API_PORT", "8000"))
+API_WORKERS = int(os.getenv("RAG_API_WORKERS", "2"))
+MAX_PREGUNTAS_LOTE = int(os.getenv("RAG_API_MAX_BATCH", "20"))
+REINTENTAR_TRAS = "2"  # Cabecera Retry-After (segundos) cuando el sistema está saturado
+
+# Pool propio para los lotes: el de main.get_executor() lo usan las tareas
+# especulativas de cada pregunta y compartirlo podría bloquearlo
+_lote_executor = ThreadPoolExecutor(max_workers=MAX_PREGUNTAS_LOTE, thread_name_prefix="lote")
+
+class OpcionesPregunta(BaseModel):
+    """Opciones por petición (todas opcionales)."""
+    categoria: Optional[Literal["FUNCIONAL", "TECNICA", "GESTION"]] = Field(
+        None, description="Fuerza la categoría en lugar de la del orquestador")
+    tipo_busqueda: Optional[Literal["SEMANTICA", "LEXICA"]] = Field(
+        None, description="Fuerza el tipo de búsqueda en lugar del del orquestador")
+    mostrar_fuentes: bool = True
+    mostrar_categoria: bool = False
+    redactar_lexica: bool = Field(
+        main.REDACTAR_LEXICA, description="Redactar con el LLM las búsquedas léxicas con resultados en varias categorías")
+
+class PeticionChat(OpcionesPregunta):
+    pregunta: str = Field(..., min_length=1)
+
+class PeticionLote(OpcionesPregunta):
+    preguntas: List[str] = Field(..., min_length=1)
+
+class RespuestaChat(BaseModel):
+    respuesta: str
+    categoria: str
+    tipo_busqueda: str
+    duracion_s: float
+    degradado: bool = False
+    precalculada: bool = False
+
+def _atender(pregunta, opciones, al_clasificar=None, perfilar=False, id_peticion=None):
+    """Llama al núcleo de servicio con las opciones de la petición."""
+    return main.atender_pregunta(
+        pregunta,
+        mostrar_categoria=opciones.mostrar_categoria,
+        mostrar_fuentes=opciones.mostrar_fuentes,
+        categoria=opciones.categoria,
+        tipo_busqueda=opciones.tipo_busqueda,
+        al_clasificar=al_clasificar,
+        redactar_lexica=opciones.redactar_lexica,
+        perfilar_pregunta=perfilar or main.PERFILAR,
+        id_peticion=id_peticion
+    )
+
+def _perfilar(cabecera):
+    """Interpreta la cabecera X-RAG-Profile."""
+    return (cabecera or "").lower() in ("1", "true", "yes", "si")
+
+def _saturado():
+    return HTTPException(status_code=503, detail=main.MENSAJE_SATURADO,
+                         headers={"Retry-After": REINTENTAR_TRAS})
+
+def _evento(nombre, datos):
+    """Serializa un evento Server-Sent Events."""
+    return f"event: {nombre}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+@asynccontextmanager
+async def lifespan(app):
+    # Cada worker precalienta su índice y conexiones; /ready lo refleja
+    main.iniciar_precalentamiento()
+    yield
+
+app = FastAPI(title="ScanGasto RAG API", lifespan=lifespan)
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+@app.get("/ready")
+def ready():
+    if not main.esta_listo():
+        raise HTTPException(status_code=503, detail="Precalentando")
+    return {"status": "ready", "arranque": main.METRICAS_ARRANQUE}
+
+@app.get("/metrics")
+def metrics():
+    # Con un circuito abierto el servicio sigue listo: responde en modo degradado
+    return {"circuitos": main.metricas_circuitos(), "indice": main.estado_indice(),
+            "recuperacion": main.metricas_recuperacion()}
+
+# Los endpoints son funciones síncronas: FastAPI los ejecuta en su pool de
+# hilos y la concurrencia real la acota el núcleo de servicio de main.py.
+@app.post("/v1/chat", response_model=RespuestaChat)
+def chat(peticion: PeticionChat, response: Response,
+         x_rag_profile: Optional[str] = Header(None), x_request_id: Optional[str] = Header(None)):
+    try:
+        resultado = _atender(peticion.pregunta, peticion,
+                             perfilar=_perfilar(x_rag_profile), id_peticion=x_request_id)
+    except main.SistemaSaturadoError:
+        raise _saturado()
+    if resultado.get("perfil"):
+        response.headers["X-RAG-Profile-File"] = resultado["perfil"]
+    return resultado
+
+@app.post("/v1/chat/batch", response_model=List[RespuestaChat])
+def chat_batch(peticion: PeticionLote):
+    if len(peticion.preguntas) > MAX_PREGUNTAS_LOTE:
+        raise HTTPException(status_code=413, detail=f"Máximo {MAX_PREGUNTAS_LOTE} preguntas por lote")
+    futuros = [
+        _lote_executor.submit(_atender, pregunta, peticion)
+        for pregunta in peticion.preguntas
+    ]
+    try:
+        return [futuro.result() for futuro in futuros]
+    except main.SistemaSaturadoError:
+        raise _saturado()
+
+@app.post("/v1/chat/stream")
+def chat_stream(peticion: PeticionChat,
+                x_rag_profile: Optional[str] = Header(None), x_request_id: Optional[str] = Header(None)):
+    eventos = queue.Queue()
+
+    def ejecutar():
+        try:
+            resultado = _atender(
+                peticion.pregunta, peticion,
+                al_clasificar=lambda categoria, tipo: eventos.put(
+                    ("clasificacion", {"categoria": categoria, "tipo_busqueda": tipo})),
+                perfilar=_perfilar(x_rag_profile), id_peticion=x_request_id
+            )
+            eventos.put(("respuesta", resultado))
+        except main.SistemaSaturadoError:
+            eventos.put(("error", {"detail": main.MENSAJE_SATURADO, "status": 503}))
+        except Exception as e:
+            eventos.put(("error", {"detail": str(e), "status": 500}))
+        eventos.put(None)
+
+    threading.Thread(target=ejecutar, daemon=True).start()
+
+    def generar():
+        while True:
+            evento = eventos.get()
+            if evento is None:
+                yield _evento("fin", {})
+                return
+            yield _evento(*evento)
+
+    return StreamingResponse(generar(), media_type="text/event-stream")
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("api:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
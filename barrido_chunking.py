@@ -0,0 +1,284 @@
+"""Barrido de parámetros de chunking y recuperación.
+
+Reconstruye el índice sobre la documentación (por defecto ./doc/doc_scangestor)
+con una rejilla de tamaños de chunk y valores de k (n_results), y evalúa cada
+configuración contra un conjunto de preguntas con sus ficheros fuente
+correctos (preguntas_oro.jsonl):
+
+    - recall@k: proporción de preguntas con algún chunk de una fuente correcta en el top-k
+    - MRR@k: media de 1/posición del primer chunk correcto (0 si no está en el top-k)
+    - Tamaño del índice en disco, tiempo de ingesta y tokens/coste de embeddings
+    - Latencia de búsqueda p50/p95 y tokens medios del contexto que recibiría el LLM
+
+Cada configuración se indexa en una BBDD Chroma temporal (no toca ./bbdd). Los
+embeddings se calculan con un backend intercambiable:
+    hash    Bolsa de palabras y n-gramas de caracteres con hashing (sin red ni coste;
+            sirve para comparar configuraciones entre sí, no como calidad absoluta)
+    st      sentence-transformers en local (requiere el paquete instalado)
+    openai  El modelo de ingest.py a través del transporte compartido (coste real)
+
+Formato del conjunto (JSONL):
+    {"pregunta": "...", "categoria": "TECNICA", "fuentes": ["TECNICA/02 QR - DT.md"]}
+"categoria" es opcional (sin ella se busca en todas); las fuentes son rutas
+relativas a la carpeta de documentación.
+
+Uso:
+    python barrido_chunking.py [--tamanos 500,1000,2000,4000] [--k 1,3,5,8] [--backend hash]
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import tempfile
+import time
+import unicodedata
+import uuid
+import zlib
+from pathlib import Path
+
+import chromadb
+import numpy as np
+
+import ingest
+
+# --- CONFIGURACIÓN ---
+FICHERO_PREGUNTAS = "./preguntas_oro.jsonl"
+TAMANOS_POR_DEFECTO = "500,1000,2000,4000"
+MINIMOS_POR_DEFECTO = "100"
+K_POR_DEFECTO = "1,3,5,8"
+DIMENSIONES_HASH = 1024
+MODELO_ST = "paraphrase-multilingual-MiniLM-L12-v2"
+LOTE_EMBEDDINGS = 100
+TOLERANCIA_RECALL = 0.02  # Margen sobre el mejor recall para proponer el punto de operación
+
+def normalizar_texto(texto):
+    """Minúsculas y sin tildes, para que 'gestión' y 'gestion' coincidan."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+class EmbeddingHash:
+    """Embeddings deterministas sin red: palabras y 4-gramas de caracteres con hashing."""
+
+    nombre = "hash"
+
+    def __init__(self, dimensiones=DIMENSIONES_HASH):
+        self.dimensiones = dimensiones
+
+    def _vector(self, texto):
+        vector = np.zeros(self.dimensiones, dtype=np.float32)
+        for palabra in re.findall(r"\w+", normalizar_texto(texto)):
+            rasgos = [palabra] + [palabra[i:i + 4] for i in range(max(0, len(palabra) - 3))]
+            for rasgo in rasgos:
+                vector[zlib.crc32(rasgo.encode("utf-8")) % self.dimensiones] += 1
+        vector = np.log1p(vector)  # Frecuencia sublineal: las palabras repetidas no dominan
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def __call__(self, textos):
+        return [self._vector(t).tolist() for t in textos]
+
+class EmbeddingSentenceTransformers:
+    """Modelo local de sentence-transformers (importación perezosa)."""
+
+    nombre = "st"
+
+    def __init__(self, modelo=MODELO_ST):
+        from sentence_transformers import SentenceTransformer
+        self.modelo = SentenceTransformer(modelo)
+
+    def __call__(self, textos):
+        return self.modelo.encode(list(textos), normalize_embeddings=True).tolist()
+
+class EmbeddingOpenAI:
+    """El modelo de embeddings de producción (ingest.MODEL_NAME)."""
+
+    nombre = "openai"
+
+    def __init__(self):
+        from transporte import crear_funcion_embeddings
+        ingest.check_api_key()
+        self.funcion = crear_funcion_embeddings(ingest.MODEL_NAME)
+
+    def __call__(self, textos):
+        return [np.asarray(e, dtype=np.float32).tolist() for e in self.funcion(list(textos))]
+
+def crear_backend(nombre, modelo_st=MODELO_ST):
+    if nombre == "st":
+        return EmbeddingSentenceTransformers(modelo_st)
+    if nombre == "openai":
+        return EmbeddingOpenAI()
+    return EmbeddingHash()
+
+def cargar_corpus(carpeta):
+    """Ficheros .md indexables (mismas reglas que ingest.py): [(ruta relativa, categoría, texto)]."""
+    raiz = Path(carpeta)
+    corpus = []
+    for ruta in sorted(raiz.rglob("*.md")):
+        if any(parte.endswith("__exclude") for parte in ruta.parts):
+            continue
+        corpus.append((ruta.relative_to(raiz).as_posix(), ruta.parent.name, ruta.read_text(encoding="utf-8")))
+    return corpus
+
+def tamano_carpeta(carpeta):
+    return sum(f.stat().st_size for f in Path(carpeta).rglob("*") if f.is_file())
+
+def embeber_por_lotes(backend, textos):
+    embeddings = []
+    for inicio in range(0, len(textos), LOTE_EMBEDDINGS):
+        embeddings += backend(textos[inicio:inicio + LOTE_EMBEDDINGS])
+    return embeddings
+
+def construir_indice(carpeta_bbdd, corpus, backend, tamano, minimo, contar_tokens):
+    """Trocea e indexa el corpus en una BBDD Chroma nueva. Devuelve (colección, métricas de ingesta)."""
+    inicio = time.perf_counter()
+    documentos, metadatas = [], []
+    for ruta, categoria, texto in corpus:
+        chunks = ingest.split_text_by_markdown_paragraphs(texto, max_chunk_size=tamano, min_chunk_size=minimo)
+        documentos += chunks
+        metadatas += [{"source_file": ruta, "category": categoria, "chunk_index": i} for i in range(len(chunks))]
+
+    embeddings = embeber_por_lotes(backend, documentos)
+    cliente = chromadb.PersistentClient(path=carpeta_bbdd)
+    coleccion = cliente.create_collection(
+        name=ingest.COLLECTION_NAME,
+        embedding_function=None,
+        configuration={"hnsw": {"space": "cosine"}}
+    )
+    coleccion.add(ids=[str(uuid.uuid4()) for _ in documentos], documents=documentos,
+                  metadatas=metadatas, embeddings=embeddings)
+    tiempo_ingesta = time.perf_counter() - inicio
+
+    tokens = sum(contar_tokens(d) for d in documentos)
+    return coleccion, {
+        "chunks": len(documentos),
+        "tokens_indexados": tokens,
+        "coste_usd": tokens / 1_000_000 * ingest.EMBEDDING_PRICE_PER_MTOK if backend.nombre == "openai" else 0.0,
+        "indice_mb": tamano_carpeta(carpeta_bbdd) / (1024 * 1024),
+        "ingesta_s": tiempo_ingesta
+    }
+
+def percentil(valores_ordenados, p):
+    """Percentil p (0-100) por rango más cercano sobre una lista ya ordenada."""
+    if not valores_ordenados:
+        return 0.0
+    indice = max(0, min(len(valores_ordenados) - 1, int(round(p / 100 * len(valores_ordenados) + 0.5)) - 1))
+    return valores_ordenados[indice]
+
+def evaluar(coleccion, preguntas, embeddings_preguntas, k, contar_tokens, filtrar_categoria=True):
+    """Recall@k, MRR@k, latencia de búsqueda y tokens de contexto para un valor de k."""
+    aciertos, rangos_reciprocos, latencias, tokens_contexto = 0, [], [], []
+    for entrada, embedding in zip(preguntas, embeddings_preguntas):
+        where = {"category": entrada["categoria"]} if filtrar_categoria and entrada.get("categoria") else None
+        inicio = time.perf_counter()
+        resultados = coleccion.query(query_embeddings=[embedding], n_results=k, where=where,
+                                     include=["documents", "metadatas"])
+        latencias.append(time.perf_counter() - inicio)
+
+        fuentes = [m["source_file"] for m in resultados["metadatas"][0]]
+        posicion = next((i for i, fuente in enumerate(fuentes, 1) if fuente in entrada["fuentes"]), None)
+        aciertos += posicion is not None
+        rangos_reciprocos.append(1 / posicion if posicion else 0.0)
+        tokens_contexto.append(sum(contar_tokens(d) for d in resultados["documents"][0]))
+
+    latencias.sort()
+    return {
+        "recall": aciertos / len(preguntas),
+        "mrr": statistics.mean(rangos_reciprocos),
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p95_ms": percentil(latencias, 95) * 1000,
+        "tokens_contexto": statistics.mean(tokens_contexto)
+    }
+
+def marcar_frontera(filas):
+    """Marca las configuraciones no dominadas en (recall más alto, tokens de contexto más bajos)."""
+    for fila in filas:
+        fila["eficiente"] = not any(
+            otra["recall"] >= fila["recall"] and otra["tokens_contexto"] <= fila["tokens_contexto"]
+            and (otra["recall"] > fila["recall"] or otra["tokens_contexto"] < fila["tokens_contexto"])
+            for otra in filas
+        )
+
+def punto_de_operacion(filas, tolerancia=TOLERANCIA_RECALL):
+    """Configuración con menos tokens de contexto cuyo recall está a 'tolerancia' del mejor."""
+    mejor = max(f["recall"] for f in filas)
+    candidatas = [f for f in filas if f["recall"] >= mejor - tolerancia]
+    return min(candidatas, key=lambda f: (f["tokens_contexto"], f["indice_mb"], f["p50_ms"]))
+
+def barrido(carpeta, preguntas, backend, tamanos, minimos, valores_k, filtrar_categoria=True):
+    """Ejecuta la rejilla completa y devuelve una fila por (tamaño, mínimo, k)."""
+    contar_tokens = ingest.get_token_counter()
+    corpus = cargar_corpus(carpeta)
+    print(f"📚 Corpus: {len(corpus)} ficheros | {len(preguntas)} preguntas | backend '{backend.nombre}'")
+
+    inicio = time.perf_counter()
+    embeddings_preguntas = embeber_por_lotes(backend, [p["pregunta"] for p in preguntas])
+    embedding_pregunta_ms = (time.perf_counter() - inicio) / len(preguntas) * 1000
+    print(f"   Embedding de pregunta: {embedding_pregunta_ms:.2f} ms de media (no incluido en la latencia de búsqueda)")
+
+    filas = []
+    temporal = tempfile.mkdtemp(prefix="barrido_chunking_")
+    try:
+        for tamano in tamanos:
+            for minimo in minimos:
+                carpeta_bbdd = os.path.join(temporal, f"t{tamano}_m{minimo}")
+                coleccion, ingesta = construir_indice(carpeta_bbdd, corpus, backend, tamano, minimo, contar_tokens)
+                print(f"   ⚙️  chunk≤{tamano} (mín {minimo}): {ingesta['chunks']} chunks, "
+                      f"{ingesta['indice_mb']:.2f} MB, ingesta {ingesta['ingesta_s']:.2f}s")
+                for k in valores_k:
+                    metricas = evaluar(coleccion, preguntas, embeddings_preguntas, k, contar_tokens, filtrar_categoria)
+                    filas.append({"tamano": tamano, "minimo": minimo, "k": k, **ingesta, **metricas})
+    finally:
+        shutil.rmtree(temporal, ignore_errors=True)
+
+    marcar_frontera(filas)
+    return filas
+
+def imprimir_tabla(filas, backend):
+    print("\n📊 BARRIDO DE CHUNKING Y RECUPERACIÓN")
+    cabecera = (f"  {'chunk':>6} {'mín':>4} {'k':>3} {'chunks':>6} {'tok. idx':>9} {'coste $':>8} {'MB':>6} "
+                f"{'ingesta s':>9} {'recall@k':>8} {'MRR@k':>6} {'p50 ms':>7} {'p95 ms':>7} {'tok. ctx':>8}")
+    print(cabecera)
+    print("  " + "-" * (len(cabecera) - 2))
+    for f in filas:
+        print(f"{'★' if f['eficiente'] else ' '} {f['tamano']:>6} {f['minimo']:>4} {f['k']:>3} {f['chunks']:>6} "
+              f"{f['tokens_indexados']:>9} {f['coste_usd']:>8.4f} {f['indice_mb']:>6.2f} {f['ingesta_s']:>9.2f} "
+              f"{f['recall']:>8.1%} {f['mrr']:>6.3f} {f['p50_ms']:>7.2f} {f['p95_ms']:>7.2f} {f['tokens_contexto']:>8.0f}")
+
+    elegida = punto_de_operacion(filas)
+    print("\n★ = frontera eficiente (ninguna otra configuración tiene más recall con menos tokens de contexto)")
+    print(f"🎯 Punto de operación sugerido: chunk≤{elegida['tamano']} (mín {elegida['minimo']}), k={elegida['k']} "
+          f"→ recall {elegida['recall']:.1%}, MRR {elegida['mrr']:.3f}, {elegida['tokens_contexto']:.0f} tokens de contexto")
+    if backend.nombre == "hash":
+        print("ℹ️  Backend 'hash': compara configuraciones entre sí; confirma el punto elegido con --backend openai")
+
+def lista_enteros(texto):
+    return [int(v) for v in texto.split(",") if v.strip()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Barrido de tamaños de chunk y k con recall@k, MRR, tamaño y latencia")
+    parser.add_argument("--carpeta", default=ingest.INPUT_FOLDER, help="Documentación a indexar")
+    parser.add_argument("--preguntas", default=FICHERO_PREGUNTAS, help="JSONL de preguntas con sus fuentes correctas")
+    parser.add_argument("--tamanos", default=TAMANOS_POR_DEFECTO, help="max_chunk_size separados por comas")
+    parser.add_argument("--minimos", default=MINIMOS_POR_DEFECTO, help="min_chunk_size separados por comas")
+    parser.add_argument("--k", default=K_POR_DEFECTO, help="Valores de n_results separados por comas")
+    parser.add_argument("--backend", choices=["hash", "st", "openai"], default="hash", help="Backend de embeddings")
+    parser.add_argument("--modelo-st", default=MODELO_ST, help="Modelo para --backend st")
+    parser.add_argument("--sin-filtro", action="store_true",
+                        help="Buscar en todas las categorías aunque la pregunta indique la suya")
+    parser.add_argument("--json", help="Guardar también las filas en este fichero JSON")
+    args = parser.parse_args()
+
+    with open(args.preguntas, "r", encoding="utf-8") as f:
+        preguntas = [json.loads(linea) for linea in f if linea.strip()]
+
+    backend = crear_backend(args.backend, args.modelo_st)
+    filas = barrido(args.carpeta, preguntas, backend, lista_enteros(args.tamanos),
+                    lista_enteros(args.minimos), lista_enteros(args.k), not args.sin_filtro)
+    imprimir_tabla(filas, backend)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(filas, f, ensure_ascii=False, indent=2)
+        print(f"💾 Resultados guardados en {args.json}")
@@ -1,7 +1,8 @@
 import os
+import json
 import chromadb
-from chromadb.utils import embedding_functions
 from dotenv import load_dotenv
+from transporte import crear_funcion_embeddings, get_api_key
 from collections import defaultdict
 
 # Cargar variables de entorno (.env)
@@ -11,23 +12,30 @@ load_dotenv()
 DB_PATH = './bbdd'    # Ruta a la BBDD Chroma
 COLLECTION_NAME = "documentacion_openai"
 MODEL_NAME = "text-embedding-3-small"
+INDEX_VERSION_FILE = os.path.join(DB_PATH, 'index_version.json')
 
-# Verificar API KEY
-if not os.getenv("OPENAI_API_KEY"):
+# Verificar API KEY (en reproducción de casete no hace falta)
+if not get_api_key():
     raise ValueError("❌ No se encontró la variable OPENAI_API_KEY. Configura tu archivo .env")
 
+def published_collection_name(name=COLLECTION_NAME):
+    """Colección de la generación publicada por ingest.py --rebuild (la 0 no lleva sufijo)."""
+    try:
+        with open(INDEX_VERSION_FILE, 'r', encoding='utf-8') as f:
+            generation = json.load(f).get('generation', 0)
+    except (OSError, ValueError):
+        generation = 0
+    return f"{name}.v{generation}" if generation else name
+
 def get_chroma_collection():
     """Configura el cliente y la colección de ChromaDB."""
     client = chromadb.PersistentClient(path=DB_PATH)
     
-    # Usamos la función nativa de Chroma para OpenAI
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        model_name=MODEL_NAME
-    )
+    # Función nativa de Chroma para OpenAI sobre el transporte HTTP compartido
+    openai_ef = crear_funcion_embeddings(MODEL_NAME)
     
     collection = client.get_or_create_collection(
-        name=COLLECTION_NAME,
+        name=published_collection_name(),
         embedding_function=openai_ef
     )
     return collection
@@ -56,19 +64,25 @@ def show_database_content():
         files_dict = defaultdict(lambda: {'category': 'N/A', 'vectors': []})
         categories = defaultdict(lambda: {'files': 0, 'vectors': 0})
         
+        shared_vectors = 0
         for vector_id, metadata in zip(results['ids'], results['metadatas']):
-            source_file = metadata.get('source_file', 'N/A')
-            category = metadata.get('category', 'N/A')
-            chunk_index = metadata.get('chunk_index', 'N/A')
-            
-            # Agregar al diccionario de archivos
-            if not files_dict[source_file]['vectors']:  # Primera vez que vemos este archivo
-                files_dict[source_file]['category'] = category
+            # Un vector deduplicado por ingest.py pertenece a varios ficheros ('sources')
+            if metadata.get('sources'):
+                sources = zip(metadata['sources'], metadata['source_categories'], metadata['source_chunks'])
+                shared_vectors += len(metadata['sources']) > 1
+            else:
+                sources = [(metadata.get('source_file', 'N/A'), metadata.get('category', 'N/A'),
+                            metadata.get('chunk_index', 'N/A'))]
             
-            files_dict[source_file]['vectors'].append({
-                'id': vector_id,
-                'chunk_index': chunk_index
-            })
+            for source_file, category, chunk_index in sources:
+                # Agregar al diccionario de archivos
+                if not files_dict[source_file]['vectors']:  # Primera vez que vemos este archivo
+                    files_dict[source_file]['category'] = category
+                
+                files_dict[source_file]['vectors'].append({
+                    'id': vector_id,
+                    'chunk_index': chunk_index
+                })
         
         # Mostrar información detallada por archivo
         print("📋 LISTA DE VECTORES POR ARCHIVO:\n")
@@ -100,6 +114,8 @@ def show_database_content():
         print(f"   - Total de archivos únicos: {len(files_dict)}")
         print(f"   - Total de vectores/chunks: {total_vectors}")
         print(f"   - Promedio de chunks por archivo: {total_vectors / len(files_dict):.1f}")
+        if shared_vectors:
+            print(f"   - Vectores compartidos por varios archivos (deduplicados): {shared_vectors}")
         print("="*70 + "\n")
         
         print("📊 DISTRIBUCIÓN POR CATEGORÍA:")
@@ -0,0 +1,108 @@
+"""Calibración de los umbrales de relevancia por categoría.
+
+A partir de un conjunto de preguntas etiquetadas calcula, para cada
+categoría, la distancia máxima a partir de la cual los chunks recuperados se
+consideran irrelevantes (main.umbral_relevancia). Con esos umbrales, las
+preguntas fuera de tema se responden al momento sin llamar al LLM.
+
+Formato del conjunto (JSONL, una pregunta por línea):
+    {"pregunta": "¿Cómo se escanea un QR?", "categoria": "FUNCIONAL", "relevante": true}
+    {"pregunta": "¿Qué tiempo hará mañana?", "categoria": null, "relevante": false}
+
+"categoria": null en una pregunta no relevante la usa como negativa en todas
+las categorías. Para cada categoría se elige el menor umbral que deja pasar
+al menos --recall de las preguntas relevantes (su distancia top-1) y se
+informa de qué proporción de las no relevantes rechaza.
+
+Uso:
+    python calibrar_umbrales.py preguntas_calibracion.jsonl [--recall 0.95] [--salida umbrales_relevancia.json]
+"""
+
+import argparse
+import json
+import math
+from datetime import datetime
+
+import main
+
+def distancia_top1(pregunta, categoria):
+    """Distancia del chunk más cercano de la categoría, sin aplicar umbral."""
+    resultados = main.buscar_documentos_relevantes(pregunta, categoria, n_results=1, mmr=False, umbral=None)
+    distancias = resultados['distances'][0] if resultados['distances'] else []
+    return distancias[0] if distancias else None
+
+def elegir_umbral(relevantes, no_relevantes, recall_objetivo):
+    """Menor umbral con el recall pedido sobre las relevantes; devuelve (umbral, recall, rechazo)."""
+    ordenadas = sorted(relevantes)
+    umbral = ordenadas[max(0, math.ceil(recall_objetivo * len(ordenadas)) - 1)]
+    recall = sum(d <= umbral for d in relevantes) / len(relevantes)
+    rechazo = sum(d > umbral for d in no_relevantes) / len(no_relevantes) if no_relevantes else None
+    return umbral, recall, rechazo
+
+def calibrar(preguntas, recall_objetivo):
+    """Calcula los umbrales por categoría y uno global. Devuelve el dict a guardar."""
+    distancias = {cat: {"relevantes": [], "no_relevantes": []} for cat in main.CATEGORIAS}
+    for i, entrada in enumerate(preguntas, 1):
+        categorias = [entrada["categoria"]] if entrada.get("categoria") else list(main.CATEGORIAS)
+        clave = "relevantes" if entrada.get("relevante", True) else "no_relevantes"
+        for categoria in categorias:
+            distancia = distancia_top1(entrada["pregunta"], categoria)
+            if distancia is not None:
+                distancias[categoria][clave].append(distancia)
+        print(f"   {i}/{len(preguntas)} {entrada['pregunta'][:60]}")
+
+    umbrales = {}
+    estadisticas = {}
+    todas_relevantes, todas_no_relevantes = [], []
+    for categoria, valores in distancias.items():
+        todas_relevantes += valores["relevantes"]
+        todas_no_relevantes += valores["no_relevantes"]
+        if not valores["relevantes"]:
+            print(f"⚠️ {categoria}: sin preguntas relevantes, se usará el umbral global")
+            continue
+        umbral, recall, rechazo = elegir_umbral(valores["relevantes"], valores["no_relevantes"], recall_objetivo)
+        umbrales[categoria] = round(umbral, 4)
+        estadisticas[categoria] = {
+            "relevantes": len(valores["relevantes"]),
+            "no_relevantes": len(valores["no_relevantes"]),
+            "recall": recall,
+            "rechazo_no_relevantes": rechazo
+        }
+
+    if todas_relevantes:
+        umbral, recall, rechazo = elegir_umbral(todas_relevantes, todas_no_relevantes, recall_objetivo)
+        umbrales["_global"] = round(umbral, 4)
+        estadisticas["_global"] = {"recall": recall, "rechazo_no_relevantes": rechazo}
+
+    umbrales["_meta"] = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "preguntas": len(preguntas),
+        "recall_objetivo": recall_objetivo,
+        "estadisticas": estadisticas
+    }
+    return umbrales
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrar los umbrales de relevancia por categoría")
+    parser.add_argument("preguntas", help="JSONL con preguntas etiquetadas")
+    parser.add_argument("--recall", type=float, default=0.95,
+                        help="Proporción de preguntas relevantes que deben superar el umbral")
+    parser.add_argument("--salida", default=main.FICHERO_UMBRALES, help="Fichero de umbrales a escribir")
+    args = parser.parse_args()
+
+    with open(args.preguntas, "r", encoding="utf-8") as f:
+        preguntas = [json.loads(linea) for linea in f if linea.strip()]
+
+    print(f"📏 Calibrando con {len(preguntas)} preguntas (recall objetivo {args.recall:.0%})...")
+    umbrales = calibrar(preguntas, args.recall)
+
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(umbrales, f, ensure_ascii=False, indent=2)
+
+    print("\n📊 UMBRALES DE RELEVANCIA")
+    for categoria, datos in umbrales["_meta"]["estadisticas"].items():
+        rechazo = datos["rechazo_no_relevantes"]
+        rechazo_txt = f"{rechazo:.0%}" if rechazo is not None else "-"
+        print(f"   {categoria:<10} distancia <= {umbrales[categoria]:.4f} | "
+              f"recall {datos['recall']:.0%} | rechazo fuera de tema {rechazo_txt}")
+    print(f"💾 Guardado en {args.salida} (main.py lo recarga automáticamente)")
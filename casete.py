@@ -0,0 +1,250 @@
+"""Grabación y reproducción de las llamadas a OpenAI (casete) para pruebas sin red.
+
+Con RAG_CASSETTE_MODE=record el transporte compartido (transporte.py) guarda
+cada respuesta correcta de chat, embeddings y demás llamadas en RAG_CASSETTE
+(JSON Lines comprimido con gzip) junto con su latencia. Con
+RAG_CASSETTE_MODE=replay las devuelve sin conectarse, tras esperar la
+latencia grabada multiplicada por RAG_CASSETTE_LATENCY_SCALE (0 = sin espera),
+así que main.py, ingest.py y bbdd.py funcionan sin OPENAI_API_KEY ni red y
+las pruebas de rendimiento son repetibles en cualquier máquina.
+
+Claves de búsqueda:
+    - Chat y resto de llamadas: método, ruta y cuerpo JSON canónico (claves
+      ordenadas). Si la misma petición se grabó varias veces se reproducen en
+      orden y después se repite la última.
+    - Embeddings: cada texto por separado, para que los micro-lotes de
+      main.py (que dependen del momento de llegada) no cambien las claves; la
+      respuesta se recompone con los vectores grabados de cada texto.
+
+Con RAG_CASSETTE_STRICT=1 (por defecto) una llamada no grabada falla con
+CaseteError; con 0 se envía a la red.
+
+Uso:
+    RAG_CASSETTE_MODE=record python prueba_carga.py --sin-stub --peticiones 50
+    RAG_CASSETTE_MODE=replay python prueba_carga.py --sin-stub --peticiones 50
+    python casete.py ./casetes/openai.jsonl.gz      # resumen del casete
+"""
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+# --- CONFIGURACIÓN ---
+MODO_CASETE = os.getenv("RAG_CASSETTE_MODE", "off").lower()  # off | record | replay
+RUTA_CASETE = os.getenv("RAG_CASSETTE", "./casetes/openai.jsonl.gz")
+CASETE_ESTRICTO = os.getenv("RAG_CASSETTE_STRICT", "1").lower() in ("1", "true", "yes", "si")
+ESCALA_LATENCIA = float(os.getenv("RAG_CASSETTE_LATENCY_SCALE", "1"))
+
+# Cabeceras que no se conservan: el cuerpo se guarda ya descomprimido
+CABECERAS_DESCARTADAS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+class CaseteError(Exception):
+    """Llamada sin grabación en modo estricto."""
+
+def json_canonico(cuerpo):
+    """Cuerpo de la petición con las claves ordenadas (o el texto tal cual si no es JSON)."""
+    if not cuerpo:
+        return ""
+    try:
+        return json.dumps(json.loads(cuerpo), sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        return cuerpo.decode("utf-8", "replace")
+
+def huella(texto):
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()[:32]
+
+def clave_peticion(metodo, ruta, cuerpo):
+    """Clave de una llamada cualquiera: método, ruta y cuerpo canónico."""
+    return huella(f"{metodo} {ruta}\n{json_canonico(cuerpo)}")
+
+def clave_embedding(parametros, entrada):
+    """Clave del embedding de un texto: parámetros de la petición (sin 'input') y el texto."""
+    return huella(json.dumps([parametros, entrada], sort_keys=True, ensure_ascii=False))
+
+def es_embeddings(ruta):
+    return ruta.rstrip("/").endswith("/embeddings")
+
+class Casete:
+    """Respuestas grabadas en memoria y fichero donde se añaden las nuevas."""
+
+    def __init__(self, ruta=RUTA_CASETE):
+        self.ruta = ruta
+        self.respuestas = {}   # clave -> [entrada http] en orden de grabación
+        self.vectores = {}     # clave de texto -> entrada de embedding
+        self.estadisticas = {"reproducidas": 0, "grabadas": 0, "sin_grabar": 0}
+        self._posiciones = {}
+        self._fichero = None
+        self._lock = threading.Lock()
+
+    def cargar(self):
+        """Lee el casete. Un final truncado (proceso interrumpido al grabar) se ignora."""
+        if not os.path.exists(self.ruta):
+            return self
+        with gzip.open(self.ruta, "rt", encoding="utf-8") as f:
+            try:
+                for linea in f:
+                    self._indexar(json.loads(linea))
+            except (EOFError, ValueError):
+                print(f"⚠️ Casete {self.ruta} truncado: se usan las entradas completas")
+        return self
+
+    def _indexar(self, entrada):
+        if entrada["tipo"] == "embedding":
+            self.vectores[entrada["clave"]] = entrada
+        else:
+            self.respuestas.setdefault(entrada["clave"], []).append(entrada)
+
+    def _escribir(self, entradas):
+        with self._lock:
+            if self._fichero is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.ruta)), exist_ok=True)
+                # Cada ejecución añade un miembro gzip nuevo; gzip los lee seguidos
+                self._fichero = gzip.open(self.ruta, "at", encoding="utf-8")
+                atexit.register(self.cerrar)
+            for entrada in entradas:
+                self._fichero.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+                self._indexar(entrada)
+            self._fichero.flush()
+            self.estadisticas["grabadas"] += 1
+
+    def grabar(self, metodo, ruta, cuerpo_peticion, estado, cabeceras, contenido, latencia):
+        """Guarda una respuesta correcta (los embeddings, un registro por texto)."""
+        texto = contenido.decode("utf-8", "replace")
+        if es_embeddings(ruta):
+            peticion = json.loads(cuerpo_peticion)
+            entradas = peticion.pop("input")
+            entradas = entradas if isinstance(entradas, list) else [entradas]
+            datos = sorted(json.loads(texto)["data"], key=lambda d: d["index"])
+            self._escribir([{
+                "tipo": "embedding",
+                "clave": clave_embedding(peticion, entrada),
+                "modelo": peticion.get("model"),
+                "embedding": dato["embedding"],
+                "latencia_s": round(latencia, 6)
+            } for entrada, dato in zip(entradas, datos)])
+            return
+        self._escribir([{
+            "tipo": "http",
+            "clave": clave_peticion(metodo, ruta, cuerpo_peticion),
+            "metodo": metodo,
+            "ruta": ruta,
+            "estado": estado,
+            "cabeceras": cabeceras,
+            "cuerpo": texto,
+            "latencia_s": round(latencia, 6)
+        }])
+
+    def buscar(self, metodo, ruta, cuerpo_peticion):
+        """Devuelve (estado, cabeceras, cuerpo, latencia) grabados para la petición, o None."""
+        if es_embeddings(ruta):
+            peticion = json.loads(cuerpo_peticion)
+            entradas = peticion.pop("input")
+            entradas = entradas if isinstance(entradas, list) else [entradas]
+            grabados = [self.vectores.get(clave_embedding(peticion, entrada)) for entrada in entradas]
+            if not grabados or None in grabados:
+                return None
+            cuerpo = json.dumps({
+                "object": "list",
+                "model": grabados[0]["modelo"],
+                "data": [{"object": "embedding", "index": i, "embedding": g["embedding"]}
+                         for i, g in enumerate(grabados)],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}
+            })
+            return 200, {"content-type": "application/json"}, cuerpo, max(g["latencia_s"] for g in grabados)
+
+        clave = clave_peticion(metodo, ruta, cuerpo_peticion)
+        with self._lock:
+            grabadas = self.respuestas.get(clave)
+            if not grabadas:
+                return None
+            posicion = self._posiciones.get(clave, 0)
+            self._posiciones[clave] = posicion + 1
+        entrada = grabadas[min(posicion, len(grabadas) - 1)]
+        return entrada["estado"], entrada["cabeceras"], entrada["cuerpo"], entrada["latencia_s"]
+
+    def contar(self, clave):
+        with self._lock:
+            self.estadisticas[clave] += 1
+
+    def cerrar(self):
+        with self._lock:
+            if self._fichero is not None:
+                self._fichero.close()
+                self._fichero = None
+
+def crear_transporte_casete(transporte, modo=MODO_CASETE, ruta=RUTA_CASETE,
+                            estricto=CASETE_ESTRICTO, escala=ESCALA_LATENCIA):
+    """Envuelve un httpx.BaseTransport para grabar (modo 'record') o reproducir ('replay')."""
+    import httpx
+
+    casete = Casete(ruta)
+    if modo == "replay":
+        casete.cargar()
+        print(f"📼 Casete {ruta}: {sum(len(r) for r in casete.respuestas.values())} respuestas y "
+              f"{len(casete.vectores)} embeddings (reproducción{' estricta' if estricto else ''}, latencia x{escala:g})")
+        atexit.register(lambda: print(f"📼 Casete: {casete.estadisticas['reproducidas']} reproducidas, "
+                                      f"{casete.estadisticas['sin_grabar']} sin grabar"))
+    else:
+        print(f"⏺️  Grabando las llamadas a OpenAI en {ruta}")
+
+    class TransporteCasete(httpx.BaseTransport):
+        def handle_request(self, request):
+            ruta_peticion = request.url.path
+            cuerpo = request.read()
+
+            if modo == "replay":
+                grabada = casete.buscar(request.method, ruta_peticion, cuerpo)
+                if grabada is not None:
+                    estado, cabeceras, contenido, latencia = grabada
+                    casete.contar("reproducidas")
+                    if escala > 0:
+                        time.sleep(latencia * escala)
+                    return httpx.Response(estado, headers=cabeceras, content=contenido.encode("utf-8"),
+                                          request=request)
+                casete.contar("sin_grabar")
+                if estricto:
+                    # Se avisa aquí porque el SDK y el circuito de main.py envuelven la excepción
+                    error = (f"Llamada no grabada en {ruta}: {request.method} {ruta_peticion} "
+                             f"(clave {clave_peticion(request.method, ruta_peticion, cuerpo)})")
+                    print(f"❌ {error}")
+                    raise CaseteError(error)
+                return transporte.handle_request(request)
+
+            inicio = time.perf_counter()
+            respuesta = transporte.handle_request(request)
+            contenido = respuesta.read()
+            latencia = time.perf_counter() - inicio
+            cabeceras = {k: v for k, v in respuesta.headers.items() if k.lower() not in CABECERAS_DESCARTADAS}
+            if 200 <= respuesta.status_code < 300:
+                casete.grabar(request.method, ruta_peticion, cuerpo, respuesta.status_code,
+                              {"content-type": respuesta.headers.get("content-type", "application/json")},
+                              contenido, latencia)
+            respuesta.close()
+            return httpx.Response(respuesta.status_code, headers=cabeceras, content=contenido, request=request)
+
+        def close(self):
+            casete.cerrar()
+            transporte.close()
+
+    return TransporteCasete()
+
+def resumir(ruta):
+    """Recuento y latencias grabadas por ruta."""
+    casete = Casete(ruta).cargar()
+    por_ruta = {}
+    for entradas in casete.respuestas.values():
+        for entrada in entradas:
+            por_ruta.setdefault(f"{entrada['metodo']} {entrada['ruta']}", []).append(entrada["latencia_s"])
+    if casete.vectores:
+        por_ruta["POST /embeddings (por texto)"] = [v["latencia_s"] for v in casete.vectores.values()]
+    print(f"📼 {ruta} ({os.path.getsize(ruta) / 1024:.1f} KB)")
+    for nombre, latencias in sorted(por_ruta.items()):
+        print(f"   {nombre:<40} {len(latencias):>6} | latencia media {sum(latencias) / len(latencias):.3f}s")
+
+if __name__ == "__main__":
+    resumir(sys.argv[1] if len(sys.argv) > 1 else RUTA_CASETE)
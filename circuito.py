@@ -0,0 +1,178 @@
+"""Plazos por etapa y circuit breaker para las llamadas a OpenAI.
+
+Cada llamada al proveedor (clasificación, agentes, sintetizador, embeddings)
+se ejecuta en un pool propio y se espera como mucho el plazo de su etapa:
+si el proveedor va lento o está caído, la petición no se queda esperando el
+timeout completo del cliente HTTP.
+
+El circuito cuenta los fallos seguidos del proveedor (plazos agotados,
+errores de conexión y respuestas 429 o 5xx). Tras
+RAG_BREAKER_FAILURES fallos se abre y, durante RAG_BREAKER_COOLDOWN
+segundos, las llamadas se rechazan al momento con ServicioNoDisponibleError
+para que main.py responda en modo degradado sin LLM. Pasado ese tiempo se
+deja pasar una única llamada de prueba (semiabierto): si funciona el
+circuito se cierra y si falla vuelve a abrirse.
+
+Los errores de capacidad local (SistemaSaturadoError) y los de la propia
+llamada (400 por un prompt demasiado largo, 401, 404...) no cuentan como
+fallos del proveedor: se propagan tal cual y no acercan el circuito a abrirse.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as PlazoAgotado
+
+# --- CONFIGURACIÓN ---
+CIRCUITO_MAX_FALLOS = int(os.getenv("RAG_BREAKER_FAILURES", "5"))
+CIRCUITO_ENFRIAMIENTO = float(os.getenv("RAG_BREAKER_COOLDOWN", "30"))
+HILOS_LLAMADAS = int(os.getenv("RAG_PROVIDER_WORKERS", "64"))
+
+CERRADO, ABIERTO, SEMIABIERTO = "cerrado", "abierto", "semiabierto"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class ServicioNoDisponibleError(Exception):
+    """El proveedor no ha respondido a tiempo, ha fallado o su circuito está abierto."""
+
+class Circuito:
+    """Circuit breaker de un servicio externo (cerrado -> abierto -> semiabierto)."""
+
+    def __init__(self, nombre, max_fallos=CIRCUITO_MAX_FALLOS, enfriamiento=CIRCUITO_ENFRIAMIENTO):
+        self.nombre = nombre
+        self.max_fallos = max_fallos
+        self.enfriamiento = enfriamiento
+        self.estado = CERRADO
+        self.fallos_seguidos = 0
+        self.ultimo_error = None
+        self.contadores = {"exitos": 0, "fallos": 0, "plazos_agotados": 0, "rechazadas": 0, "aperturas": 0}
+        self._abierto_desde = None
+        self._cambio_estado = time.time()
+        self._sonda_en_curso = False
+        self._lock = threading.Lock()
+
+    def _cambiar(self, estado):
+        anterior, self.estado = self.estado, estado
+        self._cambio_estado = time.time()
+        if estado == ABIERTO:
+            self._abierto_desde = time.monotonic()
+            self.contadores["aperturas"] += 1
+            print(f"🔌 Circuito {self.nombre} abierto tras {self.fallos_seguidos} fallos "
+                  f"({self.ultimo_error}); modo degradado durante {self.enfriamiento:.0f}s")
+        elif estado == CERRADO:
+            print(f"✅ Circuito {self.nombre} cerrado ({anterior} -> cerrado)")
+
+    def _actualizar(self):
+        if self.estado == ABIERTO and time.monotonic() - self._abierto_desde >= self.enfriamiento:
+            self._cambiar(SEMIABIERTO)
+
+    def disponible(self):
+        """True si una llamada ahora mismo tendría opciones de pasar (no reserva la prueba)."""
+        with self._lock:
+            self._actualizar()
+            return self.estado == CERRADO or (self.estado == SEMIABIERTO and not self._sonda_en_curso)
+
+    def permitir(self):
+        """Reserva el paso de una llamada; False (y cuenta el rechazo) si el circuito no lo permite."""
+        with self._lock:
+            self._actualizar()
+            if self.estado == CERRADO:
+                return True
+            if self.estado == SEMIABIERTO and not self._sonda_en_curso:
+                self._sonda_en_curso = True
+                return True
+            self.contadores["rechazadas"] += 1
+            return False
+
+    def registrar_exito(self):
+        with self._lock:
+            self.contadores["exitos"] += 1
+            self.fallos_seguidos = 0
+            self._sonda_en_curso = False
+            if self.estado != CERRADO:
+                self._cambiar(CERRADO)
+
+    def registrar_fallo(self, error, plazo_agotado=False):
+        with self._lock:
+            self.contadores["plazos_agotados" if plazo_agotado else "fallos"] += 1
+            self.fallos_seguidos += 1
+            self.ultimo_error = str(error)[:200]
+            self._sonda_en_curso = False
+            if self.estado == SEMIABIERTO or (self.estado == CERRADO and self.fallos_seguidos >= self.max_fallos):
+                self._cambiar(ABIERTO)
+
+    def cancelar(self):
+        """Libera la llamada de prueba reservada sin contarla (p. ej. por falta de capacidad local)."""
+        with self._lock:
+            self._sonda_en_curso = False
+
+    def metricas(self):
+        """Estado y contadores del circuito (para /metrics)."""
+        with self._lock:
+            self._actualizar()
+            restante = (max(0.0, self.enfriamiento - (time.monotonic() - self._abierto_desde))
+                        if self.estado == ABIERTO else 0.0)
+            return {
+                "estado": self.estado,
+                "fallos_seguidos": self.fallos_seguidos,
+                "segundos_en_estado": round(time.time() - self._cambio_estado, 3),
+                "reintento_en_s": round(restante, 3),
+                "ultimo_error": self.ultimo_error,
+                **self.contadores
+            }
+
+def es_fallo_proveedor(error):
+    """True si el error indica que el proveedor no está disponible (conexión, timeout, 429 o 5xx)."""
+    import httpx
+    import openai
+
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+    estado = getattr(error, "status_code", None)
+    return estado is not None and (estado == 429 or estado >= 500)
+
+def get_pool():
+    """Pool de hilos donde se ejecutan las llamadas al proveedor (creado en el primer uso)."""
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=HILOS_LLAMADAS, thread_name_prefix="proveedor")
+    return _pool
+
+def llamar_con_plazo(circuito, plazo, funcion, *args, ignorar=()):
+    """Ejecuta funcion(*args) esperando como mucho 'plazo' segundos.
+
+    Las excepciones de 'ignorar' (p. ej. SistemaSaturadoError) y los errores
+    que no son del proveedor (ver es_fallo_proveedor) se propagan tal cual y
+    no cuentan como fallo.
+
+    Raises:
+        ServicioNoDisponibleError: Circuito abierto, plazo agotado o fallo del proveedor
+    """
+    if not circuito.permitir():
+        raise ServicioNoDisponibleError(f"Circuito {circuito.nombre} abierto")
+
+    futuro = get_pool().submit(funcion, *args)
+    try:
+        resultado = futuro.result(timeout=plazo)
+    except PlazoAgotado:
+        # Si aún no había empezado no llega a ejecutarse; si ya está en vuelo,
+        # el timeout del cliente HTTP acabará liberando el hilo
+        futuro.cancel()
+        error = f"sin respuesta en {plazo:.1f}s"
+        circuito.registrar_fallo(error, plazo_agotado=True)
+        raise ServicioNoDisponibleError(f"{circuito.nombre}: {error}")
+    except ignorar:
+        circuito.cancelar()
+        raise
+    except Exception as e:
+        if not es_fallo_proveedor(e):
+            circuito.cancelar()
+            raise
+        circuito.registrar_fallo(e)
+        raise ServicioNoDisponibleError(f"{circuito.nombre}: {e}") from e
+    circuito.registrar_exito()
+    return resultado
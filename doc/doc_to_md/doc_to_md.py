@@ -4,11 +4,15 @@ import mammoth
 from markdownify import markdownify as md
 from pathlib import Path
 import pymupdf4llm
-import pandas as pd
+from datetime import date, datetime, time
 
 # --- CONFIGURACIÓN ---
 INPUT_FOLDER = './01_entrada'
 OUTPUT_FOLDER = './02_salida'
+# Excel: las hojas se emiten en bloques de filas con la cabecera repetida,
+# cada uno por debajo del tamaño máximo de chunk de ingest.py (2000 caracteres)
+EXCEL_BLOCK_MAX_CHARS = 1800
+EXCEL_BLOCK_MAX_ROWS = 50
 
 def setup_folders():
     """Crea las carpetas si no existen."""
@@ -103,36 +107,168 @@ def convert_pdf_to_md(pdf_path):
         print(f"❌ Error al convertir {pdf_path.name}: {e}")
         return None
 
+def format_cell(value):
+    """Convierte el valor de una celda en texto apto para una tabla Markdown."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, datetime) and value.time() == time(0):
+        value = value.date()
+    if isinstance(value, (date, time)):
+        value = value.isoformat()
+    return str(value).replace("|", "\\|").replace("\r", " ").replace("\n", " ").strip()
+
+def iter_excel_rows(excel_path):
+    """
+    Recorre el libro una sola vez, hoja a hoja y fila a fila, sin cargarlo entero.
+    Genera tuplas (nombre_hoja, fila) con las filas como tuplas de valores.
+    .xlsx con openpyxl en modo read_only; .xls con xlrd cargando hojas bajo demanda.
+    """
+    if excel_path.suffix.lower() == ".xls":
+        import xlrd
+        book = xlrd.open_workbook(str(excel_path), on_demand=True)
+        try:
+            for index, sheet_name in enumerate(book.sheet_names()):
+                sheet = book.sheet_by_index(index)
+                for row_index in range(sheet.nrows):
+                    yield sheet_name, tuple(
+                        xlrd.xldate.xldate_as_datetime(cell.value, book.datemode)
+                        if cell.ctype == xlrd.XL_CELL_DATE else cell.value
+                        for cell in sheet.row(row_index)
+                    )
+                book.unload_sheet(index)
+        finally:
+            book.release_resources()
+        return
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            for row in worksheet.iter_rows(values_only=True):
+                yield worksheet.title, row
+    finally:
+        workbook.close()
+
+def block_heading(sheet_name, first_row, last_row, sheet_title=False):
+    """Encabezado de un bloque: '### hoja (filas a-b)', precedido de '## hoja' en el primero de la hoja."""
+    heading = f"### {sheet_name} (filas {first_row}-{last_row})"
+    return f"## {sheet_name}\n\n{heading}" if sheet_title else heading
+
+def table_block_chars(heading, header, width, cells_chars, n_rows):
+    """
+    Longitud de render_table_block antes de limpiar: encabezado, fila de
+    cabecera, separador y n_rows filas de 'width' columnas cuyas celdas
+    suman cells_chars caracteres. Cada línea de la tabla ocupa sus celdas,
+    3 caracteres por columna ('| ', ' | ', ' |'), 1 más y el salto de línea.
+    """
+    columns_chars = (sum(len(c) for c in header)
+                     + sum(len(f"Columna {i + 1}") for i in range(len(header), width)))
+    line_chars = 3 * width + 2
+    return len(heading) + (columns_chars + line_chars) + (4 * width + 2) + cells_chars + n_rows * line_chars
+
+def render_table_block(sheet_name, header, rows, first_row, sheet_title=False):
+    """Tabla Markdown de un bloque de filas, con la cabecera y el rango de filas de la hoja."""
+    width = max([len(header)] + [len(row) for row in rows])
+    columns = list(header) + [f"Columna {i + 1}" for i in range(len(header), width)]
+    lines = [
+        block_heading(sheet_name, first_row, first_row + len(rows) - 1, sheet_title),
+        "| " + " | ".join(columns) + " |",
+        "|" + "---|" * width
+    ]
+    lines.extend("| " + " | ".join(list(row) + [""] * (width - len(row))) + " |" for row in rows)
+    return clean_markdown_content("\n".join(lines))
+
+def iter_excel_markdown_blocks(excel_path, max_chars=EXCEL_BLOCK_MAX_CHARS, max_rows=EXCEL_BLOCK_MAX_ROWS):
+    """
+    Genera el Markdown de un Excel por trozos con memoria acotada.
+    Por cada hoja, bloques de como mucho max_rows filas y max_chars
+    caracteres (salvo una sola fila más larga), cada uno con la cabecera
+    repetida, para que cada bloque sea un chunk de recuperación
+    autosuficiente. El título de la hoja va en su primer bloque, así que una
+    hoja sin filas de datos no genera nada.
+    La primera fila no vacía de cada hoja se toma como cabecera.
+    """
+    current_sheet = None
+    header = None
+    block, cells_chars, width, first_row, row_number = [], 0, 0, 1, 0
+    sheet_title = True
+
+    for sheet_name, row in iter_excel_rows(excel_path):
+        if sheet_name != current_sheet:
+            if block:
+                yield render_table_block(current_sheet, header, block, first_row, sheet_title)
+            current_sheet, header = sheet_name, None
+            block, cells_chars, row_number = [], 0, 0
+            sheet_title = True
+
+        cells = [format_cell(value) for value in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        if not cells:
+            continue
+
+        if header is None:
+            header = cells
+            continue
+
+        row_number += 1
+        if block:
+            new_width = max(width, len(cells))
+            new_chars = table_block_chars(block_heading(sheet_name, first_row, row_number, sheet_title), header,
+                                          new_width, cells_chars + sum(len(c) for c in cells), len(block) + 1)
+            if len(block) >= max_rows or new_chars > max_chars:
+                yield render_table_block(sheet_name, header, block, first_row, sheet_title)
+                block, cells_chars = [], 0
+                sheet_title = False
+        if not block:
+            first_row, width = row_number, len(header)
+        block.append(cells)
+        cells_chars += sum(len(c) for c in cells)
+        width = max(width, len(cells))
+
+    if block:
+        yield render_table_block(current_sheet, header, block, first_row, sheet_title)
+
 def convert_excel_to_md(excel_path):
-    """Convierte un fichero Excel a Markdown."""
+    """Convierte un fichero Excel a Markdown (en memoria; ver convert_excel_to_md_file)."""
     print(f"🔄 Procesando: {excel_path.name}...")
     
     try:
-        # Leer todas las hojas del archivo Excel
-        excel_file = pd.ExcelFile(excel_path)
-        markdown_parts = []
-        
-        for sheet_name in excel_file.sheet_names:
-            # Leer cada hoja
-            df = pd.read_excel(excel_path, sheet_name=sheet_name)
-            
-            # Si la hoja no está vacía
-            if not df.empty:
-                # Añadir título de la hoja
-                markdown_parts.append(f"## {sheet_name}\n")
-                # Convertir DataFrame a tabla Markdown
-                markdown_parts.append(df.to_markdown(index=False))
-                markdown_parts.append("\n")
-        
-        markdown_text = "\n".join(markdown_parts)
-        
-        # Limpieza personalizada
-        final_text = clean_markdown_content(markdown_text)
-        
-        return final_text
+        return "\n\n".join(iter_excel_markdown_blocks(excel_path))
+
+    except Exception as e:
+        print(f"❌ Error al convertir {excel_path.name}: {e}")
+        return None
+
+def convert_excel_to_md_file(excel_path, output_path):
+    """
+    Convierte un fichero Excel escribiendo el Markdown bloque a bloque en
+    output_path, sin tener nunca la hoja ni la tabla completa en memoria.
+    Devuelve el número de bloques escritos (None si hay error).
+    """
+    print(f"🔄 Procesando: {excel_path.name}...")
+    
+    tmp_path = output_path.with_suffix(output_path.suffix + ".tmp")
+    try:
+        blocks = 0
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for block in iter_excel_markdown_blocks(excel_path):
+                if blocks:
+                    f.write("\n\n")
+                f.write(block)
+                blocks += 1
+        if not blocks:
+            tmp_path.unlink()
+            return 0
+        os.replace(tmp_path, output_path)
+        return blocks
 
     except Exception as e:
         print(f"❌ Error al convertir {excel_path.name}: {e}")
+        if tmp_path.exists():
+            tmp_path.unlink()
         return None
 
 def main():
@@ -185,21 +321,15 @@ def main():
             
             print(f"✅ Guardado: {output_filename}")
     
-    # Procesar archivos Excel
+    # Procesar archivos Excel (en streaming, directamente al fichero de salida)
     for file_path in excel_files:
-        # Generar contenido
-        md_content = convert_excel_to_md(file_path)
+        output_filename = file_path.stem + ".md"
+        output_path = Path(OUTPUT_FOLDER) / output_filename
         
-        if md_content:
-            # Definir nombre de salida
-            output_filename = file_path.stem + ".md"
-            output_path = Path(OUTPUT_FOLDER) / output_filename
-            
-            # Guardar fichero
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(md_content)
-            
-            print(f"✅ Guardado: {output_filename}")
+        blocks = convert_excel_to_md_file(file_path, output_path)
+        
+        if blocks:
+            print(f"✅ Guardado: {output_filename} ({blocks} bloques)")
 
     print("\n🚀 Proceso finalizado.")
 
@@ -0,0 +1,252 @@
+"""Índice vectorial de solo lectura en ficheros mapeados en memoria (mmap).
+
+Alternativa a abrir un PersistentClient de Chroma en cada proceso: ingest.py
+vuelca los vectores y metadatos de la BBDD a ficheros .npy contiguos y
+main.py (RAG_VECTOR_BACKEND=mmap) los abre con np.load(mmap_mode='r'). Todos
+los workers comparten la misma copia en la caché de páginas del sistema
+operativo, así que la memoria por worker apenas crece al añadir procesos.
+
+Estructura de la carpeta (cada construcción en una subcarpeta nueva; el
+puntero actual.json se sustituye de forma atómica):
+    actual.json            {"version": "v3"}
+    v3/manifest.json       Nº de filas, dimensiones, cuantización, espacio,
+                           rango de filas de cada categoría y parámetros IVF
+    v3/vectores.npy        float32 normalizados, o int8 + v3/escalas.npy
+    v3/registros.bin       JSON de cada fila (id, documento, metadatos) concatenados
+    v3/offsets.npy         Inicio de cada registro en registros.bin (N + 1)
+    v3/centroides.npy      (IVF) Centroides de las listas
+    v3/listas.npy          (IVF) Filas ordenadas por lista
+    v3/listas_offsets.npy  (IVF) Inicio de cada lista en listas.npy
+
+Las filas se ordenan por categoría, de modo que filtrar por categoría es
+tomar un rango contiguo de la matriz. Los chunks deduplicados que pertenecen
+a varias categorías (metadato 'categories') están en el rango de la primera
+y se añaden a las demás como filas extra (manifest["categorias_extra"]).
+"""
+
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+
+# --- CONFIGURACIÓN ---
+PUNTERO = "actual.json"
+VERSIONES_CONSERVADAS = 2  # Las anteriores se borran (los procesos que las mapean siguen funcionando)
+BLOQUE_FILAS = 4096  # Filas puntuadas por bloque (acota la memoria temporal con int8)
+ITERACIONES_KMEANS = 10
+
+def normalizar(matriz):
+    """Normaliza las filas a norma 1."""
+    return matriz / np.maximum(np.linalg.norm(matriz, axis=1, keepdims=True), 1e-12)
+
+def kmeans_esferico(matriz, k, iteraciones=ITERACIONES_KMEANS, semilla=0):
+    """K-means con similitud coseno sobre filas ya normalizadas. Devuelve (centroides, asignación)."""
+    generador = np.random.default_rng(semilla)
+    centroides = matriz[generador.choice(len(matriz), size=k, replace=False)].copy()
+    for _ in range(iteraciones):
+        asignacion = np.argmax(matriz @ centroides.T, axis=1)
+        for lista in range(k):
+            miembros = matriz[asignacion == lista]
+            if len(miembros):
+                centroides[lista] = miembros.sum(axis=0)
+        centroides = normalizar(centroides)
+    return centroides, np.argmax(matriz @ centroides.T, axis=1)
+
+def construir_indice_mmap(carpeta, ids, documentos, metadatas, embeddings,
+                          cuantizacion="float32", n_listas=0, espacio="cosine"):
+    """Escribe una nueva versión del índice y la publica en el puntero.
+
+    Args:
+        carpeta (str): Carpeta raíz del índice
+        ids, documentos, metadatas: Datos de cada fila (como collection.get)
+        embeddings: Matriz (N, dim) con los vectores
+        cuantizacion (str): 'float32' o 'int8' (escala por fila, 4x menos disco y memoria)
+        n_listas (int): Listas IVF (0 = solo búsqueda exacta)
+        espacio (str): Espacio de distancia de la colección de origen ('cosine', 'l2' o 'ip')
+
+    Returns:
+        str: Ruta de la versión creada
+    """
+    os.makedirs(carpeta, exist_ok=True)
+    version = f"v{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    destino = os.path.join(carpeta, version)
+    os.makedirs(destino)
+
+    # Ordenar filas por categoría para que cada una sea un rango contiguo
+    categorias = [(meta or {}).get("category", "") for meta in metadatas]
+    orden = sorted(range(len(ids)), key=lambda i: categorias[i])
+    matriz = normalizar(np.asarray(embeddings, dtype=np.float32)[orden])
+
+    rangos = {}
+    extra = {}
+    for fila, i in enumerate(orden):
+        inicio, _ = rangos.get(categorias[i], (fila, fila))
+        rangos[categorias[i]] = (inicio, fila + 1)
+        for otra in (metadatas[i] or {}).get("categories") or []:
+            if otra != categorias[i]:
+                extra.setdefault(otra, []).append(fila)
+
+    if cuantizacion == "int8":
+        escalas = np.maximum(np.abs(matriz).max(axis=1), 1e-12) / 127
+        np.save(os.path.join(destino, "vectores.npy"), np.round(matriz / escalas[:, None]).astype(np.int8))
+        np.save(os.path.join(destino, "escalas.npy"), escalas.astype(np.float32))
+    else:
+        np.save(os.path.join(destino, "vectores.npy"), matriz)
+
+    offsets = [0]
+    with open(os.path.join(destino, "registros.bin"), "wb") as f:
+        for i in orden:
+            registro = json.dumps({"id": ids[i], "document": documentos[i], "metadata": metadatas[i] or {}},
+                                  ensure_ascii=False).encode("utf-8")
+            f.write(registro)
+            offsets.append(offsets[-1] + len(registro))
+    np.save(os.path.join(destino, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+    n_listas = min(n_listas, len(matriz))
+    if n_listas:
+        centroides, asignacion = kmeans_esferico(matriz, n_listas)
+        listas = np.argsort(asignacion, kind="stable")
+        listas_offsets = np.concatenate(([0], np.cumsum(np.bincount(asignacion, minlength=n_listas))))
+        np.save(os.path.join(destino, "centroides.npy"), centroides.astype(np.float32))
+        np.save(os.path.join(destino, "listas.npy"), listas.astype(np.int64))
+        np.save(os.path.join(destino, "listas_offsets.npy"), listas_offsets.astype(np.int64))
+
+    manifest = {
+        "filas": len(matriz),
+        "dimensiones": int(matriz.shape[1]) if len(matriz) else 0,
+        "cuantizacion": cuantizacion,
+        "espacio": espacio,
+        "categorias": rangos,
+        "categorias_extra": extra,
+        "listas_ivf": n_listas,
+        "creado": datetime.now().isoformat(timespec="seconds")
+    }
+    with open(os.path.join(destino, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # Publicar de forma atómica y limpiar versiones antiguas
+    temporal = os.path.join(carpeta, PUNTERO + ".tmp")
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump({"version": version}, f)
+    os.replace(temporal, os.path.join(carpeta, PUNTERO))
+
+    versiones = sorted(d for d in os.listdir(carpeta) if d.startswith("v") and os.path.isdir(os.path.join(carpeta, d)))
+    for antigua in versiones[:-VERSIONES_CONSERVADAS]:
+        shutil.rmtree(os.path.join(carpeta, antigua), ignore_errors=True)
+    return destino
+
+class IndiceMmap:
+    """Índice de solo lectura sobre los ficheros de construir_indice_mmap.
+
+    Las búsquedas son exactas (producto matricial por bloques) o IVF
+    (se puntúan solo las 'n_sondeos' listas más cercanas a la pregunta).
+    Es seguro usarlo desde varios hilos: no tiene estado mutable.
+    """
+
+    def __init__(self, carpeta, n_sondeos=8):
+        with open(os.path.join(carpeta, PUNTERO), "r", encoding="utf-8") as f:
+            self.ruta = os.path.join(carpeta, json.load(f)["version"])
+        with open(os.path.join(self.ruta, "manifest.json"), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+
+        self.vectores = self._cargar("vectores.npy")
+        self.escalas = self._cargar("escalas.npy") if self.manifest["cuantizacion"] == "int8" else None
+        self.offsets = self._cargar("offsets.npy")
+        self.registros = np.memmap(os.path.join(self.ruta, "registros.bin"), dtype=np.uint8, mode="r") \
+            if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+        self.n_sondeos = n_sondeos
+        if self.manifest["listas_ivf"]:
+            self.centroides = self._cargar("centroides.npy")
+            self.listas = self._cargar("listas.npy")
+            self.listas_offsets = self._cargar("listas_offsets.npy")
+
+    def _cargar(self, nombre):
+        return np.load(os.path.join(self.ruta, nombre), mmap_mode="r")
+
+    def _similitudes(self, filas, consulta):
+        """Similitud coseno de la consulta con las filas indicadas (slice o array de índices)."""
+        if isinstance(filas, slice):
+            partes = []
+            for inicio in range(filas.start, filas.stop, BLOQUE_FILAS):
+                bloque = slice(inicio, min(inicio + BLOQUE_FILAS, filas.stop))
+                partes.append(self._similitudes_bloque(bloque, consulta))
+            return np.concatenate(partes) if partes else np.zeros(0, dtype=np.float32)
+        return self._similitudes_bloque(filas, consulta)
+
+    def _similitudes_bloque(self, filas, consulta):
+        similitud = self.vectores[filas].astype(np.float32, copy=False) @ consulta
+        if self.escalas is not None:
+            similitud *= self.escalas[filas]
+        return similitud
+
+    def _candidatos_ivf(self, consulta, inicio, fin, extra):
+        """Filas del rango [inicio, fin) o de 'extra' que están en las listas más cercanas a la consulta."""
+        cercanas = np.argsort(-(self.centroides @ consulta))[:self.n_sondeos]
+        filas = np.concatenate([
+            self.listas[self.listas_offsets[lista]:self.listas_offsets[lista + 1]] for lista in cercanas
+        ])
+        return np.sort(filas[((filas >= inicio) & (filas < fin)) | np.isin(filas, extra)])
+
+    def _distancias(self, similitud):
+        """Convierte similitud coseno a la distancia del espacio de la colección de origen."""
+        if self.manifest["espacio"] == "l2":
+            return 2 - 2 * similitud
+        return 1 - similitud
+
+    def _registro(self, fila):
+        return json.loads(bytes(self.registros[self.offsets[fila]:self.offsets[fila + 1]]).decode("utf-8"))
+
+    def consultar(self, query_embeddings, categoria, n_results, include):
+        """Búsqueda con el mismo formato de resultado que collection.query() (una sola pregunta).
+
+        Args:
+            query_embeddings: Lista con el vector de la pregunta
+            categoria (str): Categoría a la que restringir ('DESCONOCIDA' = todas)
+            n_results (int): Número de resultados
+            include (list): Campos a devolver ('documents', 'metadatas', 'distances', 'embeddings')
+        """
+        extra = []
+        if categoria in (None, "DESCONOCIDA"):
+            inicio, fin = 0, self.manifest["filas"]
+        else:
+            inicio, fin = self.manifest["categorias"].get(categoria, (0, 0))
+            extra = self.manifest.get("categorias_extra", {}).get(categoria, [])
+
+        consulta = np.asarray(query_embeddings[0], dtype=np.float32).ravel()
+        consulta = consulta / max(float(np.linalg.norm(consulta)), 1e-12)
+
+        filas = None
+        if self.manifest["listas_ivf"] and (fin > inicio or extra):
+            filas = self._candidatos_ivf(consulta, inicio, fin, extra)
+            if len(filas) < n_results:
+                filas = None  # Pocas filas en las listas sondeadas: búsqueda exacta
+        if filas is None and extra:
+            filas = np.concatenate((np.arange(inicio, fin), np.asarray(extra, dtype=np.int64)))
+            similitud = self._similitudes(filas, consulta)
+        elif filas is None:
+            filas = np.arange(inicio, fin)
+            similitud = self._similitudes(slice(inicio, fin), consulta)
+        else:
+            similitud = self._similitudes(filas, consulta)
+
+        k = min(n_results, len(filas))
+        mejores = np.argpartition(-similitud, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        mejores = mejores[np.argsort(-similitud[mejores], kind="stable")]
+        seleccion = filas[mejores]
+
+        registros = [self._registro(int(fila)) for fila in seleccion]
+        resultado = {
+            "ids": [[r["id"] for r in registros]],
+            "documents": [[r["document"] for r in registros]] if "documents" in include else None,
+            "metadatas": [[r["metadata"] for r in registros]] if "metadatas" in include else None,
+            "distances": [self._distancias(similitud[mejores]).tolist()] if "distances" in include else None,
+            "embeddings": None
+        }
+        if "embeddings" in include:
+            vectores = np.asarray(self.vectores[seleccion], dtype=np.float32)
+            if self.escalas is not None:
+                vectores *= self.escalas[seleccion][:, None]
+            resultado["embeddings"] = [vectores.tolist()]
+        return resultado
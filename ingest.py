@@ -1,8 +1,18 @@
 import re
+import argparse
+import hashlib
+import json
+import random
+import time
+import unicodedata
+import zlib
 import chromadb
-from chromadb.utils import embedding_functions
+import numpy as np
 from pathlib import Path
+from datetime import datetime
 from dotenv import load_dotenv
+from transporte import crear_funcion_embeddings, get_api_key
+from perfilado import PERFILAR, perfilar
 import uuid
 import os
 
@@ -14,27 +24,105 @@ INPUT_FOLDER = './doc/doc_scangestor'  # Carpeta raíz donde buscar los .md
 DB_PATH = './bbdd'    # Dónde guardar la BBDD Chroma
 COLLECTION_NAME = "documentacion_openai"
 MODEL_NAME = "text-embedding-3-small"
+# Particionado: una colección por categoría (carpeta padre) en lugar de una compartida
+PARTITION_BY_CATEGORY = os.getenv("RAG_PARTITION_BY_CATEGORY", "0").lower() in ("1", "true", "yes", "si")
+PARTITION_SEPARATOR = "__"
+# Fichero de versión del índice: main.py lo vigila para invalidar sus cachés
+INDEX_VERSION_FILE = os.path.join(DB_PATH, 'index_version.json')
+# Modo --watch: ventana de agrupación de eventos y periodo del sondeo alternativo
+WATCH_DEBOUNCE_MS = int(os.getenv("RAG_WATCH_DEBOUNCE_MS", "1500"))
+WATCH_POLL_INTERVAL = float(os.getenv("RAG_WATCH_POLL_INTERVAL", "2"))
+# Modo --dry-run: precio y límites de la API de embeddings para las estimaciones
+EMBEDDING_PRICE_PER_MTOK = float(os.getenv("RAG_EMBEDDING_PRICE_PER_MTOK", "0.02"))  # USD / 1M tokens
+EMBEDDING_RPM = int(os.getenv("RAG_EMBEDDING_RPM", "3000"))
+EMBEDDING_TPM = int(os.getenv("RAG_EMBEDDING_TPM", "1000000"))
+EMBEDDING_REQUEST_LATENCY = float(os.getenv("RAG_EMBEDDING_REQUEST_LATENCY", "0.5"))  # segundos
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+# Índice mmap de solo lectura para main.py (RAG_VECTOR_BACKEND=mmap), ver indice_vectorial.py
+MMAP_INDEX = os.getenv("RAG_MMAP_INDEX", "0").lower() in ("1", "true", "yes", "si")
+MMAP_INDEX_DIR = os.path.join(DB_PATH, 'indice_mmap')
+MMAP_QUANTIZATION = os.getenv("RAG_MMAP_QUANTIZATION", "float32")  # float32 | int8
+MMAP_IVF_MIN_ROWS = int(os.getenv("RAG_MMAP_IVF_MIN_ROWS", "5000"))  # por debajo, solo búsqueda exacta
+# Deduplicación de chunks casi idénticos (MinHash + LSH sobre shingles de palabras)
+DEDUP_CHUNKS = os.getenv("RAG_DEDUP_CHUNKS", "0").lower() in ("1", "true", "yes", "si")
+DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.85"))  # Jaccard mínimo para considerar duplicado
+SHINGLE_SIZE = 3          # Palabras por shingle
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16        # 16 bandas x 4 filas: casi todos los pares con Jaccard >= 0.85 son candidatos
+EMBEDDING_DIMENSIONS = 1536  # text-embedding-3-small (para estimar el espacio ahorrado)
+# Índice de preguntas y respuestas precalculadas (--qa): un LLM propone preguntas
+# probables y sus respuestas a partir de cada grupo de chunks; main.py sirve las
+# preguntas casi iguales directamente desde esta colección
+QA_INDEX = os.getenv("RAG_QA_INDEX", "0").lower() in ("1", "true", "yes", "si")
+QA_COLLECTION_NAME = f"{COLLECTION_NAME}_qa"
+QA_MODEL = os.getenv("RAG_QA_MODEL", "gpt-4o-mini")
+QA_CHUNKS_PER_GROUP = int(os.getenv("RAG_QA_CHUNKS_PER_GROUP", "3"))
+QA_QUESTIONS_PER_GROUP = int(os.getenv("RAG_QA_QUESTIONS_PER_GROUP", "4"))
+QA_WORKERS = int(os.getenv("RAG_QA_WORKERS", "4"))
+# Índice de documentos (--doc-index) para la recuperación jerárquica de main.py
+# (RAG_HIERARCHICAL=1): un vector por fichero, centroide de los de sus chunks
+DOC_INDEX = os.getenv("RAG_DOC_INDEX", "0").lower() in ("1", "true", "yes", "si")
+DOC_COLLECTION_NAME = f"{COLLECTION_NAME}_docs"
+DOC_PREVIEW_CHARS = 300
+# Reconstrucción blue/green (--rebuild): cada generación vive en sus propias
+# colecciones ('<nombre>.v<N>'; la 0 son las colecciones sin sufijo) y
+# INDEX_VERSION_FILE indica cuál está publicada. La nueva se construye junto a
+# la publicada, se valida y se publica de golpe; main.py la carga sin reiniciar
+GENERATION_SEPARATOR = ".v"
+KEEP_GENERATIONS = int(os.getenv("RAG_KEEP_GENERATIONS", "2"))  # publicada + anteriores para --rollback
+REBUILD_MIN_CHUNK_RATIO = float(os.getenv("RAG_REBUILD_MIN_CHUNK_RATIO", "0.5"))  # chunks nuevos / publicados
+REBUILD_SAMPLE_SIZE = int(os.getenv("RAG_REBUILD_SAMPLE", "50"))  # chunks consultados con su propio vector
+REBUILD_MIN_SELF_RECALL = float(os.getenv("RAG_REBUILD_MIN_SELF_RECALL", "0.95"))
+REBUILD_QUESTIONS = os.getenv("RAG_REBUILD_QUESTIONS", "./preguntas_oro.jsonl")  # formato de barrido_chunking.py
+REBUILD_RECALL_K = int(os.getenv("RAG_REBUILD_RECALL_K", "5"))
+REBUILD_RECALL_TOLERANCE = float(os.getenv("RAG_REBUILD_RECALL_TOLERANCE", "0.05"))  # pérdida de recall admitida
+QA_PROMPT = """Genera preguntas frecuentes sobre la documentación de ScanGasto.
 
-# Verificar API KEY
-if not os.getenv("OPENAI_API_KEY"):
-    raise ValueError("❌ No se encontró la variable OPENAI_API_KEY. Configura tu archivo .env")
+A partir de los FRAGMENTOS del fichero "{source}", escribe {n} preguntas que un usuario haría de forma natural y, para cada una, una respuesta completa basada ÚNICAMENTE en los fragmentos (sin inventar datos). Omite las preguntas que los fragmentos no permitan responder.
 
-def get_chroma_collection():
-    """Configura el cliente y la función de embedding de OpenAI."""
+Responde SOLO con un array JSON: [{{"pregunta": "...", "respuesta": "..."}}]
+
+FRAGMENTOS:
+{fragments}"""
+
+def check_api_key():
+    """Verificar API KEY (no hace falta en --dry-run ni al reproducir un casete)."""
+    if not get_api_key():
+        raise ValueError("❌ No se encontró la variable OPENAI_API_KEY. Configura tu archivo .env")
+
+def partition_collection_name(category):
+    """
+    Devuelve el nombre de la colección particionada de una categoría.
+    Ej: FUNCIONAL -> documentacion_openai__funcional
+    """
+    suffix = re.sub(r'[^a-z0-9]+', '_', category.lower()).strip('_')
+    return f"{COLLECTION_NAME}{PARTITION_SEPARATOR}{suffix}"
+
+def get_chroma_collection(name=COLLECTION_NAME):
+    """Configura el cliente y la función de embedding de OpenAI.
+    'name' es el nombre lógico: se abre la colección de la generación publicada
+    (o de la que se está construyendo con --rebuild).
+    """
     client = chromadb.PersistentClient(path=DB_PATH)
     
-    # Usamos la función nativa de Chroma para OpenAI
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        model_name=MODEL_NAME
-    )
+    # Función nativa de Chroma para OpenAI sobre el transporte HTTP compartido
+    openai_ef = crear_funcion_embeddings(MODEL_NAME)
     
     collection = client.get_or_create_collection(
-        name=COLLECTION_NAME,
+        name=resolve_collection_name(name),
         embedding_function=openai_ef
     )
     return collection
 
+# Cache de colecciones particionadas (categoría -> colección)
+_partition_cache = {}
+
+def get_partition_collection(category):
+    """Devuelve (y cachea) la colección particionada de una categoría."""
+    if category not in _partition_cache:
+        _partition_cache[category] = get_chroma_collection(partition_collection_name(category))
+    return _partition_cache[category]
+
 def split_text_by_markdown_paragraphs(text, max_chunk_size=2000, min_chunk_size=100):
     """
     Divide el texto en chunks por párrafos de Markdown.
@@ -110,9 +198,9 @@ def file_exists_in_db(collection, source_file_path):
     Consulta si ya existen vectores asociados a este fichero.
     Devuelve True si encuentra al menos uno.
     """
-    # Buscamos en metadatos usando el filtro 'where'
+    # Buscamos en metadatos usando el filtro 'where' (también como fuente de un chunk deduplicado)
     results = collection.get(
-        where={"source_file": source_file_path},
+        where=source_filter(source_file_path),
         limit=1
     )
     # Si la lista de IDs devuelta no está vacía, es que existe
@@ -121,25 +209,680 @@ def file_exists_in_db(collection, source_file_path):
 def delete_file_from_db(collection, source_file_path):
     """
     Elimina todos los vectores asociados a un fichero específico.
+    Los chunks deduplicados que comparte con otros ficheros no se borran:
+    solo se quita el fichero de su lista de fuentes (y, si era la fuente
+    canónica, pasa a serlo la siguiente).
     """
     # Buscar todos los IDs asociados al archivo
     results = collection.get(
-        where={"source_file": source_file_path}
+        where=source_filter(source_file_path),
+        include=['metadatas']
     )
     
-    if results['ids']:
-        collection.delete(ids=results['ids'])
-        print(f"   🗑️  Eliminados {len(results['ids'])} vectores anteriores")
-        return len(results['ids'])
-    return 0
+    delete_ids, update_ids, update_metadatas = [], [], []
+    for chunk_id, metadata in zip(results['ids'], results['metadatas']):
+        remaining = [s for s in chunk_sources(metadata) if s[0] != source_file_path]
+        if remaining:
+            update_ids.append(chunk_id)
+            update_metadatas.append(set_chunk_sources(metadata, remaining))
+        else:
+            delete_ids.append(chunk_id)
+    
+    if update_ids:
+        collection.update(ids=update_ids, metadatas=update_metadatas)
+        print(f"   ♻️  {len(update_ids)} vectores compartidos se conservan para otros ficheros")
+    if delete_ids:
+        collection.delete(ids=delete_ids)
+        print(f"   🗑️  Eliminados {len(delete_ids)} vectores anteriores")
+    # Sus respuestas precalculadas dejan de ser válidas hasta la próxima ejecución de --qa
+    delete_qa_entries(source_file_path)
+    return len(delete_ids) + len(update_ids)
+
+def content_hash(content):
+    """Huella del contenido de un fichero (se guarda en los metadatos de cada chunk)."""
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+# Coeficientes de las permutaciones MinHash: h_i(x) = (a_i * x + b_i) mod p
+_MERSENNE_PRIME = (1 << 61) - 1
+_minhash_rng = np.random.default_rng(1)
+_MINHASH_A = _minhash_rng.integers(1, 1 << 30, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_B = _minhash_rng.integers(0, 1 << 30, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def chunk_shingles(text):
+    """Shingles de SHINGLE_SIZE palabras (minúsculas, sin tildes ni puntuación)."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    words = re.findall(r'\w+', ''.join(c for c in text if not unicodedata.combining(c)))
+    if len(words) <= SHINGLE_SIZE:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def lsh_band_keys(shingles):
+    """Firma MinHash de los shingles agrupada en MINHASH_BANDS claves de banda."""
+    hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # a < 2^30 y hash < 2^32: el producto cabe en uint64 antes del módulo
+    signature = ((np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MERSENNE_PRIME).min(axis=1)
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [
+        f"{band}:{hashlib.sha1(signature[band * rows:(band + 1) * rows].tobytes()).hexdigest()[:16]}"
+        for band in range(MINHASH_BANDS)
+    ]
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def band_filter(band_keys):
+    """Filtro 'where' que encuentra los chunks que comparten alguna banda LSH."""
+    clauses = [{"minhash_bands": {"$contains": key}} for key in band_keys]
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+def source_filter(source_file):
+    """Filtro 'where' de los chunks de un fichero (propios o compartidos por deduplicación)."""
+    return {"$or": [{"source_file": source_file}, {"sources": {"$contains": source_file}}]}
+
+def chunk_sources(metadata):
+    """Lista de (source_file, category, chunk_index, content_hash) de un chunk."""
+    if metadata.get('sources'):
+        return list(zip(metadata['sources'], metadata['source_categories'],
+                        metadata['source_chunks'], metadata['source_hashes']))
+    return [(metadata.get('source_file'), metadata.get('category'),
+             metadata.get('chunk_index'), metadata.get('content_hash', ''))]
+
+def set_chunk_sources(metadata, sources):
+    """Reescribe los metadatos de un chunk a partir de su lista de fuentes (la primera es la canónica)."""
+    metadata.update({
+        "source_file": sources[0][0],
+        "category": sources[0][1],
+        "chunk_index": sources[0][2],
+        "content_hash": sources[0][3],
+        "sources": [s[0] for s in sources],
+        "source_categories": [s[1] for s in sources],
+        "source_chunks": [s[2] for s in sources],
+        "source_hashes": [s[3] for s in sources],
+        "categories": list(dict.fromkeys(s[1] for s in sources))
+    })
+    return metadata
+
+class NearDuplicateIndex:
+    """Índice LSH en memoria de los chunks de una ingesta (o de un plan en --dry-run)."""
+
+    def __init__(self, threshold=DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.buckets = {}
+        self.items = []
+
+    def find(self, shingles, band_keys):
+        """Devuelve el payload del chunk más parecido por encima del umbral, o None."""
+        candidates = {i for key in band_keys for i in self.buckets.get(key, ())}
+        best, best_score = None, self.threshold
+        for i in candidates:
+            score = jaccard(shingles, self.items[i][0])
+            if score >= best_score:
+                best, best_score = self.items[i][1], score
+        return best
+
+    def add(self, shingles, band_keys, payload):
+        for key in band_keys:
+            self.buckets.setdefault(key, []).append(len(self.items))
+        self.items.append((shingles, payload))
+
+def find_duplicate_in_collection(collection, shingles, band_keys, threshold=DEDUP_THRESHOLD):
+    """Busca en la colección un chunk casi idéntico (candidatos por banda LSH). Devuelve (id, metadatos) o None."""
+    candidates = collection.get(where=band_filter(band_keys), include=['documents', 'metadatas'])
+    best, best_score = None, threshold
+    for chunk_id, document, metadata in zip(candidates['ids'], candidates['documents'], candidates['metadatas']):
+        score = jaccard(shingles, chunk_shingles(document))
+        if score >= best_score:
+            best, best_score = (chunk_id, metadata), score
+    return best
+
+def new_dedup_report():
+    return {"chunks": 0, "duplicates": 0, "tokens_saved": 0, "bytes_saved": 0}
+
+def print_dedup_report(report):
+    """Resumen del ahorro de la deduplicación (embeddings no calculados y espacio en el índice)."""
+    if not report["chunks"]:
+        return
+    print(f"♻️  Deduplicación: {report['duplicates']} de {report['chunks']} chunks eran casi idénticos a otros "
+          f"({report['duplicates'] / report['chunks']:.1%})")
+    print(f"   - Embeddings ahorrados: {report['tokens_saved']} tokens "
+          f"(${report['tokens_saved'] / 1_000_000 * EMBEDDING_PRICE_PER_MTOK:.6f})")
+    print(f"   - Índice: ~{report['bytes_saved'] / 1024:.1f} KB menos ({report['duplicates']} vectores de {EMBEDDING_DIMENSIONS} dims + texto)")
+
+def add_file_chunks(collection, str_path, category_name, content, dedup=DEDUP_CHUNKS, report=None):
+    """
+    Trocea el contenido de un fichero y guarda sus chunks en la colección.
+    Con dedup=True, los chunks casi idénticos (Jaccard >= DEDUP_THRESHOLD) a
+    uno ya guardado o a otro del mismo fichero no se vectorizan: se añade el
+    fichero a la lista de fuentes ('sources', 'categories'...) del chunk canónico.
+    Solo se compara con 'collection': en modo particionado, con la partición
+    de la categoría (un chunk de otra partición no aparecería en sus búsquedas).
+    Devuelve el número de vectores guardados.
+    """
+    # Trocear texto (Chunking) por párrafos de Markdown
+    chunks = split_text_by_markdown_paragraphs(content)
+    digest = content_hash(content)
+
+    if not dedup:
+        # Preparar datos para Chroma
+        ids = [str(uuid.uuid4()) for _ in chunks]
+        metadatas = [{
+            "source_file": str_path,
+            "category": category_name,
+            "chunk_index": i,
+            "content_hash": digest
+        } for i in range(len(chunks))]
+
+        # Insertar (Aquí es donde Chroma llama a OpenAI automáticamente)
+        collection.add(
+            documents=chunks,
+            metadatas=metadatas,
+            ids=ids
+        )
+        return len(chunks)
+
+    count_tokens = get_token_counter() if report is not None else None
+    pending = NearDuplicateIndex()
+    documents, metadatas = [], []
+    for i, chunk in enumerate(chunks):
+        shingles = chunk_shingles(chunk)
+        band_keys = lsh_band_keys(shingles)
+        source = (str_path, category_name, i, digest)
+
+        # Primero contra los chunks de este mismo fichero, después contra la colección
+        duplicate = pending.find(shingles, band_keys)
+        if duplicate is None:
+            match = find_duplicate_in_collection(collection, shingles, band_keys)
+            if match:
+                duplicate, metadata = match
+                sources = chunk_sources(metadata)
+                if str_path not in [s[0] for s in sources]:
+                    collection.update(ids=[duplicate], metadatas=[set_chunk_sources(metadata, sources + [source])])
+
+        if report is not None:
+            report["chunks"] += 1
+            if duplicate is not None:
+                report["duplicates"] += 1
+                report["tokens_saved"] += count_tokens(chunk)
+                report["bytes_saved"] += EMBEDDING_DIMENSIONS * 4 + len(chunk.encode('utf-8'))
+        if duplicate is not None:
+            continue
+
+        pending.add(shingles, band_keys, len(documents))
+        documents.append(chunk)
+        metadatas.append(set_chunk_sources({"minhash_bands": band_keys}, [source]))
+
+    # Insertar (Aquí es donde Chroma llama a OpenAI automáticamente)
+    if documents:
+        collection.add(
+            documents=documents,
+            metadatas=metadatas,
+            ids=[str(uuid.uuid4()) for _ in documents]
+        )
+    return len(documents)
+
+def read_index_state():
+    """Contenido de INDEX_VERSION_FILE: versión, generación publicada e historial ({} si no existe)."""
+    try:
+        with open(INDEX_VERSION_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_index_state(data):
+    tmp_path = INDEX_VERSION_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    # Reemplazo atómico para que los lectores nunca vean un fichero a medias
+    os.replace(tmp_path, INDEX_VERSION_FILE)
+
+def publish_index_version(generation=None, history=None):
+    """
+    Incrementa la versión del índice en INDEX_VERSION_FILE.
+    main.py compara esta versión para recargar sus colecciones cacheadas.
+    Con 'generation' cambia además la generación publicada (--rebuild,
+    --rollback): la anterior pasa al principio del historial salvo que se
+    indique 'history'.
+    """
+    data = read_index_state()
+    data["version"] = data.get("version", 0) + 1
+    data["updated_at"] = datetime.now().isoformat(timespec='seconds')
+    if generation is not None:
+        previous = {"generation": data.get("generation", 0), "published_at": data.get("published_at")}
+        data["history"] = history if history is not None else [previous] + data.get("history", [])
+        data["generation"] = generation
+        data["published_at"] = data["updated_at"]
+    write_index_state(data)
+    print(f"📣 Publicada versión {data['version']} del índice"
+          + (f" (generación {generation})" if generation is not None else ""))
+    return data['version']
+
+# Generación que se está construyendo con --rebuild: mientras no es None, las
+# colecciones se resuelven a las suyas en lugar de a las publicadas
+_build_generation = None
+
+def versioned_collection_name(name, generation):
+    """Colección física de un nombre lógico en una generación (la 0 no lleva sufijo)."""
+    return f"{name}{GENERATION_SEPARATOR}{generation}" if generation else name
+
+def split_generation(physical_name):
+    """(nombre lógico, generación) de una colección física."""
+    match = re.fullmatch(rf'(.+){re.escape(GENERATION_SEPARATOR)}(\d+)', physical_name)
+    return (match.group(1), int(match.group(2))) if match else (physical_name, 0)
+
+def is_project_collection(name):
+    """True para las colecciones lógicas que gestiona ingest.py (principal, particiones, QA y documentos)."""
+    return (name in (COLLECTION_NAME, QA_COLLECTION_NAME, DOC_COLLECTION_NAME)
+            or name.startswith(COLLECTION_NAME + PARTITION_SEPARATOR))
+
+def is_chunk_collection(name):
+    """True para las colecciones lógicas de chunks (la compartida o las particiones)."""
+    return name == COLLECTION_NAME or name.startswith(COLLECTION_NAME + PARTITION_SEPARATOR)
+
+def live_generation():
+    """Generación en uso: la que se está construyendo o, si no, la publicada."""
+    return _build_generation if _build_generation is not None else read_index_state().get("generation", 0)
+
+def resolve_collection_name(name):
+    """Nombre físico de la colección lógica 'name' en la generación en uso."""
+    return versioned_collection_name(name, live_generation())
+
+def generation_collections(client, generation):
+    """{nombre lógico: nombre físico} de las colecciones del proyecto de una generación."""
+    collections = {}
+    for collection in client.list_collections():
+        name, collection_generation = split_generation(collection.name)
+        if collection_generation == generation and is_project_collection(name):
+            collections[name] = collection.name
+    return collections
+
+def get_token_counter():
+    """
+    Devuelve una función texto -> nº de tokens del modelo de embeddings.
+    Usa 'tiktoken' si está instalado; si no, aproxima con 4 caracteres por token.
+    """
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(MODEL_NAME)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return lambda text: (len(text) + 3) // 4
+
+def project_collections(client, partitioned=False):
+    """Colecciones existentes del proyecto en la generación en uso (la compartida o las particiones), en solo lectura."""
+    names = generation_collections(client, live_generation())
+    if partitioned:
+        selected = [n for n in names if n.startswith(COLLECTION_NAME + PARTITION_SEPARATOR)]
+    else:
+        selected = [n for n in names if n == COLLECTION_NAME]
+    return [client.get_collection(names[n]) for n in sorted(selected)]
+
+def read_indexed_files(partitioned=False):
+    """
+    Ficheros ya indexados, leídos en local y en modo solo lectura
+    (no crea colecciones ni necesita la función de embeddings).
+    """
+    if not os.path.isdir(DB_PATH):
+        return set()
+    client = chromadb.PersistentClient(path=DB_PATH)
+    return indexed_files(project_collections(client, partitioned))
+
+def build_mmap_index(partitioned=False, quantization=MMAP_QUANTIZATION):
+    """
+    Vuelca las colecciones del proyecto al índice mmap de solo lectura
+    (indice_vectorial.construir_indice_mmap). Con más de MMAP_IVF_MIN_ROWS
+    filas se añaden ~sqrt(N) listas IVF para no recorrer toda la matriz.
+    """
+    from indice_vectorial import construir_indice_mmap
+
+    client = chromadb.PersistentClient(path=DB_PATH)
+    ids, documents, metadatas, embeddings = [], [], [], []
+    space = "cosine"
+    for collection in project_collections(client, partitioned):
+        space = (collection.configuration_json.get('hnsw') or {}).get('space', space)
+        results = collection.get(include=['embeddings', 'documents', 'metadatas'])
+        ids.extend(results['ids'])
+        documents.extend(results['documents'])
+        metadatas.extend(results['metadatas'])
+        embeddings.extend(results['embeddings'])
+
+    if not ids:
+        print("⚠️ No hay vectores para el índice mmap")
+        return None
+
+    n_lists = int(len(ids) ** 0.5) if len(ids) >= MMAP_IVF_MIN_ROWS else 0
+    path = construir_indice_mmap(MMAP_INDEX_DIR, ids, documents, metadatas, embeddings,
+                                 cuantizacion=quantization, n_listas=n_lists, espacio=space)
+    print(f"🗺️  Índice mmap generado en {path}: {len(ids)} vectores ({quantization}, {n_lists} listas IVF)")
+    return path
+
+def indexed_chunks_by_file(collections):
+    """
+    Chunks indexados agrupados por fichero, en orden:
+    {source_file: {"category", "hash", "chunks": [(chunk_index, id, texto)]}}.
+    Un chunk deduplicado aparece en todos sus ficheros.
+    """
+    files = {}
+    for collection in collections:
+        results = collection.get(include=['documents', 'metadatas'])
+        for chunk_id, document, metadata in zip(results['ids'], results['documents'], results['metadatas']):
+            for source_file, category, chunk_index, source_hash in chunk_sources(metadata):
+                entry = files.setdefault(source_file, {"category": category, "hash": source_hash, "chunks": []})
+                entry["chunks"].append((chunk_index if chunk_index is not None else -1, chunk_id, document))
+    for entry in files.values():
+        entry["chunks"].sort(key=lambda chunk: chunk[0])
+    return files
+
+def generate_qa_pairs(llm, source_file, chunks, n_questions=QA_QUESTIONS_PER_GROUP):
+    """Pide al LLM preguntas y respuestas basadas en 'chunks'. Devuelve [(pregunta, respuesta)]."""
+    prompt = QA_PROMPT.format(source=Path(source_file).name, n=n_questions,
+                              fragments="\n\n---\n\n".join(chunks))
+    text = llm.invoke(prompt).content
+    start, end = text.find('['), text.rfind(']')
+    pairs = json.loads(text[start:end + 1]) if 0 <= start < end else []
+    return [
+        (pair['pregunta'].strip(), pair['respuesta'].strip())
+        for pair in pairs
+        if isinstance(pair, dict) and pair.get('pregunta') and pair.get('respuesta')
+    ][:n_questions]
+
+def delete_qa_entries(source_file):
+    """Elimina las preguntas precalculadas de un fichero (si existe el índice QA)."""
+    client = chromadb.PersistentClient(path=DB_PATH)
+    qa_name = resolve_collection_name(QA_COLLECTION_NAME)
+    if qa_name not in {c.name for c in client.list_collections()}:
+        return 0
+    qa_collection = client.get_collection(qa_name)
+    ids = qa_collection.get(where={"source_file": source_file})['ids']
+    if ids:
+        qa_collection.delete(ids=ids)
+        print(f"   🗑️  Eliminadas {len(ids)} preguntas precalculadas")
+    return len(ids)
+
+def build_qa_index(partitioned=False, workers=QA_WORKERS):
+    """
+    Genera o completa el índice de preguntas precalculadas (QA_COLLECTION_NAME).
+    Cada grupo de QA_CHUNKS_PER_GROUP chunks consecutivos de un fichero se
+    envía al LLM (QA_MODEL), que propone hasta QA_QUESTIONS_PER_GROUP
+    preguntas con su respuesta basada en esos chunks. Se embebe la pregunta y
+    la respuesta, el fichero, la categoría y los ids de los chunks van en los metadatos.
+    Es reanudable: cada grupo se guarda al terminar y se saltan los ya
+    generados para el mismo contenido (content_hash); las preguntas de
+    ficheros modificados o que ya no están indexados se eliminan.
+    Devuelve el nº de preguntas añadidas o eliminadas.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from transporte import crear_chat_openai
+
+    client = chromadb.PersistentClient(path=DB_PATH)
+    files = indexed_chunks_by_file(project_collections(client, partitioned))
+    qa_collection = get_chroma_collection(QA_COLLECTION_NAME)
+
+    done, stale = set(), []
+    existing = qa_collection.get(include=['metadatas'])
+    for qa_id, metadata in zip(existing['ids'], existing['metadatas']):
+        entry = files.get(metadata.get('source_file'))
+        if entry is None or entry['hash'] != metadata.get('content_hash'):
+            stale.append(qa_id)
+        else:
+            done.add((metadata['source_file'], metadata['group']))
+    if stale:
+        qa_collection.delete(ids=stale)
+        print(f"🗑️  Eliminadas {len(stale)} preguntas precalculadas obsoletas")
+
+    pending = [
+        (source_file, i // QA_CHUNKS_PER_GROUP, entry["chunks"][i:i + QA_CHUNKS_PER_GROUP])
+        for source_file, entry in sorted(files.items())
+        for i in range(0, len(entry["chunks"]), QA_CHUNKS_PER_GROUP)
+        if (source_file, i // QA_CHUNKS_PER_GROUP) not in done
+    ]
+    print(f"🧠 Preguntas precalculadas: {len(pending)} grupos pendientes, {len(done)} ya generados")
+    if not pending:
+        return len(stale)
+
+    llm = crear_chat_openai(model=QA_MODEL, temperature=0.2)
+    created = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(generate_qa_pairs, llm, source_file, [chunk[2] for chunk in chunks]): (source_file, group, chunks)
+            for source_file, group, chunks in pending
+        }
+        for future in as_completed(futures):
+            source_file, group, chunks = futures[future]
+            try:
+                pairs = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"   ❌ {Path(source_file).name} (grupo {group}): {e}")
+                continue
+            if not pairs:
+                continue
+            entry = files[source_file]
+            prefix = f"qa-{content_hash(source_file)[:12]}-{group}"
+            # El grupo se guarda completo de una vez: si se interrumpe, se regenera en la siguiente ejecución
+            qa_collection.upsert(
+                ids=[f"{prefix}-{i}" for i in range(len(pairs))],
+                documents=[question for question, _ in pairs],
+                metadatas=[{
+                    "respuesta": answer,
+                    "source_file": source_file,
+                    "category": entry["category"],
+                    "content_hash": entry["hash"],
+                    "group": group,
+                    "chunk_ids": [chunk[1] for chunk in chunks],
+                    "model": QA_MODEL,
+                    "generated_at": datetime.now().isoformat(timespec='seconds')
+                } for _, answer in pairs]
+            )
+            created += len(pairs)
+            print(f"   ✅ {Path(source_file).name} (grupo {group}): {len(pairs)} preguntas")
+
+    print(f"📊 Preguntas precalculadas: {created} nuevas, {qa_collection.count()} en total"
+          + (f", {failed} grupos con error (se reintentarán en la próxima ejecución)" if failed else ""))
+    return created + len(stale)
+
+def document_preview(chunks):
+    """Texto guardado con el vector de un documento: su primer título y el comienzo (solo para consultarlo)."""
+    text = "\n\n".join(chunk[2] for chunk in chunks)
+    title = next((line.lstrip('#').strip() for line in text.splitlines() if line.startswith('#')), "")
+    return (f"{title}\n\n" if title else "") + text[:DOC_PREVIEW_CHARS]
+
+def build_document_index(partitioned=False):
+    """
+    Genera o actualiza el índice de documentos (DOC_COLLECTION_NAME) de la
+    recuperación jerárquica de main.py: un vector por fichero, el centroide
+    normalizado de los embeddings de sus chunks (no llama a OpenAI). En los
+    metadatos van el fichero, la categoría, el content_hash, el nº de chunks y
+    la colección de chunks donde buscarlos. Solo se recalculan los ficheros
+    cuyo contenido o colección de chunks (al pasar a --partitioned o volver a
+    la compartida) ha cambiado y se eliminan los que ya no están indexados.
+    Devuelve el nº de documentos añadidos, actualizados o eliminados.
+    """
+    client = chromadb.PersistentClient(path=DB_PATH)
+    files = {}
+    for collection in project_collections(client, partitioned):
+        collection_name = split_generation(collection.name)[0]
+        for source_file, entry in indexed_chunks_by_file([collection]).items():
+            files[source_file] = (entry, collection, collection_name)
+
+    doc_collection = get_chroma_collection(DOC_COLLECTION_NAME)
+    existing = doc_collection.get(include=['metadatas'])
+    stored = {metadata['source_file']: (doc_id, metadata.get('content_hash'), metadata.get('chunk_collection'))
+              for doc_id, metadata in zip(existing['ids'], existing['metadatas'])}
+    stale = [doc_id for source_file, (doc_id, _, _) in stored.items() if source_file not in files]
+    pending = [source_file for source_file, (entry, _, collection_name) in sorted(files.items())
+               if stored.get(source_file, (None, None, None))[1:] != (entry['hash'], collection_name)]
+
+    ids, documents, metadatas, embeddings = [], [], [], []
+    for source_file in pending:
+        entry, collection, collection_name = files[source_file]
+        vectors = np.asarray(collection.get(where=source_filter(source_file), include=['embeddings'])['embeddings'],
+                             dtype=np.float32)
+        centroid = vectors.mean(axis=0)
+        ids.append(f"doc-{content_hash(source_file)[:16]}")
+        documents.append(document_preview(entry['chunks']))
+        embeddings.append((centroid / max(float(np.linalg.norm(centroid)), 1e-12)).tolist())
+        metadatas.append({
+            "source_file": source_file,
+            "category": entry['category'],
+            "content_hash": entry['hash'],
+            "n_chunks": len(vectors),
+            "chunk_collection": collection_name
+        })
+
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        doc_collection.upsert(ids=ids[start:end], documents=documents[start:end],
+                              metadatas=metadatas[start:end], embeddings=embeddings[start:end])
+    if stale:
+        doc_collection.delete(ids=stale)
+    if ids or stale:
+        print(f"📑 Índice de documentos: {len(ids)} recalculados, {len(stale)} eliminados, "
+              f"{doc_collection.count()} en total")
+    return len(ids) + len(stale)
+
+def plan_directory(root_folder, indexed, partitioned=False, dedup=DEDUP_CHUNKS):
+    """
+    Calcula qué haría process_directory sin escribir nada ni llamar a la red.
+    Aplica las mismas reglas ('__exclude', '__ACT', ficheros ya existentes y
+    vacíos), trocea con split_text_by_markdown_paragraphs y cuenta tokens.
+    Con dedup=True descuenta los chunks casi idénticos entre los ficheros a
+    ingerir (no compara con los que ya están en la BBDD).
+    Devuelve un dict con el detalle por fichero, los totales y las estimaciones.
+    """
+    count_tokens = get_token_counter()
+    files = []
+    totals = {"files": 0, "chunks": 0, "tokens": 0, "skipped": 0, "replaced": 0, "oversized_chunks": 0,
+              "duplicate_chunks": 0, "duplicate_tokens": 0}
+    dedup_indexes = {}  # colección destino -> NearDuplicateIndex
+
+    for file_path in sorted(Path(root_folder).rglob('*.md')):
+        if not is_ingestible(file_path):
+            files.append({"path": file_path.as_posix(), "action": "skip", "reason": "__exclude"})
+            totals["skipped"] += 1
+            continue
+
+        category_name = file_path.parent.name
+        is_update = file_path.stem.endswith("__ACT")
+        str_path = (file_path.parent / (file_path.stem[:-5] + ".md")).as_posix() if is_update else file_path.as_posix()
+        exists = str_path in indexed
+
+        if exists and not is_update:
+            files.append({"path": str_path, "action": "skip", "reason": "ya existe"})
+            totals["skipped"] += 1
+            continue
+
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        if not content.strip():
+            files.append({"path": file_path.as_posix(), "action": "skip", "reason": "vacío"})
+            totals["skipped"] += 1
+            continue
+
+        chunks = split_text_by_markdown_paragraphs(content)
+        chunk_tokens = [count_tokens(chunk) for chunk in chunks]
+        oversized = sum(t > EMBEDDING_MAX_INPUT_TOKENS for t in chunk_tokens)
+        collection_name = partition_collection_name(category_name) if partitioned else COLLECTION_NAME
+
+        duplicates = duplicate_tokens = 0
+        if dedup:
+            near_duplicates = dedup_indexes.setdefault(collection_name, NearDuplicateIndex())
+            for chunk, tokens in zip(chunks, chunk_tokens):
+                shingles = chunk_shingles(chunk)
+                band_keys = lsh_band_keys(shingles)
+                if near_duplicates.find(shingles, band_keys) is not None:
+                    duplicates += 1
+                    duplicate_tokens += tokens
+                else:
+                    near_duplicates.add(shingles, band_keys, True)
+
+        files.append({
+            "path": file_path.as_posix(),
+            "action": "update" if exists else "add",
+            "collection": collection_name,
+            "chunks": len(chunk_tokens),
+            "tokens": sum(chunk_tokens),
+            "oversized_chunks": oversized,
+            "duplicate_chunks": duplicates
+        })
+        totals["files"] += 1
+        totals["chunks"] += len(chunk_tokens)
+        totals["tokens"] += sum(chunk_tokens)
+        totals["oversized_chunks"] += oversized
+        totals["replaced"] += exists
+        totals["duplicate_chunks"] += duplicates
+        totals["duplicate_tokens"] += duplicate_tokens
+
+    # Cada fichero es una llamada de embeddings (collection.add de todos sus
+    # chunks) y la ingesta es secuencial: manda el mayor de los dos límites
+    requests = totals["files"]
+    tokens_to_embed = totals["tokens"] - totals["duplicate_tokens"]
+    rate_limit_s = max(requests / EMBEDDING_RPM, tokens_to_embed / EMBEDDING_TPM) * 60
+    return {
+        "files": files,
+        "totals": totals,
+        "estimated_cost_usd": tokens_to_embed / 1_000_000 * EMBEDDING_PRICE_PER_MTOK,
+        "estimated_duration_s": max(rate_limit_s, requests * EMBEDDING_REQUEST_LATENCY)
+    }
+
+def print_ingest_plan(plan):
+    """Muestra el plan de ingesta calculado por plan_directory."""
+    icons = {"add": "➕", "update": "🔄", "skip": "⏭️ "}
+    for entry in plan["files"]:
+        if entry["action"] == "skip":
+            print(f"{icons['skip']} {entry['path']} ({entry['reason']})")
+            continue
+        warning = f" ⚠️ {entry['oversized_chunks']} chunks > {EMBEDDING_MAX_INPUT_TOKENS} tokens" if entry["oversized_chunks"] else ""
+        duplicates = f" ({entry['duplicate_chunks']} duplicados)" if entry["duplicate_chunks"] else ""
+        print(f"{icons[entry['action']]} {entry['path']} -> {entry['collection']}: "
+              f"{entry['chunks']} chunks{duplicates}, {entry['tokens']} tokens{warning}")
+
+    totals = plan["totals"]
+    print("\n" + "="*40)
+    print("🧮 PLAN DE INGESTA (dry-run, sin cambios):")
+    print(f"   - Ficheros a vectorizar: {totals['files']} ({totals['replaced']} reemplazan vectores existentes)")
+    print(f"   - Omitidos: {totals['skipped']}")
+    print(f"   - Chunks: {totals['chunks']} | Tokens: {totals['tokens']}")
+    if totals["duplicate_chunks"]:
+        print(f"   - Casi duplicados (no se vectorizan): {totals['duplicate_chunks']} chunks, "
+              f"{totals['duplicate_tokens']} tokens, ~{totals['duplicate_chunks'] * EMBEDDING_DIMENSIONS * 4 / 1024:.1f} KB de vectores")
+    print(f"   - Coste estimado: ${plan['estimated_cost_usd']:.6f} (a ${EMBEDDING_PRICE_PER_MTOK}/1M tokens)")
+    print(f"   - Duración estimada: {plan['estimated_duration_s']:.1f}s "
+          f"({EMBEDDING_RPM} RPM, {EMBEDDING_TPM} TPM, {EMBEDDING_REQUEST_LATENCY}s por llamada)")
+    if totals["oversized_chunks"]:
+        print(f"   - ⚠️ {totals['oversized_chunks']} chunks superan el límite de {EMBEDDING_MAX_INPUT_TOKENS} tokens del modelo")
+    print("="*40)
 
-def process_directory(root_folder, collection):
+def process_directory(root_folder, collection, partitioned=False, dry_run=False, mmap_index=MMAP_INDEX,
+                      dedup=DEDUP_CHUNKS, qa_index=QA_INDEX, doc_index=DOC_INDEX, publish=True):
+    """
+    Recorre la carpeta y vectoriza los .md que no estén ya en la BBDD.
+    Con partitioned=True cada fichero se guarda en la colección de su
+    categoría (ver partition_collection_name) en lugar de en 'collection'.
+    Con dry_run=True solo calcula y muestra el plan (ver plan_directory):
+    no renombra, no escribe en la BBDD ni llama a OpenAI; 'collection' puede ser None.
+    Con mmap_index=True se regenera el índice mmap antes de publicar la versión.
+    Con dedup=True los chunks casi idénticos se guardan una sola vez (ver
+    add_file_chunks) y al final se muestra el ahorro.
+    Con qa_index=True se generan después las preguntas precalculadas que
+    falten (ver build_qa_index).
+    Con doc_index=True se actualiza el índice de documentos de la
+    recuperación jerárquica (ver build_document_index).
+    Con publish=False no se regeneran los índices mmap y de documentos ni se
+    publica versión (lo hace rebuild_generation tras validar). Devuelve el nº
+    de ficheros vectorizados.
+    """
     root_path = Path(root_folder)
     
     if not root_path.exists():
         print(f"⚠️ La carpeta {root_folder} no existe.")
         return
 
+    if dry_run:
+        plan = plan_directory(root_folder, read_indexed_files(partitioned), partitioned=partitioned, dedup=dedup)
+        print_ingest_plan(plan)
+        return plan
+
     print(f"🔍 Escaneando '{root_folder}' recursivamente...\n")
 
     # rglob('*') busca recursivamente cualquier archivo
@@ -151,6 +894,7 @@ def process_directory(root_folder, collection):
 
     processed_count = 0
     skipped_count = 0
+    dedup_report = new_dedup_report()
 
     for file_path in files:
         # Verificar que el archivo sea .md (seguridad adicional)
@@ -164,6 +908,10 @@ def process_directory(root_folder, collection):
             print(f"🚫 Excluyendo: {file_path.name} (carpeta con '__exclude')")
             skipped_count += 1
             continue
+
+        # category: nombre de la carpeta padre inmediata
+        category_name = file_path.parent.name
+        target = get_partition_collection(category_name) if partitioned else collection
         
         # Manejar archivos con sufijo __ACT.md (actualización)
         is_update = file_path.stem.endswith("__ACT")
@@ -174,9 +922,9 @@ def process_directory(root_folder, collection):
             str_path = original_path.as_posix()
             
             # Comprobar si existe la versión anterior en la BBDD
-            if file_exists_in_db(collection, str_path):
+            if file_exists_in_db(target, str_path):
                 print(f"🔄 Actualizando: {file_path.name} -> {original_path.name}")
-                delete_file_from_db(collection, str_path)
+                delete_file_from_db(target, str_path)
             else:
                 print(f"➕ Nuevo archivo (con __ACT): {file_path.name} -> {original_path.name}")
             
@@ -193,16 +941,13 @@ def process_directory(root_folder, collection):
             str_path = file_path.as_posix()
             
             # Comprobar existencia (Idempotencia)
-            if file_exists_in_db(collection, str_path):
+            if file_exists_in_db(target, str_path):
                 print(f"⏭️  Saltando (ya existe): {file_path.name}")
                 skipped_count += 1
                 continue
         
         # Mostrar que se está procesando el archivo
         print(f"⚡ Procesando: {file_path.name}")
-        
-        # category: nombre de la carpeta padre inmediata
-        category_name = file_path.parent.name
 
         try:
             # Leer contenido
@@ -214,25 +959,11 @@ def process_directory(root_folder, collection):
                 skipped_count += 1
                 continue
 
-            # Trocear texto (Chunking) por párrafos de Markdown
-            chunks = split_text_by_markdown_paragraphs(content)
-            
-            # Preparar datos para Chroma
-            ids = [str(uuid.uuid4()) for _ in chunks]
-            metadatas = [{
-                "source_file": str_path,
-                "category": category_name,
-                "chunk_index": i
-            } for i in range(len(chunks))]
-
-            # Insertar (Aquí es donde Chroma llama a OpenAI automáticamente)
-            collection.add(
-                documents=chunks,
-                metadatas=metadatas,
-                ids=ids
-            )
+            # Trocear, deduplicar y guardar (Chroma llama a OpenAI en collection.add)
+            num_chunks = add_file_chunks(target, str_path, category_name, content,
+                                         dedup=dedup, report=dedup_report)
             processed_count += 1
-            print(f"   ✅ Guardados {len(chunks)} vectores.")
+            print(f"   ✅ Guardados {num_chunks} vectores.")
 
         except Exception as e:
             print(f"   ❌ Error procesando {file_path.name}: {e}")
@@ -242,8 +973,524 @@ def process_directory(root_folder, collection):
     print(f"📊 RESUMEN:")
     print(f"   - Procesados y vectorizados: {processed_count}")
     print(f"   - Omitidos (existen o fueron excluidos): {skipped_count}")
+    print_dedup_report(dedup_report)
     print("="*40)
 
+    qa_changes = build_qa_index(partitioned) if qa_index else 0
+    doc_changes = build_document_index(partitioned) if doc_index and publish else 0
+    if publish and (processed_count or qa_changes or doc_changes):
+        if mmap_index and processed_count:
+            build_mmap_index(partitioned)
+        publish_index_version()
+    return processed_count
+
+def is_ingestible(file_path):
+    """Indica si un fichero entra en la BBDD (.md fuera de carpetas '__exclude')."""
+    return (file_path.suffix.lower() == '.md'
+            and not any(part.endswith("__exclude") for part in file_path.parts))
+
+def sync_file(file_path, collection, partitioned=False, dedup=DEDUP_CHUNKS):
+    """
+    Sincroniza un único fichero con la BBDD (modo --watch).
+    - Si existe y es ingerible: lo vectoriza de nuevo solo si su contenido cambió.
+    - Si ya no existe, se renombró o quedó dentro de '__exclude': borra sus vectores.
+    - Los ficheros '__ACT.md' se renombran a su nombre original como en process_directory.
+    Devuelve 'added', 'updated', 'deleted' o None si no había nada que hacer.
+    """
+    file_path = Path(file_path)
+
+    if file_path.stem.endswith("__ACT") and file_path.is_file() and is_ingestible(file_path):
+        original_path = file_path.parent / (file_path.stem[:-5] + ".md")
+        try:
+            file_path.rename(original_path)
+            print(f"   📝 Archivo renombrado físicamente: {file_path.name} -> {original_path.name}")
+            file_path = original_path
+        except Exception as e:
+            print(f"   ⚠️ No se pudo renombrar el archivo físicamente: {e}")
+
+    str_path = file_path.as_posix()
+    category_name = file_path.parent.name
+    target = get_partition_collection(category_name) if partitioned else collection
+
+    content = ""
+    if file_path.is_file() and is_ingestible(file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+    if not content.strip():
+        if delete_file_from_db(target, str_path):
+            print(f"🗑️  Eliminado del índice: {str_path}")
+            return 'deleted'
+        return None
+
+    existing = target.get(where=source_filter(str_path), limit=1, include=['metadatas'])
+    stored_hash = None
+    if existing['ids']:
+        stored_hash = {source[0]: source[3] for source in chunk_sources(existing['metadatas'][0])}.get(str_path)
+    if stored_hash == content_hash(content):
+        return None
+
+    if existing['ids']:
+        print(f"🔄 Actualizando: {file_path.name}")
+        delete_file_from_db(target, str_path)
+    else:
+        print(f"➕ Nuevo archivo: {file_path.name}")
+    num_chunks = add_file_chunks(target, str_path, category_name, content, dedup=dedup)
+    print(f"   ✅ Guardados {num_chunks} vectores.")
+    return 'updated' if existing['ids'] else 'added'
+
+def indexed_files(collections):
+    """Conjunto de ficheros fuente presentes en las colecciones indicadas (incluidos los deduplicados)."""
+    files = set()
+    for collection in collections:
+        results = collection.get(include=['metadatas'])
+        files.update(source[0] for meta in results['metadatas'] if meta for source in chunk_sources(meta))
+    return files
+
+def expand_changed_paths(paths, collections):
+    """
+    Traduce las rutas de un lote de eventos a los ficheros .md afectados.
+    Las carpetas creadas se expanden a sus .md; las carpetas borradas o
+    renombradas (p.ej. a '__exclude') se expanden a los ficheros indexados
+    que contenían, para poder eliminarlos del índice.
+    """
+    cwd = Path.cwd()
+    indexed = None
+    targets = set()
+    for raw_path in paths:
+        path = Path(raw_path)
+        if path.is_absolute():
+            path = Path(os.path.relpath(path, cwd))
+
+        if path.suffix.lower() == '.md':
+            targets.add(path.as_posix())
+            continue
+        if path.is_dir():
+            targets.update(p.as_posix() for p in path.rglob('*.md'))
+        if indexed is None:
+            indexed = indexed_files(collections)
+        prefix = path.as_posix().rstrip('/') + '/'
+        targets.update(f for f in indexed if f.startswith(prefix))
+    return sorted(targets)
+
+def poll_changes(root_folder, debounce_ms=WATCH_DEBOUNCE_MS, interval=WATCH_POLL_INTERVAL):
+    """
+    Alternativa por sondeo a inotify: compara (mtime, tamaño) de todo el árbol
+    cada 'interval' segundos y emite un lote cuando lleva 'debounce_ms' sin cambios.
+    """
+    def snapshot():
+        state = {}
+        for path in Path(root_folder).rglob('*'):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            state[str(path)] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    previous = snapshot()
+    pending = set()
+    last_change = 0.0
+    while True:
+        time.sleep(interval)
+        current = snapshot()
+        changed = {p for p in previous.keys() | current.keys() if previous.get(p) != current.get(p)}
+        previous = current
+        if changed:
+            pending |= changed
+            last_change = time.monotonic()
+        elif pending and (time.monotonic() - last_change) * 1000 >= debounce_ms:
+            yield pending
+            pending = set()
+
+def watch_changes(root_folder, debounce_ms=WATCH_DEBOUNCE_MS, force_polling=False):
+    """
+    Generador de lotes de rutas modificadas bajo root_folder.
+    Usa 'watchfiles' (inotify en Linux) si está instalado, que ya agrupa las
+    ráfagas de eventos en ventanas de 'debounce_ms'; si no, cae en poll_changes.
+    """
+    try:
+        from watchfiles import watch
+    except ImportError:
+        watch = None
+
+    if watch is None or force_polling:
+        print(f"👀 Vigilando '{root_folder}' por sondeo cada {WATCH_POLL_INTERVAL}s")
+        yield from poll_changes(root_folder, debounce_ms)
+        return
+
+    print(f"👀 Vigilando '{root_folder}' (inotify)")
+    for changes in watch(root_folder, debounce=debounce_ms):
+        yield {path for _, path in changes}
+
+def watch_directory(root_folder, collection, partitioned=False, force_polling=False, mmap_index=MMAP_INDEX,
+                    dedup=DEDUP_CHUNKS, qa_index=QA_INDEX, doc_index=DOC_INDEX):
+    """
+    Modo demonio: ingesta inicial con process_directory y después
+    reindexado incremental de los ficheros afectados por cada lote de eventos.
+    Tras cada lote con cambios publica una nueva versión del índice (con
+    qa_index=True, después de regenerar las preguntas de esos ficheros).
+    """
+    process_directory(root_folder, collection, partitioned=partitioned, mmap_index=mmap_index, dedup=dedup,
+                      qa_index=qa_index, doc_index=doc_index)
+
+    if partitioned:
+        # Precargar las particiones existentes para detectar borrados de carpetas completas
+        for folder in Path(root_folder).iterdir():
+            if folder.is_dir() and not folder.name.endswith("__exclude"):
+                get_partition_collection(folder.name)
+
+    generation = live_generation()
+    for paths in watch_changes(root_folder, force_polling=force_polling):
+        if live_generation() != generation:
+            # Otro proceso ha publicado una generación (--rebuild/--rollback): se
+            # sigue escribiendo en ella y se recuperan los cambios de mientras
+            generation = live_generation()
+            print(f"🔀 Generación {generation} publicada: se vuelve a sincronizar la carpeta")
+            _partition_cache.clear()
+            collection = get_chroma_collection()
+            paths = (set(paths) | read_indexed_files(partitioned)
+                     | {p.as_posix() for p in Path(root_folder).rglob('*.md')})
+        collections = list(_partition_cache.values()) if partitioned else [collection]
+        changed = 0
+        for str_path in expand_changed_paths(paths, collections):
+            try:
+                if sync_file(str_path, collection, partitioned=partitioned, dedup=dedup):
+                    changed += 1
+            except Exception as e:
+                print(f"   ❌ Error sincronizando {str_path}: {e}")
+        if changed:
+            if mmap_index:
+                build_mmap_index(partitioned)
+            if qa_index:
+                build_qa_index(partitioned)
+            if doc_index:
+                build_document_index(partitioned)
+            publish_index_version()
+
+def chunk_collections(client, generation, partitioned=None):
+    """
+    Colecciones de chunks (compartida o particiones) de una generación.
+    Con partitioned=True/False solo las de esa disposición (una BBDD puede
+    tener a la vez la colección compartida y las particiones).
+    """
+    return [client.get_collection(physical)
+            for name, physical in sorted(generation_collections(client, generation).items())
+            if is_chunk_collection(name)
+            and (partitioned is None or (name != COLLECTION_NAME) == partitioned)]
+
+def copy_qa_entries(client, source_generation, partitioned=False):
+    """
+    Copia a la generación en construcción las preguntas precalculadas de
+    'source_generation' cuyo fichero no ha cambiado (mismo content_hash),
+    con sus embeddings: la nueva generación conserva el índice QA sin volver
+    a generarlo. Devuelve el nº de preguntas copiadas.
+    """
+    source_name = versioned_collection_name(QA_COLLECTION_NAME, source_generation)
+    if source_name not in {c.name for c in client.list_collections()}:
+        return 0
+    hashes = {source_file: entry["hash"]
+              for source_file, entry in indexed_chunks_by_file(project_collections(client, partitioned)).items()}
+    existing = client.get_collection(source_name).get(include=['documents', 'metadatas', 'embeddings'])
+    valid = [i for i, metadata in enumerate(existing['metadatas'])
+             if hashes.get(metadata.get('source_file')) == metadata.get('content_hash')]
+    if not valid:
+        return 0
+    qa_collection = get_chroma_collection(QA_COLLECTION_NAME)
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        qa_collection.add(
+            ids=[existing['ids'][i] for i in batch],
+            documents=[existing['documents'][i] for i in batch],
+            metadatas=[existing['metadatas'][i] for i in batch],
+            embeddings=[existing['embeddings'][i] for i in batch]
+        )
+    print(f"📋 Copiadas {len(valid)} preguntas precalculadas de la generación {source_generation} "
+          f"({len(existing['ids']) - len(valid)} de ficheros modificados o eliminados)")
+    return len(valid)
+
+def self_recall(collections, sample_size=REBUILD_SAMPLE_SIZE, seed=0):
+    """
+    Consulta una muestra de chunks con su propio vector y cuenta cuántos
+    vuelven en el top-3 (un índice HNSW sano los devuelve todos).
+    Devuelve (aciertos, tamaño de la muestra).
+    """
+    population = [(collection, chunk_id) for collection in collections
+                  for chunk_id in collection.get(include=[])['ids']]
+    sample = random.Random(seed).sample(population, min(sample_size, len(population)))
+    by_collection = {}
+    for collection, chunk_id in sample:
+        by_collection.setdefault(collection.name, (collection, []))[1].append(chunk_id)
+
+    hits = 0
+    for collection, ids in by_collection.values():
+        stored = collection.get(ids=ids, include=['embeddings'])
+        results = collection.query(query_embeddings=stored['embeddings'], n_results=min(3, collection.count()),
+                                   include=[])
+        hits += sum(chunk_id in found for chunk_id, found in zip(stored['ids'], results['ids']))
+    return hits, len(sample)
+
+def gold_recall(collections, questions, embeddings, k=REBUILD_RECALL_K):
+    """
+    recall@k de preguntas con sus ficheros correctos (formato de
+    barrido_chunking.py): acierto si algún chunk de una fuente correcta está
+    entre los k más cercanos de todas las colecciones.
+    """
+    candidates = [[] for _ in questions]
+    for collection in collections:
+        n_results = min(k, collection.count())
+        if not n_results:
+            continue
+        results = collection.query(query_embeddings=embeddings, n_results=n_results,
+                                   include=['metadatas', 'distances'])
+        for merged, metadatas, distances in zip(candidates, results['metadatas'], results['distances']):
+            merged.extend(zip(distances, metadatas))
+
+    hits = 0
+    for question, merged in zip(questions, candidates):
+        top = sorted(merged, key=lambda candidate: candidate[0])[:k]
+        sources = {source[0] for _, metadata in top for source in chunk_sources(metadata)}
+        hits += any(source == expected or source.endswith('/' + expected)
+                    for source in sources for expected in question['fuentes'])
+    return hits / len(questions)
+
+def collection_dimensions(collections):
+    """Dimensiones de los vectores guardados (None si no hay ninguno)."""
+    for collection in collections:
+        stored = collection.get(limit=1, include=['embeddings'])['embeddings']
+        if len(stored):
+            return len(stored[0])
+    return None
+
+def validate_generation(client, generation, published, root_folder=INPUT_FOLDER, partitioned=False):
+    """
+    Comprueba una generación recién construida antes de publicarla:
+    - Recuento: tiene chunks y al menos REBUILD_MIN_CHUNK_RATIO de los publicados.
+    - Cobertura: están indexados todos los .md ingeribles y no vacíos de la carpeta.
+    - Autorecuperación: al menos REBUILD_MIN_SELF_RECALL de una muestra de
+      chunks vuelve en el top-3 al consultar con su propio vector.
+    - Recall: si existe REBUILD_QUESTIONS, el recall@k de esas preguntas no
+      cae más de REBUILD_RECALL_TOLERANCE respecto a la generación publicada
+      (solo se compara si ambas usan vectores de las mismas dimensiones).
+    La referencia son las colecciones publicadas de la misma disposición
+    (compartida o particiones); si no las hay, las de la otra.
+    Devuelve (ok, {comprobación: detalle}).
+    """
+    new_collections = chunk_collections(client, generation, partitioned)
+    published_collections = (chunk_collections(client, published, partitioned)
+                             or chunk_collections(client, published, not partitioned))
+    new_count = sum(c.count() for c in new_collections)
+    published_count = sum(c.count() for c in published_collections)
+    checks = [("Chunks", f"{new_count} (publicada: {published_count})",
+               new_count > 0 and new_count >= REBUILD_MIN_CHUNK_RATIO * published_count)]
+
+    expected = {p.as_posix() for p in Path(root_folder).rglob('*.md')
+                if is_ingestible(p) and p.read_text(encoding='utf-8').strip()}
+    missing = sorted(expected - indexed_files(new_collections))
+    checks.append(("Ficheros", f"{len(expected) - len(missing)}/{len(expected)}"
+                   + (f", faltan: {', '.join(Path(m).name for m in missing[:5])}" if missing else ""), not missing))
+
+    if new_count:
+        hits, total = self_recall(new_collections, seed=generation)
+        checks.append(("Autorecuperación", f"{hits}/{total} ({hits / total:.1%})",
+                       hits >= REBUILD_MIN_SELF_RECALL * total))
+
+    if new_count and os.path.exists(REBUILD_QUESTIONS):
+        with open(REBUILD_QUESTIONS, 'r', encoding='utf-8') as f:
+            questions = [json.loads(line) for line in f if line.strip()]
+        embeddings = crear_funcion_embeddings(MODEL_NAME)([q['pregunta'] for q in questions])
+        new_recall = gold_recall(new_collections, questions, embeddings)
+        published_recall = None
+        if published_count and collection_dimensions(published_collections) == len(embeddings[0]):
+            published_recall = gold_recall(published_collections, questions, embeddings)
+        checks.append((f"Recall@{REBUILD_RECALL_K} ({len(questions)} preguntas)",
+                       f"{new_recall:.1%}" + (f" (publicada: {published_recall:.1%})" if published_recall is not None else ""),
+                       published_recall is None or new_recall >= published_recall - REBUILD_RECALL_TOLERANCE))
+
+    print(f"\n🔎 Validación de la generación {generation}:")
+    for label, detail, passed in checks:
+        print(f"   {'✅' if passed else '❌'} {label}: {detail}")
+    return all(passed for _, _, passed in checks), {label: detail for label, detail, _ in checks}
+
+def rebuild_generation(root_folder, partitioned=False, mmap_index=MMAP_INDEX, dedup=DEDUP_CHUNKS,
+                       qa_index=QA_INDEX, doc_index=DOC_INDEX, keep=KEEP_GENERATIONS):
+    """
+    Reconstrucción blue/green sin cortar el servicio: vectoriza toda la
+    carpeta en una generación nueva de colecciones mientras main.py sigue
+    sirviendo la publicada, copia las preguntas precalculadas aún válidas
+    (con qa_index=True genera además las que falten), genera el índice de
+    documentos si se pide o si la generación publicada lo tiene, valida la generación
+    (validate_generation) y, si pasa, la publica en INDEX_VERSION_FILE.
+    Después elimina las generaciones que exceden 'keep' (gc_generations).
+    Devuelve la generación publicada o None si la validación falla (sus
+    colecciones se conservan para revisarlas hasta el siguiente --gc).
+    """
+    global _build_generation
+
+    client = chromadb.PersistentClient(path=DB_PATH)
+    state = read_index_state()
+    published = state.get("generation", 0)
+    known = ([split_generation(c.name)[1] for c in client.list_collections()
+              if is_project_collection(split_generation(c.name)[0])]
+             + [published] + [entry["generation"] for entry in state.get("history", [])])
+    generation = max(known) + 1
+    print(f"🏗️  Construyendo la generación {generation} (publicada: {published})\n")
+
+    _build_generation = generation
+    _partition_cache.clear()
+    try:
+        collection = None if partitioned else get_chroma_collection()
+        process_directory(root_folder, collection, partitioned=partitioned, dedup=dedup, publish=False)
+        copy_qa_entries(client, published, partitioned)
+        if qa_index:
+            build_qa_index(partitioned)
+        if doc_index or DOC_COLLECTION_NAME in generation_collections(client, published):
+            build_document_index(partitioned)
+        ok, _ = validate_generation(client, generation, published, root_folder, partitioned=partitioned)
+        if not ok:
+            print(f"❌ La generación {generation} no se publica; sigue publicada la {published}. "
+                  f"Sus colecciones se conservan para revisarlas (las elimina --gc).")
+            return None
+        if mmap_index:
+            build_mmap_index(partitioned)
+    finally:
+        _build_generation = None
+        _partition_cache.clear()
+
+    publish_index_version(generation)
+    gc_generations(keep)
+    return generation
+
+def rollback_generation():
+    """
+    Vuelve a publicar la generación anterior más reciente que siga existiendo
+    (--rollback). La generación retirada deja de estar en el historial y la
+    elimina el siguiente --gc. Devuelve la generación publicada o None.
+    """
+    state = read_index_state()
+    history = state.get("history", [])
+    client = chromadb.PersistentClient(path=DB_PATH)
+    for i, entry in enumerate(history):
+        if chunk_collections(client, entry["generation"]):
+            publish_index_version(entry["generation"], history=history[i + 1:])
+            print(f"⏪ Generación {entry['generation']} publicada de nuevo "
+                  f"(retirada la {state.get('generation', 0)})")
+            return entry["generation"]
+        print(f"⚠️ La generación {entry['generation']} ya no existe; se omite")
+    print("⚠️ No hay ninguna generación anterior a la que volver")
+    return None
+
+def gc_generations(keep=KEEP_GENERATIONS):
+    """
+    Elimina las colecciones de las generaciones que no son la publicada ni
+    una de las keep-1 anteriores del historial (las de reconstrucciones
+    fallidas o retiradas incluidas). No debe ejecutarse mientras otro
+    proceso está en medio de un --rebuild.
+    Devuelve los nombres de las colecciones eliminadas.
+    """
+    state = read_index_state()
+    history = state.get("history", [])[:max(keep - 1, 0)]
+    kept = {state.get("generation", 0)} | {entry["generation"] for entry in history}
+    if _build_generation is not None:
+        kept.add(_build_generation)
+    if state and history != state.get("history", []):
+        state["history"] = history
+        write_index_state(state)
+
+    client = chromadb.PersistentClient(path=DB_PATH)
+    removed = []
+    for collection in client.list_collections():
+        name, generation = split_generation(collection.name)
+        if is_project_collection(name) and generation not in kept:
+            client.delete_collection(collection.name)
+            removed.append(collection.name)
+    if removed:
+        print(f"🧹 Eliminadas {len(removed)} colecciones de generaciones antiguas: {', '.join(sorted(removed))}")
+    return removed
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingesta de documentación markdown en ChromaDB")
+    parser.add_argument("--partitioned", action="store_true", default=PARTITION_BY_CATEGORY,
+                        help="Guardar una colección por categoría (RAG_PARTITION_BY_CATEGORY=1)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Quedarse vigilando la carpeta y reindexar los cambios de forma incremental")
+    parser.add_argument("--poll", action="store_true",
+                        help="Con --watch, usar sondeo en lugar de inotify")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Mostrar ficheros, chunks, tokens, coste y duración estimados sin ingerir nada")
+    parser.add_argument("--mmap", action="store_true", default=MMAP_INDEX,
+                        help="Regenerar el índice mmap de solo lectura tras cada cambio (RAG_MMAP_INDEX=1)")
+    parser.add_argument("--build-mmap", action="store_true",
+                        help="Solo generar el índice mmap a partir de la BBDD actual y salir")
+    parser.add_argument("--dedup", action="store_true", default=DEDUP_CHUNKS,
+                        help="Guardar una sola vez los chunks casi idénticos (RAG_DEDUP_CHUNKS=1); con "
+                             "--partitioned solo dentro de cada categoría")
+    parser.add_argument("--qa", action="store_true", default=QA_INDEX,
+                        help="Tras la ingesta, generar las preguntas precalculadas que falten (RAG_QA_INDEX=1)")
+    parser.add_argument("--build-qa", action="store_true",
+                        help="Solo generar (o reanudar) el índice de preguntas precalculadas y salir")
+    parser.add_argument("--doc-index", action="store_true", default=DOC_INDEX,
+                        help="Actualizar el índice de documentos de la recuperación jerárquica (RAG_DOC_INDEX=1)")
+    parser.add_argument("--build-docs", action="store_true",
+                        help="Solo generar el índice de documentos a partir de la BBDD actual y salir")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Reconstruir todo en una generación nueva, validarla y publicarla sin cortar el servicio")
+    parser.add_argument("--rollback", action="store_true",
+                        help="Volver a publicar la generación anterior y salir")
+    parser.add_argument("--gc", action="store_true",
+                        help="Eliminar las colecciones de generaciones antiguas o sin publicar y salir")
+    parser.add_argument("--keep", type=int, default=KEEP_GENERATIONS,
+                        help="Generaciones que se conservan, contando la publicada (RAG_KEEP_GENERATIONS)")
+    parser.add_argument("--profile", action="store_true", default=PERFILAR,
+                        help="Perfilar la ingesta y guardar el perfil en RAG_PROFILE_DIR (RAG_PROFILE=1)")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        process_directory(INPUT_FOLDER, None, partitioned=args.partitioned, dry_run=True, dedup=args.dedup)
+        raise SystemExit(0)
+
+    if args.build_mmap:
+        if build_mmap_index(args.partitioned):
+            publish_index_version()
+        raise SystemExit(0)
+
+    if args.rollback:
+        rollback_generation()
+        raise SystemExit(0)
+
+    if args.gc:
+        gc_generations(args.keep)
+        raise SystemExit(0)
+
+    check_api_key()
+    if args.build_docs:
+        if build_document_index(args.partitioned):
+            publish_index_version()
+        raise SystemExit(0)
+
+    if args.rebuild:
+        with perfilar(args.profile, "ingest"):
+            generation = rebuild_generation(INPUT_FOLDER, partitioned=args.partitioned, mmap_index=args.mmap,
+                                            dedup=args.dedup, qa_index=args.qa, doc_index=args.doc_index,
+                                            keep=args.keep)
+        raise SystemExit(0 if generation is not None else 1)
+
+    if args.build_qa:
+        with perfilar(args.profile, "ingest"):
+            if build_qa_index(args.partitioned):
+                publish_index_version()
+        raise SystemExit(0)
+
     collection = get_chroma_collection()
-    process_directory(INPUT_FOLDER, collection)
\ No newline at end of file
+    if args.watch:
+        try:
+            watch_directory(INPUT_FOLDER, collection, partitioned=args.partitioned,
+                            force_polling=args.poll, mmap_index=args.mmap, dedup=args.dedup, qa_index=args.qa,
+                            doc_index=args.doc_index)
+        except KeyboardInterrupt:
+            print("\n👋 Vigilancia detenida.")
+    else:
+        with perfilar(args.profile, "ingest"):
+            process_directory(INPUT_FOLDER, collection, partitioned=args.partitioned, mmap_index=args.mmap,
+                              dedup=args.dedup, qa_index=args.qa, doc_index=args.doc_index)
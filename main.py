@@ -18,21 +18,32 @@ Versión: 2.0
 Fecha: Diciembre 2025
 """
 
+import time
+_INICIO_IMPORT = time.perf_counter()
+
 import os
 import re
 import glob
-import gradio as gr
+import json
+import queue
+import threading
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from dotenv import load_dotenv
-import chromadb
-from chromadb.utils import embedding_functions
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from transporte import crear_chat_openai, crear_funcion_embeddings, get_api_key, get_openai_client
+from perfilado import PERFILAR, perfilar
+from circuito import Circuito, ServicioNoDisponibleError, llamar_con_plazo
+
+# Las dependencias pesadas (gradio, chromadb, langchain, numpy) se importan
+# dentro de las funciones que las usan para que importar main.py sea inmediato.
 
 # Cargar variables de entorno
 load_dotenv()
 
-# Verificar API KEY
-API_KEY = os.getenv("OPENAI_API_KEY")
+# Verificar API KEY (en reproducción de casete no hace falta)
+API_KEY = get_api_key()
 if not API_KEY:
     raise ValueError("❌ No se encontró la variable OPENAI_API_KEY. Configura tu archivo .env")
 
@@ -41,48 +52,463 @@ DB_PATH = './bbdd'
 COLLECTION_NAME = "documentacion_openai"
 MODEL_NAME = "text-embedding-3-small"
 
+# Particionado por categoría (debe coincidir con el modo usado en ingest.py)
+PARTICIONADO_POR_CATEGORIA = os.getenv("RAG_PARTITION_BY_CATEGORY", "0").lower() in ("1", "true", "yes", "si")
+SEPARADOR_PARTICION = "__"
+CATEGORIAS = ("FUNCIONAL", "TECNICA", "GESTION")
+
+# Carpeta raíz de la documentación (una subcarpeta por categoría) para la búsqueda léxica
+CARPETA_DOCS = './doc/doc_scangestor'
+
+# Versión del índice publicada por ingest.py (modo --watch o tras cada ingesta)
+# y generación de colecciones en uso ('<nombre>.v<N>', ver ingest.py --rebuild)
+INDEX_VERSION_FILE = os.path.join(DB_PATH, 'index_version.json')
+SEPARADOR_GENERACION = ".v"
+INTERVALO_COMPROBACION_INDICE = float(os.getenv("RAG_INDEX_CHECK_INTERVAL", "5"))
+# Backend de consulta: 'chroma' (PersistentClient) o 'mmap' (índice de solo
+# lectura generado por ingest.py --mmap, compartido entre procesos vía page cache)
+BACKEND_VECTORIAL = os.getenv("RAG_VECTOR_BACKEND", "chroma").lower()
+CARPETA_INDICE_MMAP = os.path.join(DB_PATH, 'indice_mmap')
+MMAP_SONDEOS = int(os.getenv("RAG_MMAP_NPROBE", "8"))
+
+# Diversificación MMR de los chunks recuperados
+USAR_MMR = os.getenv("RAG_MMR", "0").lower() in ("1", "true", "yes", "si")
+MMR_CANDIDATOS = int(os.getenv("RAG_MMR_CANDIDATES", "12"))
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+MMR_MAX_POR_ARCHIVO = int(os.getenv("RAG_MMR_MAX_PER_FILE", "2"))
+MMR_UMBRAL_DUPLICADO = float(os.getenv("RAG_MMR_DUPLICATE_THRESHOLD", "0.95"))
+
+# Recuperación jerárquica: primero los documentos más cercanos en el índice de
+# documentos (un vector por fichero, ingest.py --doc-index) y después los
+# chunks solo de esos documentos. Sin el índice se hace la consulta plana
+RECUPERACION_JERARQUICA = os.getenv("RAG_HIERARCHICAL", "0").lower() in ("1", "true", "yes", "si")
+COLECCION_DOCUMENTOS = f"{COLLECTION_NAME}_docs"
+JERARQUICA_DOCUMENTOS = int(os.getenv("RAG_HIERARCHICAL_DOCS", "3"))
+
+# Recuperación especulativa en paralelo con la clasificación
+RECUPERACION_ESPECULATIVA = os.getenv("RAG_SPECULATIVE_RETRIEVAL", "1").lower() in ("1", "true", "yes", "si")
+ESPECULATIVO_K = int(os.getenv("RAG_SPECULATIVE_K", "12"))
+
+# Límites de concurrencia y control de admisión (ver sección "Capa de servicio")
+LLM_MAX_CONCURRENCIA = int(os.getenv("RAG_LLM_CONCURRENCY", "8"))
+EMBEDDING_MAX_CONCURRENCIA = int(os.getenv("RAG_EMBEDDING_CONCURRENCY", "8"))
+MAX_PETICIONES_EN_CURSO = int(os.getenv("RAG_MAX_IN_FLIGHT", "32"))
+ESPERA_ADMISION = float(os.getenv("RAG_ADMISSION_TIMEOUT", "2"))
+ESPERA_RECURSO = float(os.getenv("RAG_RESOURCE_TIMEOUT", "30"))
+GRADIO_CONCURRENCIA = int(os.getenv("RAG_GRADIO_CONCURRENCY", "16"))
+GRADIO_MAX_COLA = int(os.getenv("RAG_GRADIO_MAX_QUEUE", "64"))
+
+# Arranque: precalentar índice y conexiones HTTP antes de aceptar peticiones
+PRECALENTAR = os.getenv("RAG_WARMUP", "1").lower() in ("1", "true", "yes", "si")
+ESPERA_PRECALENTAMIENTO = float(os.getenv("RAG_WARMUP_TIMEOUT", "60"))
+
+HILOS_ESPECULATIVOS = int(os.getenv("RAG_SPECULATIVE_WORKERS", str(2 * MAX_PETICIONES_EN_CURSO)))
+
+# Micro-lotes de embeddings: las preguntas que llegan dentro de la misma
+# ventana se embeben en una sola llamada a la API
+LOTES_EMBEDDING = os.getenv("RAG_EMBEDDING_BATCH", "1").lower() in ("1", "true", "yes", "si")
+VENTANA_LOTE_MS = float(os.getenv("RAG_EMBEDDING_BATCH_WINDOW_MS", "5"))
+MAX_LOTE_EMBEDDING = int(os.getenv("RAG_EMBEDDING_BATCH_MAX", "64"))
+
+# Umbral de relevancia: si ningún chunk recuperado queda por debajo de la
+# distancia calibrada para su categoría (ver calibrar_umbrales.py) no se llama
+# al LLM y se responde al momento o con una búsqueda léxica de respaldo
+FICHERO_UMBRALES = os.getenv("RAG_RELEVANCE_THRESHOLDS", "./umbrales_relevancia.json")
+UMBRAL_RELEVANCIA_GLOBAL = os.getenv("RAG_RELEVANCE_MAX_DISTANCE")  # Sin fichero: umbral único (vacío = sin filtro)
+RESPALDO_SIN_RELEVANCIA = os.getenv("RAG_RELEVANCE_FALLBACK", "lexica").lower()  # lexica | ninguno
+
+# Búsquedas léxicas: fusión determinista de coincidencias; el sintetizador LLM
+# solo se usa si se pide respuesta redactada y hay resultados en varias categorías
+REDACTAR_LEXICA = os.getenv("RAG_LEXICAL_PROSE", "0").lower() in ("1", "true", "yes", "si")
+MAX_COINCIDENCIAS_POR_ARCHIVO = 3
+
+# Respuestas precalculadas (ingest.py --qa): una pregunta casi igual a una de
+# las generadas offline se responde desde ese índice, sin clasificar ni generar
+RESPUESTAS_PRECALCULADAS = os.getenv("RAG_QA_ANSWERS", "1").lower() in ("1", "true", "yes", "si")
+COLECCION_PREGUNTAS = f"{COLLECTION_NAME}_qa"
+UMBRAL_PRECALCULADA = float(os.getenv("RAG_QA_MAX_DISTANCE", "0.12"))  # Distancia coseno máxima
+
+# Plazos por etapa (segundos) para las llamadas a OpenAI y modo degradado:
+# con el circuito abierto (ver circuito.py) se responde sin LLM con una
+# clasificación local y los fragmentos recuperados o las coincidencias literales
+PLAZO_CLASIFICACION = float(os.getenv("RAG_DEADLINE_CLASSIFY", "8"))
+PLAZO_AGENTE = float(os.getenv("RAG_DEADLINE_AGENT", "30"))
+PLAZO_SINTESIS = float(os.getenv("RAG_DEADLINE_SYNTHESIS", "30"))
+PLAZO_EMBEDDING = float(os.getenv("RAG_DEADLINE_EMBEDDING", "5"))
+MAX_CARACTERES_FRAGMENTO_DEGRADADO = 700
+AVISO_DEGRADADO = "⚠️ **Modo degradado:** los servicios de IA no están disponibles en este momento"
+
+MENSAJE_SATURADO = "⏳ El sistema está atendiendo muchas preguntas en este momento. Inténtalo de nuevo en unos segundos."
+
 # Regex compilados para extraer información de clasificación
 CATEGORIA_PATTERN = re.compile(r'Categoría:\s*(FUNCIONAL|TECNICA|GESTION)', re.IGNORECASE)
 TIPO_BUSQUEDA_PATTERN = re.compile(r'Tipo de búsqueda:\s*(SEMANTICA|LEXICA)', re.IGNORECASE)
 
-# Cliente LangChain global (reutilizable)
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.3,
-    api_key=API_KEY
+# Clasificación local (modo degradado): palabras clave sin tildes por
+# categoría y señales de búsqueda literal (comillas, identificadores, "¿dónde aparece...?")
+PALABRAS_CATEGORIA = {
+    "FUNCIONAL": ("pantalla", "usuario", "boton", "flujo", "caso de uso", "formulario", "funcionalidad",
+                  "como puedo", "como se", "registrar", "escanear", "menu", "notificacion", "filtro"),
+    "TECNICA": ("api", "endpoint", "base de datos", "sql", "tabla", "backend", "frontend", "flutter",
+                "python", "arquitectura", "servidor", "codigo", "libreria", "tecnologia", "despliegue",
+                "implementa", "modelo de datos", "servicio"),
+    "GESTION": ("coste", "presupuesto", "horas", "equipo", "planificacion", "cronograma", "reunion",
+                "riesgo", "hito", "sprint", "responsable", "perfiles", "fase", "plazo", "entrega",
+                "estimacion", "metodologia", "desarrollado"),
+}
+PESO_PALABRA_CLAVE = 2.0
+VOTOS_CHUNKS_CERCANOS = 5
+PREGUNTA_LEXICA_PATTERN = re.compile(
+    r'["“”«»`]|\b\w+_\w+\b|\bd[oó]nde (aparece|se (usa|menciona|define))|'
+    r'\ben qu[eé] (archivo|fichero|documento)|\bbusca\b|\b(campo|variable|string)\b',
+    re.IGNORECASE
 )
 
-# Cache de la colección ChromaDB
-_collection_cache = None
+# Cliente LangChain global (reutilizable), creado en el primer uso (ver get_llm)
+_llm = None
+
+# Métricas de arranque en segundos desde el inicio de la importación
+METRICAS_ARRANQUE = {"import_s": None, "ready_s": None, "first_query_s": None}
+_listo = threading.Event()
+
+# Cache de colecciones ChromaDB (nombre -> colección) y recursos compartidos
+_collection_cache = {}
+_chroma_client = None
+_indice_mmap = None
+_embedding_function = None
+_version_indice = None
+_generacion_indice = 0
+_ultima_comprobacion_indice = 0.0
+_umbrales = {"mtime": None, "valores": {}}
+
+# --- Capa de servicio ---
+# Gradio atiende cada petición en un hilo distinto: la inicialización perezosa
+# se protege con un lock y las llamadas a OpenAI se limitan con semáforos
+# independientes para el LLM y para los embeddings.
+_init_lock = threading.Lock()
+_llm_semaforo = threading.BoundedSemaphore(LLM_MAX_CONCURRENCIA)
+_embedding_semaforo = threading.BoundedSemaphore(EMBEDDING_MAX_CONCURRENCIA)
+_admision_semaforo = threading.BoundedSemaphore(MAX_PETICIONES_EN_CURSO)
+_executor = None
+_loteador_embeddings = None
+
+# Circuitos de las llamadas a OpenAI y contadores del modo degradado
+_circuito_llm = Circuito("LLM")
+_circuito_embeddings = Circuito("embeddings")
+_metricas_degradado = {"clasificaciones_locales": 0, "respuestas_degradadas": 0}
+_metricas_lock = threading.Lock()
+# Tiempos acumulados de las dos etapas de la recuperación jerárquica
+_metricas_jerarquica = {"consultas": 0, "sin_indice": 0, "documentos_s": 0.0, "chunks_s": 0.0, "chunks_candidatos": 0}
+
+class SistemaSaturadoError(Exception):
+    """No se ha obtenido capacidad (admisión, LLM o embeddings) a tiempo."""
+
+@contextmanager
+def limite_concurrencia(semaforo, recurso, timeout=ESPERA_RECURSO):
+    """Ocupa un hueco del semáforo o lanza SistemaSaturadoError tras 'timeout' segundos."""
+    if not semaforo.acquire(timeout=timeout):
+        raise SistemaSaturadoError(f"Sin capacidad disponible para {recurso}")
+    try:
+        yield
+    finally:
+        semaforo.release()
+
+def get_llm():
+    """Devuelve el cliente ChatOpenAI global, creándolo en el primer uso."""
+    global _llm
+    
+    if _llm is None:
+        with _init_lock:
+            if _llm is None:
+                _llm = crear_chat_openai(
+                    model="gpt-4o-mini",
+                    temperature=0.3
+                )
+    return _llm
+
+@lru_cache(maxsize=None)
+def get_prompt(template):
+    """Compila (una sola vez por plantilla) el ChatPromptTemplate de un agente."""
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_template(template)
+
+def get_executor():
+    """Pool de hilos compartido para las tareas lanzadas en paralelo dentro de una petición."""
+    global _executor
+    
+    if _executor is None:
+        with _init_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HILOS_ESPECULATIVOS, thread_name_prefix="rag")
+    return _executor
+
+def registrar_degradado(contador):
+    """Suma uno a un contador del modo degradado (ver metricas_circuitos)."""
+    with _metricas_lock:
+        _metricas_degradado[contador] += 1
+
+def invocar_llm(template, variables, plazo=PLAZO_AGENTE):
+    """Ejecuta el prompt contra el LLM global respetando el límite de concurrencia.
+    
+    La llamada se espera como mucho 'plazo' segundos y pasa por el circuito
+    del LLM (ver circuito.py). Si se agota el plazo el hueco del semáforo se
+    libera aunque la llamada siga en vuelo; el circuito se abre enseguida y
+    deja de enviar más.
+    
+    Raises:
+        ServicioNoDisponibleError: Plazo agotado, error del proveedor o circuito abierto
+        SistemaSaturadoError: Sin hueco de LLM en ESPERA_RECURSO segundos
+    """
+    chain = get_prompt(template) | get_llm()
+    with limite_concurrencia(_llm_semaforo, "el LLM"):
+        return llamar_con_plazo(_circuito_llm, plazo, chain.invoke, variables)
+
+def nombre_coleccion_categoria(categoria):
+    """Nombre de la colección particionada de una categoría (igual que en ingest.py)."""
+    sufijo = re.sub(r'[^a-z0-9]+', '_', categoria.lower()).strip('_')
+    return f"{COLLECTION_NAME}{SEPARADOR_PARTICION}{sufijo}"
 
-def get_chroma_collection():
+def get_embedding_function():
+    """Devuelve la función de embeddings de OpenAI compartida por todas las colecciones."""
+    global _embedding_function
+    
+    if _embedding_function is None:
+        with _init_lock:
+            if _embedding_function is None:
+                _embedding_function = crear_funcion_embeddings(MODEL_NAME)
+    return _embedding_function
+
+class LoteadorEmbeddings:
+    """Agrupa en una sola llamada los embeddings pedidos por peticiones concurrentes.
+    
+    Un hilo despachador recoge las peticiones que llegan en una ventana de
+    ventana_ms (o hasta max_lote textos), las embebe con una única llamada
+    (textos repetidos solo una vez) y entrega a cada petición su vector. Los
+    lotes se ejecutan en un pool propio, así que puede haber varios en vuelo,
+    acotados por el semáforo de embeddings.
+    """
+    
+    def __init__(self, funcion, ventana_ms=VENTANA_LOTE_MS, max_lote=MAX_LOTE_EMBEDDING):
+        self._funcion = funcion
+        self._ventana = ventana_ms / 1000
+        self._max_lote = max_lote
+        self._cola = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=EMBEDDING_MAX_CONCURRENCIA, thread_name_prefix="embeddings")
+        threading.Thread(target=self._despachar, name="loteador-embeddings", daemon=True).start()
+    
+    def embeber(self, texto):
+        """Devuelve el embedding de 'texto' (bloquea hasta que se procese su lote)."""
+        futuro = Future()
+        self._cola.put((texto, futuro))
+        return futuro.result()
+    
+    def _despachar(self):
+        while True:
+            lote = [self._cola.get()]
+            limite = time.monotonic() + self._ventana
+            while len(lote) < self._max_lote:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self._cola.get(timeout=restante))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._procesar, lote)
+    
+    def _procesar(self, lote):
+        textos = list(dict.fromkeys(texto for texto, _ in lote))
+        try:
+            with limite_concurrencia(_embedding_semaforo, "los embeddings"):
+                vectores = dict(zip(textos, self._funcion(textos)))
+        except Exception as e:
+            for _, futuro in lote:
+                futuro.set_exception(e)
+            return
+        for texto, futuro in lote:
+            futuro.set_result(vectores[texto])
+
+def get_loteador_embeddings():
+    """Devuelve el loteador de embeddings compartido, creándolo en el primer uso."""
+    global _loteador_embeddings
+    
+    if _loteador_embeddings is None:
+        funcion = get_embedding_function()
+        with _init_lock:
+            if _loteador_embeddings is None:
+                _loteador_embeddings = LoteadorEmbeddings(funcion)
+    return _loteador_embeddings
+
+def calcular_embedding(pregunta):
+    """Calcula el embedding de la pregunta respetando el límite de concurrencia.
+    
+    Con RAG_EMBEDDING_BATCH=1 (por defecto) la petición se agrupa con las de
+    otros usuarios que lleguen en la misma ventana (ver LoteadorEmbeddings).
+    
+    Returns:
+        list: Lista con un único vector, lista para usar como query_embeddings
+    
+    Raises:
+        ServicioNoDisponibleError: Sin respuesta en PLAZO_EMBEDDING segundos o circuito abierto
+    """
+    if LOTES_EMBEDDING:
+        return [llamar_con_plazo(_circuito_embeddings, PLAZO_EMBEDDING, get_loteador_embeddings().embeber,
+                                 pregunta, ignorar=SistemaSaturadoError)]
+    with limite_concurrencia(_embedding_semaforo, "los embeddings"):
+        return llamar_con_plazo(_circuito_embeddings, PLAZO_EMBEDDING, get_embedding_function(), [pregunta])
+
+def get_chroma_collection(nombre=COLLECTION_NAME):
     """Obtiene la colección de ChromaDB con patrón Singleton.
     
     Implementa un patrón de caché para evitar reconexiones innecesarias
-    a la base de datos vectorial ChromaDB. La colección se inicializa
-    una sola vez y se reutiliza en llamadas posteriores.
+    a la base de datos vectorial ChromaDB. El cliente y cada colección
+    se inicializan una sola vez y se reutilizan en llamadas posteriores.
+    
+    Args:
+        nombre (str): Nombre de la colección. Por defecto la colección
+            compartida; en modo particionado, la de una categoría
     
     Returns:
         chromadb.Collection: Colección de ChromaDB configurada con
             función de embeddings de OpenAI (text-embedding-3-small)
     
     Note:
-        Utiliza la variable global _collection_cache para persistencia
+        Utiliza las variables globales _chroma_client y _collection_cache,
+        inicializadas bajo _init_lock (doble comprobación) porque Gradio
+        invoca chat_response desde varios hilos a la vez
     """
-    global _collection_cache
+    global _chroma_client
     
-    if _collection_cache is None:
-        chroma_client = chromadb.PersistentClient(path=DB_PATH)
-        openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-            api_key=API_KEY,
-            model_name=MODEL_NAME
-        )
-        _collection_cache = chroma_client.get_or_create_collection(
-            name=COLLECTION_NAME,
-            embedding_function=openai_ef
-        )
+    coleccion = _collection_cache.get(nombre)
+    if coleccion is None:
+        embedding_function = get_embedding_function()
+        with _init_lock:
+            coleccion = _collection_cache.get(nombre)
+            if coleccion is None:
+                if _chroma_client is None:
+                    import chromadb
+                    _chroma_client = chromadb.PersistentClient(path=DB_PATH)
+                    cargar_indice_publicado()
+                coleccion = _chroma_client.get_or_create_collection(
+                    name=nombre_fisico(nombre),
+                    embedding_function=embedding_function
+                )
+                _collection_cache[nombre] = coleccion
+    
+    return coleccion
+
+def get_coleccion_opcional(nombre):
+    """Colección auxiliar generada por ingest.py o None si no existe.
+    
+    A diferencia de get_chroma_collection no la crea; que no exista también
+    se recuerda hasta la siguiente versión del índice.
+    """
+    global _chroma_client
+    
+    if nombre not in _collection_cache:
+        embedding_function = get_embedding_function()
+        with _init_lock:
+            if nombre not in _collection_cache:
+                if _chroma_client is None:
+                    import chromadb
+                    _chroma_client = chromadb.PersistentClient(path=DB_PATH)
+                    cargar_indice_publicado()
+                fisico = nombre_fisico(nombre)
+                existe = fisico in {c.name for c in _chroma_client.list_collections()}
+                _collection_cache[nombre] = (
+                    _chroma_client.get_collection(fisico, embedding_function=embedding_function)
+                    if existe else None
+                )
+    return _collection_cache.get(nombre)
+
+def get_coleccion_preguntas():
+    """Colección de preguntas precalculadas (ingest.py --qa) o None si no se ha generado."""
+    return get_coleccion_opcional(COLECCION_PREGUNTAS)
+
+def get_coleccion_documentos():
+    """Índice de documentos de la recuperación jerárquica (ingest.py --doc-index) o None."""
+    return get_coleccion_opcional(COLECCION_DOCUMENTOS)
+
+def get_indice_mmap():
+    """Obtiene el índice vectorial mmap de solo lectura (RAG_VECTOR_BACKEND=mmap).
+    
+    Se abre una sola vez por proceso (doble comprobación con _init_lock) y se
+    descarta, como las colecciones de Chroma, cuando cambia la versión del índice.
+    """
+    global _indice_mmap
+    
+    indice = _indice_mmap
+    if indice is None:
+        with _init_lock:
+            if _indice_mmap is None:
+                from indice_vectorial import IndiceMmap
+                cargar_indice_publicado()
+                _indice_mmap = IndiceMmap(CARPETA_INDICE_MMAP, n_sondeos=MMAP_SONDEOS)
+            indice = _indice_mmap
+    return indice
+
+def leer_indice_publicado():
+    """Contenido de INDEX_VERSION_FILE ({} si no existe)."""
+    try:
+        with open(INDEX_VERSION_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def leer_version_indice():
+    """Lee la versión publicada en INDEX_VERSION_FILE (0 si no existe)."""
+    return leer_indice_publicado().get('version', 0)
+
+def cargar_indice_publicado():
+    """Fija la versión y la generación con las que se abren el cliente y las colecciones.
+    
+    Se leen juntas del mismo fichero para que las colecciones abiertas
+    correspondan siempre a la versión que después se compara.
+    """
+    global _version_indice, _generacion_indice
+    
+    datos = leer_indice_publicado()
+    _version_indice = datos.get('version', 0)
+    _generacion_indice = datos.get('generation', 0)
+
+def nombre_fisico(nombre):
+    """Colección de la generación publicada para un nombre lógico (la 0 no lleva sufijo)."""
+    return f"{nombre}{SEPARADOR_GENERACION}{_generacion_indice}" if _generacion_indice else nombre
+
+def estado_indice():
+    """Versión y generación del índice que está sirviendo este proceso (para /metrics)."""
+    return {"version": _version_indice, "generacion": _generacion_indice}
+
+def comprobar_version_indice():
+    """Invalida las colecciones cacheadas si ingest.py ha publicado una nueva versión.
     
-    return _collection_cache
+    Se comprueba como mucho una vez cada INTERVALO_COMPROBACION_INDICE segundos.
+    Al cambiar la versión se descartan el cliente y las colecciones (también la
+    caché de sistemas de Chroma) para que la siguiente consulta abra el índice
+    actualizado; si ingest.py --rebuild ha publicado otra generación, la
+    siguiente consulta ya abre sus colecciones (cambio sin reiniciar).
+    """
+    global _chroma_client, _indice_mmap, _ultima_comprobacion_indice
+    
+    ahora = time.monotonic()
+    if _chroma_client is None and _indice_mmap is None:
+        return
+    if ahora - _ultima_comprobacion_indice < INTERVALO_COMPROBACION_INDICE:
+        return
+    _ultima_comprobacion_indice = ahora
+    
+    version = leer_version_indice()
+    if version == _version_indice:
+        return
+    
+    with _init_lock:
+        if version == _version_indice:
+            return
+        _indice_mmap = None
+        if _chroma_client is not None:
+            _collection_cache.clear()
+            _chroma_client.clear_system_cache()
+            _chroma_client = None
 
 def agente_orquestador(pregunta):
     """Agente Orquestador: Clasifica preguntas en dos dimensiones.
@@ -107,6 +533,10 @@ def agente_orquestador(pregunta):
              "Categoría: [CATEGORIA]\nTipo de búsqueda: [TIPO]\nJustificación: [TEXTO]"
              En caso de error, retorna mensaje de error con el detalle
     
+    Raises:
+        ServicioNoDisponibleError: Si el LLM no responde en PLAZO_CLASIFICACION
+            segundos o su circuito está abierto (ver clasificar_localmente)
+    
     Example:
         >>> agente_orquestador("¿Cómo funciona el sistema de QR?")
         "Categoría: FUNCIONAL\nTipo de búsqueda: SEMANTICA\n..."
@@ -130,10 +560,10 @@ Justificación: [Breve explicación]
 Pregunta: {pregunta}"""
 
     try:
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | llm
-        response = chain.invoke({"pregunta": pregunta})
+        response = invocar_llm(template, {"pregunta": pregunta}, plazo=PLAZO_CLASIFICACION)
         return response.content
+    except (SistemaSaturadoError, ServicioNoDisponibleError):
+        raise
     except Exception as e:
         return f"❌ Error al clasificar la pregunta: {str(e)}"
 
@@ -167,15 +597,458 @@ def extraer_tipo_busqueda(clasificacion_texto):
         return match.group(1).upper()
     return "SEMANTICA"  # Por defecto, asumimos búsqueda semántica
 
-def buscar_documentos_relevantes(pregunta, categoria, n_results=3):
-    """Busca documentos relevantes en ChromaDB según la pregunta y categoría."""
-    collection = get_chroma_collection()
-    results = collection.query(
-        query_texts=[pregunta],
-        n_results=n_results,
-        where={"category": categoria} if categoria != "DESCONOCIDA" else None
+def quitar_tildes(texto):
+    """Texto en minúsculas y sin tildes, para comparar palabras clave."""
+    return "".join(c for c in unicodedata.normalize("NFKD", texto.lower()) if not unicodedata.combining(c))
+
+def clasificar_localmente(pregunta, futuros=None):
+    """Clasificación sin LLM (modo degradado), en el mismo formato que agente_orquestador.
+    
+    El tipo es LEXICA si la pregunta pide un término literal (ver
+    PREGUNTA_LEXICA_PATTERN). La categoría se vota con PALABRAS_CATEGORIA
+    (PESO_PALABRA_CLAVE por palabra) y, si la recuperación semántica
+    especulativa ha terminado, con las categorías de los VOTOS_CHUNKS_CERCANOS
+    chunks más cercanos (peso 1/posición). Sin ninguna pista se hace una
+    búsqueda léxica, que recorre todas las categorías.
+    """
+    registrar_degradado("clasificaciones_locales")
+    tipo = "LEXICA" if PREGUNTA_LEXICA_PATTERN.search(pregunta) else "SEMANTICA"
+    
+    texto = quitar_tildes(pregunta)
+    votos = {
+        cat: PESO_PALABRA_CLAVE * sum(1 for palabra in palabras if re.search(rf'\b{palabra}', texto))
+        for cat, palabras in PALABRAS_CATEGORIA.items()
+    }
+    especulativo = resultado_especulativo(futuros or {}, "semantica")
+    if especulativo is not None:
+        for posicion, meta in enumerate(especulativo[1]['metadatas'][0][:VOTOS_CHUNKS_CERCANOS], 1):
+            for cat in categorias_chunk(meta):
+                if cat in votos:
+                    votos[cat] += 1 / posicion
+    
+    categoria = max(votos, key=votos.get)
+    if not votos[categoria]:
+        categoria, tipo = "FUNCIONAL", "LEXICA"
+    return (f"Categoría: {categoria}\nTipo de búsqueda: {tipo}\n"
+            f"Justificación: clasificación local (modo degradado)")
+
+def fusionar_resultados(lista_resultados, n_results):
+    """Fusiona resultados de varias colecciones ordenando por distancia.
+    
+    Args:
+        lista_resultados (list): Respuestas de collection.query() de una sola pregunta
+        n_results (int): Número de documentos a conservar tras la fusión
+    
+    Returns:
+        dict: Resultado con el mismo formato que collection.query()
+            (incluye 'embeddings' si las respuestas los traían)
+    """
+    claves = ['distances', 'ids', 'documents', 'metadatas']
+    if lista_resultados and lista_resultados[0].get('embeddings') is not None:
+        claves.append('embeddings')
+    
+    candidatos = []
+    for resultados in lista_resultados:
+        if not resultados['ids'] or not resultados['ids'][0]:
+            continue
+        candidatos.extend(zip(*(resultados[clave][0] for clave in claves)))
+    
+    candidatos.sort(key=lambda c: c[0])
+    mejores = candidatos[:n_results]
+    return {clave: [[c[i] for c in mejores]] for i, clave in enumerate(claves)}
+
+def seleccionar_mmr(embedding_pregunta, embeddings, fuentes, k,
+                    lambda_mmr=MMR_LAMBDA, max_por_archivo=MMR_MAX_POR_ARCHIVO,
+                    umbral_duplicado=MMR_UMBRAL_DUPLICADO):
+    """Selecciona hasta k candidatos con Maximal Marginal Relevance (vectorizado).
+    
+    En cada paso elige el candidato que maximiza
+    lambda * sim(pregunta, d) - (1 - lambda) * max sim(d, seleccionados),
+    con similitud coseno calculada de una vez como producto de matrices.
+    
+    Args:
+        embedding_pregunta: Vector de la pregunta
+        embeddings: Matriz (n, dim) con los vectores de los candidatos
+        fuentes (list): source_file de cada candidato (para el límite por archivo)
+        k (int): Número máximo de candidatos a devolver
+        lambda_mmr (float): 1.0 = solo relevancia, 0.0 = solo diversidad
+        max_por_archivo (int): Máximo de chunks de un mismo archivo (0 = sin límite)
+        umbral_duplicado (float): Se descartan candidatos con similitud coseno
+            superior a este valor respecto a uno ya seleccionado
+    
+    Returns:
+        list: Índices de los candidatos seleccionados, en orden de selección.
+            Puede contener menos de k elementos si el resto son casi duplicados.
+    """
+    import numpy as np
+    
+    matriz = np.asarray(embeddings, dtype=np.float32)
+    if matriz.size == 0:
+        return []
+    matriz = matriz / np.maximum(np.linalg.norm(matriz, axis=1, keepdims=True), 1e-12)
+    consulta = np.asarray(embedding_pregunta, dtype=np.float32).ravel()
+    consulta = consulta / max(float(np.linalg.norm(consulta)), 1e-12)
+    
+    relevancia = matriz @ consulta
+    similitud = matriz @ matriz.T
+    fuentes = np.asarray(fuentes)
+    
+    disponibles = np.ones(len(matriz), dtype=bool)
+    max_similitud = np.zeros(len(matriz), dtype=np.float32)
+    por_archivo = {}
+    seleccion = []
+    
+    while len(seleccion) < k and disponibles.any():
+        puntuacion = lambda_mmr * relevancia - (1 - lambda_mmr) * max_similitud
+        puntuacion[~disponibles] = -np.inf
+        elegido = int(np.argmax(puntuacion))
+        seleccion.append(elegido)
+        
+        disponibles[elegido] = False
+        max_similitud = np.maximum(max_similitud, similitud[elegido])
+        disponibles &= similitud[elegido] <= umbral_duplicado
+        
+        fuente = fuentes[elegido]
+        por_archivo[fuente] = por_archivo.get(fuente, 0) + 1
+        if max_por_archivo and por_archivo[fuente] >= max_por_archivo:
+            disponibles &= fuentes != fuente
+    
+    return seleccion
+
+def diversificar_resultados(resultados, embedding_pregunta, n_results):
+    """Reordena un resultado de collection.query() con MMR y descarta los embeddings."""
+    if not resultados['ids'] or not resultados['ids'][0]:
+        return resultados
+    
+    fuentes = [meta.get('source_file', '') for meta in resultados['metadatas'][0]]
+    seleccion = seleccionar_mmr(embedding_pregunta, resultados['embeddings'][0], fuentes, n_results)
+    return {
+        clave: [[resultados[clave][0][i] for i in seleccion]]
+        for clave in ('ids', 'documents', 'metadatas', 'distances')
+    }
+
+def filtro_categoria(categoria):
+    """Filtro 'where' de una categoría, incluidos los chunks deduplicados que comparte con otras."""
+    return {"$or": [{"category": categoria}, {"categories": {"$contains": categoria}}]}
+
+def categorias_chunk(meta):
+    """Categorías a las que pertenece un chunk (varias si ingest.py lo ha deduplicado)."""
+    return meta.get('categories') or [meta.get('category')]
+
+def filtro_fuentes(fuentes):
+    """Filtro 'where' de los chunks de unos ficheros (propios o compartidos por deduplicación)."""
+    return {"$or": [{"source_file": {"$in": fuentes}}] + [{"sources": {"$contains": f}} for f in fuentes]}
+
+def consultar_jerarquico(embedding, categoria, n_results, include):
+    """Recuperación en dos etapas: documentos más cercanos y después sus chunks.
+    
+    1. En el índice de documentos (centroide de los chunks de cada fichero)
+       se eligen los JERARQUICA_DOCUMENTOS ficheros más cercanos de la categoría.
+    2. Se buscan los chunks solo dentro de esos ficheros (filtro 'where' por
+       fuente; en modo particionado, en la partición de cada fichero).
+    
+    El coste depende del nº de documentos más los chunks de unos pocos, no del
+    total de chunks, y los chunks de otros módulos no compiten. Los tiempos de
+    cada etapa se acumulan en metricas_recuperacion().
+    
+    Returns:
+        dict: Resultado con el formato de collection.query(), o None si no hay
+            índice de documentos (se hace la consulta plana)
+    """
+    coleccion_documentos = get_coleccion_documentos()
+    if coleccion_documentos is None:
+        with _metricas_lock:
+            _metricas_jerarquica["sin_indice"] += 1
+        return None
+    
+    inicio = time.perf_counter()
+    documentos = coleccion_documentos.query(
+        query_embeddings=embedding,
+        n_results=JERARQUICA_DOCUMENTOS,
+        where=filtro_categoria(categoria) if categoria != "DESCONOCIDA" else None,
+        include=["metadatas"]
+    )
+    fuentes_por_coleccion = {}
+    for meta in documentos['metadatas'][0]:
+        fuentes_por_coleccion.setdefault(meta['chunk_collection'], []).append(meta['source_file'])
+    fin_documentos = time.perf_counter()
+    
+    lista_resultados = [
+        get_chroma_collection(nombre).query(
+            query_embeddings=embedding,
+            n_results=n_results,
+            where=filtro_fuentes(fuentes),
+            include=include
+        )
+        for nombre, fuentes in fuentes_por_coleccion.items()
+    ]
+    resultados = (lista_resultados[0] if len(lista_resultados) == 1
+                  else fusionar_resultados(lista_resultados, n_results) if lista_resultados
+                  else {clave: [[]] for clave in ['ids', 'documents', 'metadatas', 'distances'] + include})
+    
+    with _metricas_lock:
+        _metricas_jerarquica["consultas"] += 1
+        _metricas_jerarquica["documentos_s"] += fin_documentos - inicio
+        _metricas_jerarquica["chunks_s"] += time.perf_counter() - fin_documentos
+        _metricas_jerarquica["chunks_candidatos"] += sum(
+            meta.get('n_chunks', 0) for meta in documentos['metadatas'][0])
+    return resultados
+
+def consultar_colecciones(embedding, categoria, n_results, include):
+    """Lanza la consulta vectorial contra la colección o particiones que correspondan.
+    
+    En modo particionado (RAG_PARTITION_BY_CATEGORY=1) la consulta va
+    directamente a la colección de la categoría, sin filtro 'where'. Las
+    preguntas sin categoría (DESCONOCIDA) se lanzan contra todas las
+    particiones reutilizando el mismo embedding y se fusionan por distancia.
+
+    Con RAG_VECTOR_BACKEND=mmap la consulta se resuelve en el índice mmap
+    (get_indice_mmap), que guarda cada categoría como un rango contiguo.
+    
+    Con RAG_HIERARCHICAL=1 (y el backend de Chroma) se usa la recuperación
+    en dos etapas de consultar_jerarquico si existe el índice de documentos.
+    """
+    if BACKEND_VECTORIAL == "mmap":
+        return get_indice_mmap().consultar(embedding, categoria, n_results, include)
+    
+    if RECUPERACION_JERARQUICA:
+        resultados = consultar_jerarquico(embedding, categoria, n_results, include)
+        if resultados is not None:
+            return resultados
+    
+    if not PARTICIONADO_POR_CATEGORIA:
+        collection = get_chroma_collection()
+        return collection.query(
+            query_embeddings=embedding,
+            n_results=n_results,
+            where=filtro_categoria(categoria) if categoria != "DESCONOCIDA" else None,
+            include=include
+        )
+    
+    if categoria in CATEGORIAS:
+        collection = get_chroma_collection(nombre_coleccion_categoria(categoria))
+        return collection.query(query_embeddings=embedding, n_results=n_results, include=include)
+    
+    lista_resultados = [
+        get_chroma_collection(nombre_coleccion_categoria(cat)).query(
+            query_embeddings=embedding,
+            n_results=n_results,
+            include=include
+        )
+        for cat in CATEGORIAS
+    ]
+    return fusionar_resultados(lista_resultados, n_results)
+
+def filtrar_por_categoria(resultados, categoria, n_results):
+    """Se queda con los n_results primeros resultados de una categoría (en local)."""
+    indices = [
+        i for i, meta in enumerate(resultados['metadatas'][0])
+        if categoria == "DESCONOCIDA" or categoria in categorias_chunk(meta)
+    ][:n_results]
+    return {
+        clave: [[valores[0][i] for i in indices]]
+        for clave, valores in resultados.items()
+        if clave in ('ids', 'documents', 'metadatas', 'distances', 'embeddings') and valores is not None
+    }
+
+def get_umbrales_relevancia():
+    """Umbrales de distancia por categoría de FICHERO_UMBRALES (se recargan si cambia el fichero)."""
+    try:
+        mtime = os.path.getmtime(FICHERO_UMBRALES)
+    except OSError:
+        return {}
+    if mtime != _umbrales["mtime"]:
+        try:
+            with open(FICHERO_UMBRALES, 'r', encoding='utf-8') as f:
+                valores = json.load(f)
+        except (OSError, ValueError):
+            valores = {}
+        _umbrales["valores"], _umbrales["mtime"] = valores, mtime
+    return _umbrales["valores"]
+
+def umbral_relevancia(categoria):
+    """Distancia máxima para considerar relevante un chunk de la categoría (None = sin umbral)."""
+    umbrales = get_umbrales_relevancia()
+    umbral = umbrales.get(categoria, umbrales.get("_global", UMBRAL_RELEVANCIA_GLOBAL))
+    return float(umbral) if umbral not in (None, "") else None
+
+def aplicar_umbral_relevancia(resultados, umbral):
+    """Descarta los resultados (ordenados por distancia) que superan el umbral."""
+    if umbral is None or not resultados['ids'] or not resultados['ids'][0]:
+        return resultados
+    n = sum(1 for distancia in resultados['distances'][0] if distancia <= umbral)
+    return {
+        clave: [valores[0][:n]] if valores is not None else None
+        for clave, valores in resultados.items()
+        if clave in ('ids', 'documents', 'metadatas', 'distances', 'embeddings')
+    }
+
+def ranking_especulativo_global():
+    """True si la consulta especulativa ordena todos los chunks por distancia (ranking plano).
+    
+    Se cumple con la colección compartida, las particiones fusionadas por
+    distancia y el índice mmap. La recuperación jerárquica no: sus chunks
+    salen de los documentos más cercanos en global, no de los de la categoría.
+    """
+    return BACKEND_VECTORIAL == "mmap" or not RECUPERACION_JERARQUICA
+
+def buscar_documentos_relevantes(pregunta, categoria, n_results=3, mmr=USAR_MMR, especulativo=None,
+                                 umbral="calibrado"):
+    """Busca documentos relevantes en ChromaDB según la pregunta y categoría.
+    
+    Con mmr=True (RAG_MMR=1) recupera MMR_CANDIDATOS candidatos junto con sus
+    embeddings y se queda con hasta n_results chunks diversos (ver
+    seleccionar_mmr), evitando varios trozos casi iguales del mismo archivo.
+    
+    Si se pasa 'especulativo' (ver recuperacion_semantica_especulativa), se
+    reutiliza su embedding. Sus resultados sin filtrar solo se reutilizan si
+    el ranking especulativo es plano y global (ver ranking_especulativo_global):
+    entonces los chunks de la categoría presentes en el top-K son los
+    primeros de esa categoría, y basta con filtrarlos en local mientras haya
+    al menos los candidatos pedidos (si no, el truncado a ESPECULATIVO_K
+    podría haber dejado fuera alguno y se repite la consulta con filtro).
+    Con un índice aproximado (HNSW) el orden puede diferir ligeramente del de
+    la consulta con filtro. En otros modos se consulta siempre con la categoría.
+    
+    Los resultados incluyen siempre 'distances' y solo se conservan los
+    chunks con distancia menor o igual que 'umbral' (por defecto el calibrado
+    de la categoría, ver umbral_relevancia; None = sin filtro). Si no queda
+    ninguno, 'documents' llega vacío y el agente no llama al LLM.
+    """
+    comprobar_version_indice()
+    if umbral == "calibrado":
+        umbral = umbral_relevancia(categoria)
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if mmr else [])
+    n_candidatos = max(n_results, MMR_CANDIDATOS) if mmr else n_results
+    
+    resultados = None
+    if especulativo is not None:
+        embedding, candidatos = especulativo
+        if ranking_especulativo_global():
+            resultados = filtrar_por_categoria(candidatos, categoria, n_candidatos)
+            if len(resultados['ids'][0]) < n_candidatos or (mmr and 'embeddings' not in resultados):
+                resultados = None
+    else:
+        embedding = calcular_embedding(pregunta)
+    
+    if resultados is None:
+        resultados = consultar_colecciones(embedding, categoria, n_candidatos, include)
+    
+    resultados = aplicar_umbral_relevancia(resultados, umbral)
+    if not mmr:
+        return resultados
+    return diversificar_resultados(resultados, embedding[0], n_results)
+
+def recuperacion_semantica_especulativa(pregunta, futuro_embedding=None):
+    """Consulta vectorial sin filtro de categoría, lanzada mientras se clasifica.
+    
+    Si se pasa 'futuro_embedding' se completa en cuanto se calcula el
+    embedding, antes de la consulta a Chroma (ver buscar_respuesta_precalculada).
+    
+    Returns:
+        tuple: (embedding de la pregunta, resultados top-ESPECULATIVO_K sin filtrar)
+    """
+    comprobar_version_indice()
+    try:
+        embedding = calcular_embedding(pregunta)
+    except Exception as e:
+        if futuro_embedding is not None:
+            futuro_embedding.set_exception(e)
+        raise
+    if futuro_embedding is not None:
+        futuro_embedding.set_result(embedding)
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if USAR_MMR else [])
+    n_candidatos = max(ESPECULATIVO_K, MMR_CANDIDATOS if USAR_MMR else 0)
+    return embedding, consultar_colecciones(embedding, "DESCONOCIDA", n_candidatos, include)
+
+def recuperacion_lexica_especulativa(pregunta):
+    """Búsqueda léxica en las carpetas de todas las categorías, lanzada mientras se clasifica.
+    
+    Returns:
+        dict: categoría -> (terminos, resultados) de busqueda_lexica_en_archivos
+    """
+    return {
+        cat: busqueda_lexica_en_archivos(pregunta, os.path.join(CARPETA_DOCS, cat))
+        for cat in CATEGORIAS
+    }
+
+def lanzar_recuperacion_especulativa(pregunta):
+    """Lanza en segundo plano la recuperación semántica y léxica de la pregunta."""
+    if not RECUPERACION_ESPECULATIVA:
+        return {}
+    executor = get_executor()
+    futuro_embedding = Future()
+    return {
+        "embedding": futuro_embedding,
+        "semantica": executor.submit(recuperacion_semantica_especulativa, pregunta, futuro_embedding),
+        "lexica": executor.submit(recuperacion_lexica_especulativa, pregunta)
+    }
+
+def resultado_especulativo(futuros, clave):
+    """Espera el resultado especulativo indicado; None si no se lanzó o falló."""
+    futuro = futuros.get(clave)
+    if futuro is None:
+        return None
+    try:
+        return futuro.result()
+    except Exception:
+        # El camino normal (consulta directa) se encargará de informar del error
+        return None
+
+def buscar_respuesta_precalculada(pregunta, futuros, categoria=None):
+    """Pregunta precalculada más parecida si está a distancia <= UMBRAL_PRECALCULADA.
+    
+    Reutiliza el embedding de la recuperación especulativa si se ha lanzado;
+    solo espera al embedding, no a la consulta vectorial sin filtro.
+    Con 'categoria' solo se buscan las preguntas de esa categoría.
+    
+    Returns:
+        dict: {"pregunta", "respuesta", "categoria", "distancia", "metadatas"} o None
+    """
+    comprobar_version_indice()
+    coleccion = get_coleccion_preguntas()
+    if coleccion is None:
+        return None
+    
+    embedding = resultado_especulativo(futuros, "embedding")
+    try:
+        embedding = embedding if embedding is not None else calcular_embedding(pregunta)
+    except SistemaSaturadoError:
+        raise
+    except Exception:
+        # Sin embedding se sigue por el camino normal, que informa del error
+        return None
+    resultados = coleccion.query(
+        query_embeddings=embedding,
+        n_results=1,
+        where=filtro_categoria(categoria) if categoria else None,
+        include=["documents", "metadatas", "distances"]
     )
-    return results
+    if not resultados['ids'][0] or resultados['distances'][0][0] > UMBRAL_PRECALCULADA:
+        return None
+    meta = resultados['metadatas'][0][0]
+    return {
+        "pregunta": resultados['documents'][0][0],
+        "respuesta": meta['respuesta'],
+        "categoria": meta.get('category', "DESCONOCIDA"),
+        "distancia": resultados['distances'][0][0],
+        "metadatas": meta
+    }
+
+def formatear_respuesta_precalculada(coincidencia, mostrar_categoria, mostrar_fuentes):
+    """Resultado de procesar_pregunta para una respuesta precalculada."""
+    contenido = (f"{coincidencia['respuesta']}\n\n"
+                 f"_⚡ Respuesta precalculada para la pregunta frecuente «{coincidencia['pregunta']}»_")
+    respuesta = formatear_respuesta_con_fuentes(contenido, [coincidencia['metadatas']], mostrar_fuentes)
+    if mostrar_categoria:
+        respuesta = f"🤖 **Tipo de búsqueda:** ⚡ Respuesta precalculada - {coincidencia['categoria']}\n---\n{respuesta}"
+    return {
+        "respuesta": respuesta,
+        "categoria": coincidencia['categoria'],
+        "tipo_busqueda": "SEMANTICA",
+        "degradado": False,
+        "precalculada": True
+    }
 
 def construir_contexto(documentos, metadatas):
     """Construye el contexto a partir de documentos y metadatos."""
@@ -190,8 +1063,9 @@ def formatear_respuesta_con_fuentes(contenido, metadatas, mostrar_fuentes=True):
     if not mostrar_fuentes:
         return contenido
     
+    # Un chunk deduplicado lista todos los ficheros en los que aparece ('sources')
     fuentes_unicas = list(dict.fromkeys(
-        meta.get('source_file', 'Desconocido') for meta in metadatas
+        fuente for meta in metadatas for fuente in (meta.get('sources') or [meta.get('source_file', 'Desconocido')])
     ))
     fuentes_str = "\n".join(f"- {fuente}" for fuente in fuentes_unicas)
     return f"{contenido}\n\n📚 **Fuentes consultadas:**\n{fuentes_str}"
@@ -297,7 +1171,123 @@ def formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes):
     
     return respuesta
 
-def agente_funcional(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True):
+def puntuar_coincidencia(coincidencia):
+    """Relevancia de una coincidencia léxica: palabra completa y mayúsculas exactas puntúan más."""
+    termino = coincidencia['termino']
+    linea = coincidencia['contexto'].split('\n')[min(1, coincidencia['linea'] - 1)]
+    puntuacion = 1
+    if re.search(rf'(?<!\w){re.escape(termino)}(?!\w)', linea, re.IGNORECASE):
+        puntuacion += 2
+    if termino in linea:
+        puntuacion += 1
+    return puntuacion
+
+def fusionar_resultados_lexicos(lexico, mostrar_fuentes):
+    """Fusiona sin LLM las búsquedas léxicas de todas las categorías.
+    
+    Elimina coincidencias repetidas (mismo fragmento en varios archivos o
+    categorías), ordena los archivos por relevancia acumulada y muestra cada
+    coincidencia con su archivo y línea.
+    
+    Args:
+        lexico (dict): categoría -> (terminos, resultados) de busqueda_lexica_en_archivos
+        mostrar_fuentes (bool): Si se listan los archivos y líneas consultados
+    
+    Returns:
+        str: Respuesta formateada en Markdown
+    """
+    terminos = next((t for t, _ in lexico.values() if t), None)
+    if terminos is None:
+        return "⚠️ No se pudieron extraer términos de búsqueda de tu pregunta. Inténtalo de nuevo especificando claramente el término que buscas."
+    
+    vistos = {}
+    por_archivo = {}
+    for categoria, (_, resultados) in lexico.items():
+        for coincidencia in resultados:
+            clave = coincidencia['contexto'].strip()
+            ubicacion = f"{categoria}/{coincidencia['archivo']}"
+            if clave in vistos:
+                vistos[clave]['duplicados'].append(f"{ubicacion}:{coincidencia['linea']}")
+                continue
+            entrada = dict(coincidencia, puntuacion=puntuar_coincidencia(coincidencia), duplicados=[])
+            vistos[clave] = entrada
+            por_archivo.setdefault(ubicacion, []).append(entrada)
+    
+    if not por_archivo:
+        return f"⚠️ No se encontraron coincidencias para los términos buscados: {', '.join(terminos)}"
+    
+    archivos = sorted(por_archivo.items(), key=lambda item: -sum(c['puntuacion'] for c in item[1]))
+    total = sum(len(coincidencias) for coincidencias in por_archivo.values())
+    
+    respuesta = f"🔍 **Búsqueda léxica de:** {', '.join(terminos)}\n\n"
+    respuesta += f"Se encontraron **{total} coincidencias** en **{len(archivos)} archivos**:\n\n"
+    for ubicacion, coincidencias in archivos:
+        coincidencias.sort(key=lambda c: (-c['puntuacion'], c['linea']))
+        respuesta += f"### 📄 {ubicacion}\n"
+        for c in coincidencias[:MAX_COINCIDENCIAS_POR_ARCHIVO]:
+            repetida = f" _(también en {', '.join(c['duplicados'])})_" if c['duplicados'] else ""
+            respuesta += f"\n**Línea {c['linea']}:**{repetida}\n```\n{c['contexto']}\n```\n"
+        if len(coincidencias) > MAX_COINCIDENCIAS_POR_ARCHIVO:
+            respuesta += f"\n_... y {len(coincidencias) - MAX_COINCIDENCIAS_POR_ARCHIVO} coincidencias más en este archivo_\n"
+        respuesta += "\n"
+    
+    if mostrar_fuentes:
+        respuesta += "\n📚 **Archivos consultados:**\n"
+        respuesta += "\n".join(
+            f"- {ubicacion} (líneas {', '.join(str(c['linea']) for c in sorted(coincidencias, key=lambda c: c['linea']))})"
+            for ubicacion, coincidencias in archivos
+        )
+    
+    return respuesta
+
+def respuesta_sin_contexto_relevante(pregunta, categoria, mostrar_fuentes, lexico=None):
+    """Respuesta inmediata (sin LLM) cuando ningún chunk supera el umbral de relevancia.
+    
+    Con RAG_RELEVANCE_FALLBACK=lexica se prueba antes una búsqueda literal en
+    la carpeta de la categoría y, si encuentra algo, se devuelven esas coincidencias.
+    """
+    if RESPALDO_SIN_RELEVANCIA == "lexica":
+        if lexico is None:
+            lexico = busqueda_lexica_en_archivos(pregunta, os.path.join(CARPETA_DOCS, categoria))
+        terminos, resultados = lexico
+        if terminos and resultados:
+            return ("ℹ️ No hay documentación que responda directamente a tu pregunta; "
+                    "estas son las coincidencias literales encontradas:\n\n"
+                    + formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes))
+    return f"⚠️ No se encontró documentación relevante sobre tu pregunta en la categoría {categoria}."
+
+def respuesta_degradada(pregunta, categoria, mostrar_fuentes, documentos=None, metadatas=None, lexico=None):
+    """Respuesta sin LLM cuando el proveedor no está disponible (plazo agotado o circuito abierto).
+    
+    Muestra tal cual los chunks ya recuperados (recortados a
+    MAX_CARACTERES_FRAGMENTO_DEGRADADO caracteres) o, si tampoco se ha podido
+    calcular el embedding, las coincidencias literales en la carpeta de la categoría.
+    """
+    registrar_degradado("respuestas_degradadas")
+    if documentos:
+        fragmentos = []
+        for i, (doc, meta) in enumerate(zip(documentos, metadatas), 1):
+            texto = doc if len(doc) <= MAX_CARACTERES_FRAGMENTO_DEGRADADO else doc[:MAX_CARACTERES_FRAGMENTO_DEGRADADO].rstrip() + " [...]"
+            fragmentos.append(f"**{i}. {meta.get('source_file', 'Desconocido')}**\n\n{texto}")
+        contenido = (f"{AVISO_DEGRADADO}; estos son los fragmentos de documentación más relevantes "
+                     f"para tu pregunta:\n\n" + "\n\n---\n\n".join(fragmentos))
+        return formatear_respuesta_con_fuentes(contenido, metadatas, mostrar_fuentes)
+    
+    if lexico is None:
+        lexico = busqueda_lexica_en_archivos(pregunta, os.path.join(CARPETA_DOCS, categoria))
+    terminos, resultados = lexico
+    if terminos and resultados:
+        return (f"{AVISO_DEGRADADO}; estas son las coincidencias literales encontradas:\n\n"
+                + formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes))
+    return f"{AVISO_DEGRADADO} y no se han encontrado coincidencias literales. Inténtalo de nuevo en unos minutos."
+
+def respuesta_degradada_lexica(lexico, mostrar_fuentes):
+    """Fusión sin LLM de una búsqueda léxica en todas las categorías cuando no se puede redactar."""
+    registrar_degradado("respuestas_degradadas")
+    return (f"{AVISO_DEGRADADO}; estas son las coincidencias literales encontradas:\n\n"
+            + fusionar_resultados_lexicos(lexico, mostrar_fuentes))
+
+def agente_funcional(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True, especulativo=None, lexico=None):
     """
     Agente funcional que busca documentos relevantes en la BBDD vectorial (semántica)
     o realiza búsqueda léxica en archivos markdown según el tipo de búsqueda.
@@ -307,25 +1297,34 @@ def agente_funcional(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True):
         categoria: Categoría de la pregunta (FUNCIONAL/TECNICA/GESTION)
         tipo_busqueda: Tipo de búsqueda (SEMANTICA/LEXICA)
         mostrar_fuentes: Si se deben mostrar las fuentes consultadas
+        especulativo: Recuperación semántica ya lanzada (ver recuperacion_semantica_especulativa)
+        lexico: Resultado ya calculado de busqueda_lexica_en_archivos para su carpeta
+    
+    Returns:
+        tuple: (respuesta en Markdown, True si se ha respondido en modo degradado sin LLM)
     """
+    documentos = metadatas = None
     try:
         # Manejo de búsqueda léxica
         if tipo_busqueda == "LEXICA":
-            carpeta_funcional = './doc/doc_scangestor/FUNCIONAL'
-            terminos, resultados = busqueda_lexica_en_archivos(pregunta, carpeta_funcional)
+            if lexico is not None:
+                terminos, resultados = lexico
+            else:
+                carpeta_funcional = os.path.join(CARPETA_DOCS, "FUNCIONAL")
+                terminos, resultados = busqueda_lexica_en_archivos(pregunta, carpeta_funcional)
             
             if terminos is None:
-                return "⚠️ No se pudieron extraer términos de búsqueda de tu pregunta. Inténtalo de nuevo especificando claramente el término que buscas."
+                return "⚠️ No se pudieron extraer términos de búsqueda de tu pregunta. Inténtalo de nuevo especificando claramente el término que buscas.", False
             
-            return formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes)
+            return formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes), False
         
         # Manejo de búsqueda semántica (comportamiento original)
         # 1. Buscar documentos relevantes
-        results = buscar_documentos_relevantes(pregunta, categoria)
+        results = buscar_documentos_relevantes(pregunta, categoria, especulativo=especulativo)
         
-        # 2. Verificar si hay resultados
+        # 2. Verificar si hay resultados relevantes (bajo el umbral de distancia)
         if not results['documents'] or not results['documents'][0]:
-            return "⚠️ No se encontraron documentos relevantes en la base de datos para responder tu pregunta."
+            return respuesta_sin_contexto_relevante(pregunta, categoria, mostrar_fuentes, lexico), False
         
         # 3. Construir contexto
         documentos = results['documents'][0]
@@ -347,10 +1346,7 @@ PREGUNTA: {pregunta}
 RESPUESTA: Proporciona una respuesta clara, estructurada y basada únicamente en el contexto proporcionado. Si lo ves necesario incluye ejemplos prácticos o pasos a seguir.
 Si el contexto no contiene información suficiente, indícalo claramente. Puedes proponer cambios en base a las preguntas realizadas para incorporar funcionalidades nuevas."""
         
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | llm
-        
-        response = chain.invoke({
+        response = invocar_llm(template, {
             "categoria": categoria,
             "tipo_busqueda": tipo_busqueda,
             "contexto": contexto,
@@ -358,12 +1354,16 @@ Si el contexto no contiene información suficiente, indícalo claramente. Puedes
         })
         
         # 5. Formatear respuesta con fuentes
-        return formatear_respuesta_con_fuentes(response.content, metadatas, mostrar_fuentes)
+        return formatear_respuesta_con_fuentes(response.content, metadatas, mostrar_fuentes), False
         
+    except ServicioNoDisponibleError:
+        return respuesta_degradada(pregunta, categoria, mostrar_fuentes, documentos, metadatas, lexico), True
+    except SistemaSaturadoError:
+        raise
     except Exception as e:
-        return f"❌ Error en el agente funcional: {str(e)}"
+        return f"❌ Error en el agente funcional: {str(e)}", False
 
-def agente_tecnico(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True):
+def agente_tecnico(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True, especulativo=None, lexico=None):
     """
     Agente técnico que busca documentos relevantes en la BBDD vectorial (semántica)
     o realiza búsqueda léxica en archivos markdown según el tipo de búsqueda.
@@ -373,25 +1373,34 @@ def agente_tecnico(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True):
         categoria: Categoría de la pregunta (FUNCIONAL/TECNICA/GESTION)
         tipo_busqueda: Tipo de búsqueda (SEMANTICA/LEXICA)
         mostrar_fuentes: Si se deben mostrar las fuentes consultadas
+        especulativo: Recuperación semántica ya lanzada (ver recuperacion_semantica_especulativa)
+        lexico: Resultado ya calculado de busqueda_lexica_en_archivos para su carpeta
+    
+    Returns:
+        tuple: (respuesta en Markdown, True si se ha respondido en modo degradado sin LLM)
     """
+    documentos = metadatas = None
     try:
         # Manejo de búsqueda léxica
         if tipo_busqueda == "LEXICA":
-            carpeta_tecnica = './doc/doc_scangestor/TECNICA'
-            terminos, resultados = busqueda_lexica_en_archivos(pregunta, carpeta_tecnica)
+            if lexico is not None:
+                terminos, resultados = lexico
+            else:
+                carpeta_tecnica = os.path.join(CARPETA_DOCS, "TECNICA")
+                terminos, resultados = busqueda_lexica_en_archivos(pregunta, carpeta_tecnica)
             
             if terminos is None:
-                return "⚠️ No se pudieron extraer términos de búsqueda de tu pregunta. Inténtalo de nuevo especificando claramente el término que buscas."
+                return "⚠️ No se pudieron extraer términos de búsqueda de tu pregunta. Inténtalo de nuevo especificando claramente el término que buscas.", False
             
-            return formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes)
+            return formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes), False
         
         # Manejo de búsqueda semántica (comportamiento original)
         # 1. Buscar documentos relevantes
-        results = buscar_documentos_relevantes(pregunta, categoria)
+        results = buscar_documentos_relevantes(pregunta, categoria, especulativo=especulativo)
         
-        # 2. Verificar si hay resultados
+        # 2. Verificar si hay resultados relevantes (bajo el umbral de distancia)
         if not results['documents'] or not results['documents'][0]:
-            return "⚠️ No se encontraron documentos relevantes en la base de datos para responder tu pregunta."
+            return respuesta_sin_contexto_relevante(pregunta, categoria, mostrar_fuentes, lexico), False
         
         # 3. Construir contexto
         documentos = results['documents'][0]
@@ -415,10 +1424,7 @@ Incluye detalles técnicos relevantes, arquitectura, APIs, tecnologías y patron
 Si el contexto no contiene información suficiente, indícalo claramente. Si necesitas más información puedes preguntarla.
 Indica que el correo de soporte es soporte@scangasto.com."""
         
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | llm
-        
-        response = chain.invoke({
+        response = invocar_llm(template, {
             "categoria": categoria,
             "tipo_busqueda": tipo_busqueda,
             "contexto": contexto,
@@ -426,12 +1432,16 @@ Indica que el correo de soporte es soporte@scangasto.com."""
         })
         
         # 5. Formatear respuesta con fuentes
-        return formatear_respuesta_con_fuentes(response.content, metadatas, mostrar_fuentes)
+        return formatear_respuesta_con_fuentes(response.content, metadatas, mostrar_fuentes), False
         
+    except ServicioNoDisponibleError:
+        return respuesta_degradada(pregunta, categoria, mostrar_fuentes, documentos, metadatas, lexico), True
+    except SistemaSaturadoError:
+        raise
     except Exception as e:
-        return f"❌ Error en el agente técnico: {str(e)}"
+        return f"❌ Error en el agente técnico: {str(e)}", False
 
-def agente_gestion(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True):
+def agente_gestion(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True, especulativo=None, lexico=None):
     """
     Agente de gestión que busca documentos relevantes en la BBDD vectorial (semántica)
     o realiza búsqueda léxica en archivos markdown según el tipo de búsqueda.
@@ -441,25 +1451,34 @@ def agente_gestion(pregunta, categoria, tipo_busqueda, mostrar_fuentes=True):
         categoria: Categoría de la pregunta (FUNCIONAL/TECNICA/GESTION)
         tipo_busqueda: Tipo de búsqueda (SEMANTICA/LEXICA)
         mostrar_fuentes: Si se deben mostrar las fuentes consultadas
+        especulativo: Recuperación semántica ya lanzada (ver recuperacion_semantica_especulativa)
+        lexico: Resultado ya calculado de busqueda_lexica_en_archivos para su carpeta
+    
+    Returns:
+        tuple: (respuesta en Markdown, True si se ha respondido en modo degradado sin LLM)
     """
+    documentos = metadatas = None
     try:
         # Manejo de búsqueda léxica
         if tipo_busqueda == "LEXICA":
-            carpeta_gestion = './doc/doc_scangestor/GESTION'
-            terminos, resultados = busqueda_lexica_en_archivos(pregunta, carpeta_gestion)
+            if lexico is not None:
+                terminos, resultados = lexico
+            else:
+                carpeta_gestion = os.path.join(CARPETA_DOCS, "GESTION")
+                terminos, resultados = busqueda_lexica_en_archivos(pregunta, carpeta_gestion)
             
             if terminos is None:
-                return "⚠️ No se pudieron extraer términos de búsqueda de tu pregunta. Inténtalo de nuevo especificando claramente el término que buscas."
+                return "⚠️ No se pudieron extraer términos de búsqueda de tu pregunta. Inténtalo de nuevo especificando claramente el término que buscas.", False
             
-            return formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes)
+            return formatear_resultados_lexicos(terminos, resultados, mostrar_fuentes), False
         
         # Manejo de búsqueda semántica (comportamiento original)
         # 1. Buscar documentos relevantes
-        results = buscar_documentos_relevantes(pregunta, categoria)
+        results = buscar_documentos_relevantes(pregunta, categoria, especulativo=especulativo)
         
-        # 2. Verificar si hay resultados
+        # 2. Verificar si hay resultados relevantes (bajo el umbral de distancia)
         if not results['documents'] or not results['documents'][0]:
-            return "⚠️ No se encontraron documentos relevantes en la base de datos para responder tu pregunta."
+            return respuesta_sin_contexto_relevante(pregunta, categoria, mostrar_fuentes, lexico), False
         
         # 3. Construir contexto
         documentos = results['documents'][0]
@@ -484,10 +1503,7 @@ Si el contexto no contiene información suficiente, indícalo claramente.
 Comenta que el correo del jefe de proyecto es angel@scangasto.com.
 """
         
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | llm
-        
-        response = chain.invoke({
+        response = invocar_llm(template, {
             "categoria": categoria,
             "tipo_busqueda": tipo_busqueda,
             "contexto": contexto,
@@ -495,12 +1511,17 @@ Comenta que el correo del jefe de proyecto es angel@scangasto.com.
         })
         
         # 5. Formatear respuesta con fuentes
-        return formatear_respuesta_con_fuentes(response.content, metadatas, mostrar_fuentes)
+        return formatear_respuesta_con_fuentes(response.content, metadatas, mostrar_fuentes), False
         
+    except ServicioNoDisponibleError:
+        return respuesta_degradada(pregunta, categoria, mostrar_fuentes, documentos, metadatas, lexico), True
+    except SistemaSaturadoError:
+        raise
     except Exception as e:
-        return f"❌ Error en el agente de gestión: {str(e)}"
+        return f"❌ Error en el agente de gestión: {str(e)}", False
 
-def agente_sintetizador(pregunta, respuesta_funcional, respuesta_tecnica, respuesta_gestion):
+def agente_sintetizador(pregunta, respuesta_funcional, respuesta_tecnica, respuesta_gestion,
+                        lexico=None, mostrar_fuentes=True):
     """    Agente sintetizador que fusiona las respuestas de múltiples agentes
     en una salida coherente y estructurada.
     
@@ -509,9 +1530,12 @@ def agente_sintetizador(pregunta, respuesta_funcional, respuesta_tecnica, respue
         respuesta_funcional: Respuesta del agente funcional
         respuesta_tecnica: Respuesta del agente técnico
         respuesta_gestion: Respuesta del agente de gestión
+        lexico: Búsqueda léxica de todas las categorías, para la respuesta
+            degradada si el LLM no está disponible
+        mostrar_fuentes: Si se deben mostrar las fuentes en la respuesta degradada
     
     Returns:
-        Una respuesta sintetizada y coherente
+        tuple: (respuesta sintetizada, True si se ha respondido en modo degradado sin LLM)
     """
     try:
         template = """Eres un agente sintetizador experto en consolidar información de múltiples fuentes.
@@ -548,18 +1572,19 @@ INSTRUCCIONES PARA LA SÍNTESIS:
 
 RESPUESTA SINTETIZADA:"""
         
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | llm
-        
-        response = chain.invoke({
+        response = invocar_llm(template, {
             "pregunta": pregunta,
             "respuesta_funcional": respuesta_funcional,
             "respuesta_tecnica": respuesta_tecnica,
             "respuesta_gestion": respuesta_gestion
-        })
+        }, plazo=PLAZO_SINTESIS)
         
-        return response.content
+        return response.content, False
         
+    except ServicioNoDisponibleError:
+        if lexico is not None:
+            return respuesta_degradada_lexica(lexico, mostrar_fuentes), True
+        raise
     except Exception as e:
         # Si falla la síntesis, devolver las respuestas organizadas manualmente
         return f"""## Resultados de búsqueda léxica
@@ -574,7 +1599,7 @@ RESPUESTA SINTETIZADA:"""
 {respuesta_gestion}
 
 ---
-⚠️ Nota: Error al sintetizar respuestas: {str(e)}"""
+⚠️ Nota: Error al sintetizar respuestas: {str(e)}""", False
 
 # Diccionario de dispatch para selección de agentes
 AGENTES_DISPATCH = {
@@ -583,7 +1608,8 @@ AGENTES_DISPATCH = {
     "GESTION": agente_gestion
 }
 
-def chat_response(message, history, mostrar_categoria, mostrar_fuentes):
+def chat_response(message, history, mostrar_categoria, mostrar_fuentes, redactar_lexica=REDACTAR_LEXICA,
+                  perfilar_pregunta=False):
     """
     Función principal del chat que procesa los mensajes.
     
@@ -592,85 +1618,328 @@ def chat_response(message, history, mostrar_categoria, mostrar_fuentes):
         history: Historial de mensajes
         mostrar_categoria: Si se debe mostrar la categoría identificada
         mostrar_fuentes: Si se deben mostrar las fuentes consultadas
+        redactar_lexica: Si las búsquedas léxicas con resultados en varias
+            categorías se redactan con el agente sintetizador
+        perfilar_pregunta: Guardar un perfil de esta pregunta (interruptor de depuración)
     """
     if not message.strip():
         return "Por favor, escribe una pregunta."
     
+    try:
+        resultado = atender_pregunta(message, mostrar_categoria, mostrar_fuentes,
+                                     redactar_lexica=redactar_lexica,
+                                     perfilar_pregunta=perfilar_pregunta or PERFILAR)
+    except SistemaSaturadoError:
+        return MENSAJE_SATURADO
+    
+    if perfilar_pregunta and resultado.get("perfil"):
+        return f"{resultado['respuesta']}\n\n---\n🔬 Perfil guardado en `{resultado['perfil']}`"
+    return resultado["respuesta"]
+
+def atender_pregunta(message, mostrar_categoria=False, mostrar_fuentes=True,
+                     categoria=None, tipo_busqueda=None, al_clasificar=None,
+                     redactar_lexica=REDACTAR_LEXICA, perfilar_pregunta=PERFILAR, id_peticion=None):
+    """
+    Núcleo de servicio compartido por la UI de Gradio y la API HTTP (api.py).
+    
+    Aplica el control de admisión: si ya hay MAX_PETICIONES_EN_CURSO
+    preguntas en proceso y no se libera hueco en ESPERA_ADMISION segundos,
+    lanza SistemaSaturadoError de inmediato en lugar de acumular llamadas a
+    OpenAI que acabarían en errores de rate limit.
+    
+    Args:
+        message: El mensaje del usuario (no vacío)
+        mostrar_categoria: Si se debe mostrar la categoría identificada
+        mostrar_fuentes: Si se deben mostrar las fuentes consultadas
+        categoria: Categoría forzada (omite esa parte de la clasificación)
+        tipo_busqueda: Tipo de búsqueda forzado (SEMANTICA/LEXICA)
+        al_clasificar: Callback opcional (categoria, tipo_busqueda) al terminar la clasificación
+        redactar_lexica: Redactar con el sintetizador las búsquedas léxicas multi-categoría
+        perfilar_pregunta: Perfilar la pregunta (ver perfilado.py); el fichero
+            se etiqueta con id_peticion y la clasificación
+        id_peticion: Identificador de la petición (por defecto uno aleatorio)
+    
+    Returns:
+        dict: {"respuesta", "categoria", "tipo_busqueda", "degradado", "precalculada", "duracion_s"}
+            y "perfil" (ruta del fichero) si se ha perfilado
+    
+    Raises:
+        SistemaSaturadoError: Si no hay capacidad para atender la pregunta
+    """
+    with limite_concurrencia(_admision_semaforo, "nuevas preguntas", ESPERA_ADMISION):
+        inicio = time.perf_counter()
+        with perfilar(perfilar_pregunta, "chat", id_peticion) as perfilador:
+            resultado = procesar_pregunta(
+                message, mostrar_categoria, mostrar_fuentes,
+                categoria=categoria, tipo_busqueda=tipo_busqueda, al_clasificar=al_clasificar,
+                redactar_lexica=redactar_lexica
+            )
+            if perfilador:
+                perfilador.etiquetas.update(categoria=resultado["categoria"], tipo=resultado["tipo_busqueda"])
+    resultado["duracion_s"] = time.perf_counter() - inicio
+    if perfilador:
+        resultado["perfil"] = perfilador.ruta
+    
+    if METRICAS_ARRANQUE["first_query_s"] is None:
+        METRICAS_ARRANQUE["first_query_s"] = resultado["duracion_s"]
+        print(f"⏱️ Primera pregunta: {formatear_metricas_arranque()}")
+    return resultado
+
+def clasificar_pregunta(message, futuros):
+    """Clasificación del orquestador o, si OpenAI no está disponible, local.
+    
+    Returns:
+        tuple: (texto de clasificación, True si se ha clasificado en local)
+    """
+    try:
+        return agente_orquestador(message), False
+    except ServicioNoDisponibleError:
+        return clasificar_localmente(message, futuros), True
+
+def procesar_pregunta(message, mostrar_categoria, mostrar_fuentes,
+                      categoria=None, tipo_busqueda=None, al_clasificar=None,
+                      redactar_lexica=REDACTAR_LEXICA):
+    """
+    Pipeline completo de una pregunta: clasificación, agentes y formateo.
+    
+    Args:
+        message: El mensaje del usuario (no vacío)
+        mostrar_categoria: Si se debe mostrar la categoría identificada
+        mostrar_fuentes: Si se deben mostrar las fuentes consultadas
+        categoria: Categoría forzada; si se fuerzan categoría y tipo no se llama al orquestador
+        tipo_busqueda: Tipo de búsqueda forzado
+        al_clasificar: Callback opcional (categoria, tipo_busqueda)
+        redactar_lexica: Redactar con el sintetizador las búsquedas léxicas multi-categoría
+    
+    Si la pregunta es casi igual a una precalculada (ingest.py --qa) se
+    devuelve su respuesta sin clasificar ni generar ("precalculada": True).
+    Si OpenAI no responde a tiempo o su circuito está abierto, la pregunta se
+    clasifica en local y los agentes responden sin LLM ("degradado": True).
+    
+    Returns:
+        dict: {"respuesta", "categoria", "tipo_busqueda", "degradado", "precalculada"}
+    
+    Raises:
+        SistemaSaturadoError: Si no hay capacidad de LLM/embeddings a tiempo
+    """
+    # Recuperación especulativa (semántica sin filtro y léxica) en paralelo con la clasificación
+    futuros = {}
+    degradado = False
+    if categoria is None or tipo_busqueda is None:
+        futuros = lanzar_recuperacion_especulativa(message)
+    
+    # Pregunta frecuente: si hay una precalculada casi igual se responde sin
+    # clasificar ni llamar al LLM. Solo espera al embedding especulativo (la
+    # consulta vectorial sin filtro sigue en paralelo con la clasificación)
+    if RESPUESTAS_PRECALCULADAS and tipo_busqueda != "LEXICA":
+        coincidencia = buscar_respuesta_precalculada(message, futuros, categoria)
+        if coincidencia:
+            if al_clasificar:
+                al_clasificar(coincidencia['categoria'], "SEMANTICA")
+            return formatear_respuesta_precalculada(coincidencia, mostrar_categoria, mostrar_fuentes)
+    
     # 1. Clasificar pregunta (categoría y tipo de búsqueda)
-    clasificacion = agente_orquestador(message)
-    categoria = extraer_categoria(clasificacion)
-    tipo_busqueda = extraer_tipo_busqueda(clasificacion)
+    if categoria is None or tipo_busqueda is None:
+        clasificacion, degradado = clasificar_pregunta(message, futuros)
+        categoria = categoria or extraer_categoria(clasificacion)
+        tipo_busqueda = tipo_busqueda or extraer_tipo_busqueda(clasificacion)
+    
+    if al_clasificar:
+        al_clasificar(categoria, tipo_busqueda)
+    resultado = {"categoria": categoria, "tipo_busqueda": tipo_busqueda, "degradado": degradado, "precalculada": False}
     
     # 2. Manejo diferenciado según tipo de búsqueda
     if tipo_busqueda == "LEXICA":
-        # Para búsquedas léxicas: llamar a los 3 agentes y sintetizar
-        respuesta_funcional = agente_funcional(message, "FUNCIONAL", tipo_busqueda, mostrar_fuentes)
-        respuesta_tecnica = agente_tecnico(message, "TECNICA", tipo_busqueda, mostrar_fuentes)
-        respuesta_gestion = agente_gestion(message, "GESTION", tipo_busqueda, mostrar_fuentes)
+        # Para búsquedas léxicas: buscar en las 3 carpetas (o reutilizar la
+        # búsqueda especulativa) y fusionar las coincidencias sin LLM
+        lexico = resultado_especulativo(futuros, "lexica") or recuperacion_lexica_especulativa(message)
+        categorias_con_resultados = [cat for cat, (_, coincidencias) in lexico.items() if coincidencias]
         
-        # Sintetizar las tres respuestas en una sola
-        respuesta_agente = agente_sintetizador(message, respuesta_funcional, respuesta_tecnica, respuesta_gestion)
+        # Con el circuito del LLM abierto se fusiona sin LLM aunque se pida redactar
+        if redactar_lexica and len(categorias_con_resultados) > 1 and _circuito_llm.disponible():
+            # Respuesta redactada: los 3 agentes formatean y el sintetizador fusiona
+            # (en modo léxico los agentes no llaman al LLM)
+            respuesta_funcional, _ = agente_funcional(message, "FUNCIONAL", tipo_busqueda, mostrar_fuentes, lexico=lexico.get("FUNCIONAL"))
+            respuesta_tecnica, _ = agente_tecnico(message, "TECNICA", tipo_busqueda, mostrar_fuentes, lexico=lexico.get("TECNICA"))
+            respuesta_gestion, _ = agente_gestion(message, "GESTION", tipo_busqueda, mostrar_fuentes, lexico=lexico.get("GESTION"))
+            respuesta_agente, degradado_agente = agente_sintetizador(
+                message, respuesta_funcional, respuesta_tecnica, respuesta_gestion,
+                lexico=lexico, mostrar_fuentes=mostrar_fuentes)
+        elif redactar_lexica and len(categorias_con_resultados) > 1:
+            respuesta_agente, degradado_agente = respuesta_degradada_lexica(lexico, mostrar_fuentes), True
+        else:
+            respuesta_agente, degradado_agente = fusionar_resultados_lexicos(lexico, mostrar_fuentes), False
         
     else:
         # Para búsquedas semánticas: usar el agente de la categoría específica (comportamiento original)
         agente = AGENTES_DISPATCH.get(categoria)
         
         if agente:
-            respuesta_agente = agente(message, categoria, tipo_busqueda, mostrar_fuentes)
+            especulativo = resultado_especulativo(futuros, "semantica")
+            # La búsqueda léxica especulativa sirve de respaldo si no hay chunks relevantes
+            lexico = (resultado_especulativo(futuros, "lexica") or {}).get(categoria)
+            respuesta_agente, degradado_agente = agente(message, categoria, tipo_busqueda, mostrar_fuentes,
+                                                        especulativo=especulativo, lexico=lexico)
         else:
             # Para categorías desconocidas
             categoria_header = f"🤖 **Categoría identificada:** {categoria}\n\n---\n\n" if mostrar_categoria else ""
-            return f"""{categoria_header}⚠️ Lo siento, no he podido clasificar correctamente tu pregunta. 
+            resultado["respuesta"] = f"""{categoria_header}⚠️ Lo siento, no he podido clasificar correctamente tu pregunta. 
 
 Inténtalo de nuevo con una pregunta relacionada con:
 - **FUNCIONAL**: Funcionalidades, características, comportamiento de usuario, casos de uso o flujos de trabajo.
 - **TÉCNICA**: Implementación, código, arquitectura, tecnologías, APIs, bases de datos o desarrollo.
 - **GESTIÓN**: Procesos, organización, documentación, planificación, administración o procedimientos."""
+            return resultado
+    
+    resultado["degradado"] = degradado or degradado_agente
     
     # 3. Formatear respuesta completa (con o sin categoría según el checkbox)
     if mostrar_categoria:
         tipo_busqueda_label = "🔍 Léxica (búsqueda en todos los documentos)" if tipo_busqueda == "LEXICA" else f"📚 Semántica - {categoria}"
-        return f"""🤖 **Tipo de búsqueda:** {tipo_busqueda_label}
+        resultado["respuesta"] = f"""🤖 **Tipo de búsqueda:** {tipo_busqueda_label}
 ---
 {respuesta_agente}"""
     else:
-        return respuesta_agente
-
-# Crear interfaz de Gradio
-with gr.Blocks(title="IIA Capstone - ScanGasto") as demo:
-    gr.Markdown("""
-    # 💬 ScanGasto - Aplicación de gestión de tickets
-    
-    Puedes realizar preguntas relacionadas con la aplicación ScanGasto. El agente clasificará tu pregunta en una de las siguientes categorías:
-    - **FUNCIONAL**: Preguntas sobre funcionalidades y casos de uso
-    - **TÉCNICA**: Preguntas sobre implementación y desarrollo
-    - **GESTIÓN**: Preguntas sobre procesos y organización
-    Después, otro agente especializado en cada categoría analizará la pregunta y proporcionará una respuesta detallada.
-    """)
-    
-    # Checkboxes para opciones de visualización
-    mostrar_categoria_check = gr.Checkbox(
-        label="Mostrar categoría",
-        value=False
-    )
+        resultado["respuesta"] = respuesta_agente
+    return resultado
+
+def crear_interfaz():
+    """Construye la interfaz Gradio (solo al servir, no al importar el módulo)."""
+    import gradio as gr
     
-    mostrar_fuentes_check = gr.Checkbox(
-        label="Mostrar fuentes",
-        value=False
-    )
+    with gr.Blocks(title="IIA Capstone - ScanGasto") as demo:
+        gr.Markdown("""
+        # 💬 ScanGasto - Aplicación de gestión de tickets
     
-    chatbot = gr.ChatInterface(
-        fn=chat_response,
-        additional_inputs=[mostrar_categoria_check, mostrar_fuentes_check],
-        title="",
-        description="Escribe tu pregunta abajo:",
-        examples=[
-            ["¿Cómo puedo registrar un ticket?"],
-            ["¿Qué tecnología se utiliza para comprobar un ticket con QR?"],
-            ["¿Qué perfiles han desarrollado el módulo de consultas?"]
-        ],
-        cache_examples=False
+        Puedes realizar preguntas relacionadas con la aplicación ScanGasto. El agente clasificará tu pregunta en una de las siguientes categorías:
+        - **FUNCIONAL**: Preguntas sobre funcionalidades y casos de uso
+        - **TÉCNICA**: Preguntas sobre implementación y desarrollo
+        - **GESTIÓN**: Preguntas sobre procesos y organización
+        Después, otro agente especializado en cada categoría analizará la pregunta y proporcionará una respuesta detallada.
+        """)
+    
+        # Checkboxes para opciones de visualización
+        mostrar_categoria_check = gr.Checkbox(
+            label="Mostrar categoría",
+            value=False
+        )
+    
+        mostrar_fuentes_check = gr.Checkbox(
+            label="Mostrar fuentes",
+            value=False
+        )
+    
+        redactar_lexica_check = gr.Checkbox(
+            label="Redactar búsquedas léxicas con IA (más lento)",
+            value=REDACTAR_LEXICA
+        )
+    
+        with gr.Accordion("🛠️ Depuración", open=False):
+            perfilar_check = gr.Checkbox(
+                label="Perfilar cada pregunta (guarda un perfil speedscope en RAG_PROFILE_DIR)",
+                value=False
+            )
+    
+        gr.ChatInterface(
+            fn=chat_response,
+            additional_inputs=[mostrar_categoria_check, mostrar_fuentes_check, redactar_lexica_check, perfilar_check],
+            title="",
+            description="Escribe tu pregunta abajo:",
+            examples=[
+                ["¿Cómo puedo registrar un ticket?"],
+                ["¿Qué tecnología se utiliza para comprobar un ticket con QR?"],
+                ["¿Qué perfiles han desarrollado el módulo de consultas?"]
+            ],
+            cache_examples=False
+        )
+    
+    # Cola de Gradio acotada: como mucho GRADIO_CONCURRENCIA peticiones en paralelo
+    # y GRADIO_MAX_COLA en espera; el resto se rechaza con aviso al usuario
+    demo.queue(default_concurrency_limit=GRADIO_CONCURRENCIA, max_size=GRADIO_MAX_COLA)
+    return demo
+
+def precalentar():
+    """Prepara el sistema antes de servir la primera pregunta.
+    
+    Crea el cliente LLM, calcula un embedding (abre la conexión TLS con la
+    API de embeddings), abre Chroma y lanza una consulta por colección para
+    cargar el índice HNSW en memoria (o abre el índice mmap con
+    RAG_VECTOR_BACKEND=mmap), y abre la conexión con la API de chat.
+    Los fallos no son fatales: se informa y se marca el sistema como listo.
+    """
+    inicio = time.perf_counter()
+    try:
+        get_llm()
+        embedding = calcular_embedding("precalentamiento")
+        nombres = ([nombre_coleccion_categoria(c) for c in CATEGORIAS]
+                   if PARTICIONADO_POR_CATEGORIA else [COLLECTION_NAME])
+        if BACKEND_VECTORIAL == "mmap":
+            get_indice_mmap().consultar(embedding, "DESCONOCIDA", 1, ["distances"])
+            nombres = []
+        if RECUPERACION_JERARQUICA and nombres and get_coleccion_documentos() is not None:
+            get_coleccion_documentos().query(query_embeddings=embedding, n_results=1)
+        for nombre in nombres:
+            coleccion = get_chroma_collection(nombre)
+            if coleccion.count():
+                coleccion.query(query_embeddings=embedding, n_results=1)
+        get_openai_client().models.list()
+        print(f"🔥 Precalentamiento completado en {time.perf_counter() - inicio:.2f}s")
+    except Exception as e:
+        print(f"⚠️ Precalentamiento incompleto: {e}")
+    finally:
+        METRICAS_ARRANQUE["ready_s"] = time.perf_counter() - _INICIO_IMPORT
+        _listo.set()
+
+def iniciar_precalentamiento():
+    """Lanza precalentar() en segundo plano (o marca listo si RAG_WARMUP=0)."""
+    if not PRECALENTAR:
+        METRICAS_ARRANQUE["ready_s"] = time.perf_counter() - _INICIO_IMPORT
+        _listo.set()
+        return None
+    hilo = threading.Thread(target=precalentar, name="precalentamiento", daemon=True)
+    hilo.start()
+    return hilo
+
+def esta_listo():
+    """Indica si el precalentamiento ha terminado (sonda de disponibilidad)."""
+    return _listo.is_set()
+
+def metricas_circuitos():
+    """Estado de los circuitos del LLM y de los embeddings y contadores del modo degradado."""
+    with _metricas_lock:
+        degradado = dict(_metricas_degradado)
+    return {
+        "llm": _circuito_llm.metricas(),
+        "embeddings": _circuito_embeddings.metricas(),
+        **degradado
+    }
+
+def metricas_recuperacion():
+    """Consultas jerárquicas y tiempo medio de cada etapa (para /metrics)."""
+    with _metricas_lock:
+        metricas = dict(_metricas_jerarquica)
+    consultas = metricas.pop("consultas")
+    return {
+        "jerarquica": RECUPERACION_JERARQUICA,
+        "consultas_jerarquicas": consultas,
+        "consultas_sin_indice_documentos": metricas["sin_indice"],
+        "documentos_ms_medio": round(metricas["documentos_s"] / consultas * 1000, 3) if consultas else None,
+        "chunks_ms_medio": round(metricas["chunks_s"] / consultas * 1000, 3) if consultas else None,
+        "chunks_candidatos_medio": round(metricas["chunks_candidatos"] / consultas, 1) if consultas else None
+    }
+
+def formatear_metricas_arranque():
+    """Texto con las métricas de arranque disponibles."""
+    return ", ".join(
+        f"{clave}={valor:.2f}s" for clave, valor in METRICAS_ARRANQUE.items() if valor is not None
     )
 
+METRICAS_ARRANQUE["import_s"] = time.perf_counter() - _INICIO_IMPORT
+
 if __name__ == "__main__":
+    # El precalentamiento corre en paralelo con la construcción de la UI
+    iniciar_precalentamiento()
+    demo = crear_interfaz()
+    _listo.wait(ESPERA_PRECALENTAMIENTO)
+    print(f"⏱️ Arranque: {formatear_metricas_arranque()}")
     demo.launch(share=False, server_name="127.0.0.1", server_port=7860)
@@ -0,0 +1,193 @@
+"""Perfilado bajo demanda de una pregunta o de una ingesta.
+
+Envuelve una ejecución (main.atender_pregunta o ingest.process_directory) en
+un perfilador de muestreo propio: un hilo toma cada RAG_PROFILE_INTERVAL_MS
+las pilas de todos los hilos con sys._current_frames() y, al terminar, las
+guarda en RAG_PROFILE_DIR como fichero speedscope (https://www.speedscope.app,
+un perfil por hilo) o en formato 'folded' para flamegraph.pl.
+
+Se conservan las pilas del hilo que atiende la petición y las de cualquier
+hilo que esté ejecutando código del proyecto en ese momento (recuperación
+especulativa, lotes de embeddings...). Los hilos auxiliares bloqueados en
+threading/queue (ociosos) y los de otras librerías se descartan. Con varias preguntas perfiladas a la vez, los hilos
+compartidos pueden mezclar trabajo de ambas.
+
+Se activa con RAG_PROFILE=1 (todas las ejecuciones), con la cabecera
+X-RAG-Profile de la API o con el interruptor de depuración de la UI. Sin
+activar, perfilar() no crea hilos ni toma muestras.
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+# --- CONFIGURACIÓN ---
+PERFILAR = os.getenv("RAG_PROFILE", "0").lower() in ("1", "true", "yes", "si")
+CARPETA_PERFILES = os.getenv("RAG_PROFILE_DIR", "./perfiles")
+INTERVALO_MUESTREO_MS = float(os.getenv("RAG_PROFILE_INTERVAL_MS", "5"))
+FORMATO_PERFIL = os.getenv("RAG_PROFILE_FORMAT", "speedscope").lower()  # speedscope | folded
+MAX_PROFUNDIDAD = 256
+
+# Raíz del proyecto: una pila 'interesa' si pasa por algún fichero de aquí
+RAIZ_PROYECTO = os.path.dirname(os.path.abspath(__file__))
+# En los hilos auxiliares, una pila que termina aquí es un hilo esperando trabajo
+FICHEROS_ESPERA = ("threading.py", "queue.py")
+
+def es_codigo_proyecto(fichero):
+    """True si el fichero es código del proyecto (no una librería instalada ni este módulo)."""
+    return (fichero.startswith(RAIZ_PROYECTO) and fichero != __file__
+            and "site-packages" not in fichero)
+
+def esta_ocioso(code):
+    """True si la hoja de la pila es una espera en threading/queue (hilo esperando trabajo)."""
+    return os.path.basename(code.co_filename) in FICHEROS_ESPERA
+
+class PerfiladorMuestreo:
+    """Muestrea periódicamente las pilas de los hilos del proceso."""
+
+    def __init__(self, intervalo_ms=INTERVALO_MUESTREO_MS):
+        self.intervalo = intervalo_ms / 1000
+        self.hilo_objetivo = threading.get_ident()
+        self.etiquetas = {}
+        self.ruta = None
+        self._frames = []         # [(nombre, fichero, línea)]
+        self._indices = {}        # (nombre, fichero, línea) -> índice en _frames
+        self._muestras = {}       # ident del hilo -> [(pila, peso)]
+        self._nombres_hilos = {}
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, name="perfilador", daemon=True)
+
+    def iniciar(self):
+        self.inicio = time.perf_counter()
+        self._ultima = self.inicio
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+        self._hilo.join()
+        self.duracion = time.perf_counter() - self.inicio
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            self._muestrear()
+
+    def _indice_frame(self, code, linea):
+        clave = (code.co_name, code.co_filename, linea)
+        if clave not in self._indices:
+            self._indices[clave] = len(self._frames)
+            self._frames.append(clave)
+        return self._indices[clave]
+
+    def _muestrear(self):
+        ahora = time.perf_counter()
+        peso, self._ultima = ahora - self._ultima, ahora
+        propio = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == propio:
+                continue
+            codigos = []
+            while frame is not None and len(codigos) < MAX_PROFUNDIDAD:
+                codigos.append(frame.f_code)
+                frame = frame.f_back
+            if ident != self.hilo_objetivo and (
+                    esta_ocioso(codigos[0]) or not any(es_codigo_proyecto(c.co_filename) for c in codigos)):
+                continue
+            # speedscope espera las pilas de la raíz a la hoja
+            pila = [self._indice_frame(c, c.co_firstlineno) for c in reversed(codigos)]
+            self._muestras.setdefault(ident, []).append((pila, peso))
+
+    def _nombre_hilo(self, ident):
+        if ident not in self._nombres_hilos:
+            hilos = {h.ident: h.name for h in threading.enumerate()}
+            self._nombres_hilos[ident] = hilos.get(ident, f"hilo-{ident}")
+        return self._nombres_hilos[ident]
+
+    def _orden_hilos(self):
+        """Primero el hilo de la petición, después el resto por nº de muestras."""
+        return sorted(self._muestras, key=lambda i: (i != self.hilo_objetivo, -len(self._muestras[i])))
+
+    def a_speedscope(self, titulo):
+        perfiles = []
+        for ident in self._orden_hilos():
+            muestras = self._muestras[ident]
+            perfiles.append({
+                "type": "sampled",
+                "name": self._nombre_hilo(ident) + (" (petición)" if ident == self.hilo_objetivo else ""),
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(peso for _, peso in muestras),
+                "samples": [pila for pila, _ in muestras],
+                "weights": [peso for _, peso in muestras]
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": titulo,
+            "exporter": "perfilado.py",
+            "activeProfileIndex": 0,
+            "shared": {"frames": [
+                {"name": nombre, "file": fichero, "line": linea} for nombre, fichero, linea in self._frames
+            ]},
+            "profiles": perfiles
+        }
+
+    def a_folded(self):
+        """Pilas agregadas 'hilo;f1;f2 microsegundos' (entrada de flamegraph.pl)."""
+        acumulado = {}
+        for ident in self._orden_hilos():
+            raiz = self._nombre_hilo(ident).replace(";", "_").replace(" ", "_")
+            for pila, peso in self._muestras[ident]:
+                nombres = [raiz] + [
+                    f"{self._frames[i][0]} ({os.path.basename(self._frames[i][1])}:{self._frames[i][2]})".replace(" ", "_")
+                    for i in pila
+                ]
+                clave = ";".join(nombres)
+                acumulado[clave] = acumulado.get(clave, 0) + peso
+        return "".join(f"{pila} {max(1, round(peso * 1e6))}\n" for pila, peso in acumulado.items())
+
+    def guardar(self, carpeta, prefijo, formato=FORMATO_PERFIL):
+        """Escribe el perfil con el id de la petición y la clasificación en el nombre."""
+        os.makedirs(carpeta, exist_ok=True)
+        partes = [prefijo, self.etiquetas.get("id") or uuid.uuid4().hex[:12]]
+        partes += [str(v) for k, v in self.etiquetas.items() if k != "id" and v]
+        etiqueta = re.sub(r"[^\w.-]+", "-", "_".join(partes))
+        nombre = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{etiqueta}"
+
+        if formato == "folded":
+            self.ruta = os.path.join(carpeta, nombre + ".folded")
+            with open(self.ruta, "w", encoding="utf-8") as f:
+                f.write(self.a_folded())
+        else:
+            self.ruta = os.path.join(carpeta, nombre + ".speedscope.json")
+            titulo = f"{' '.join(partes)} ({self.duracion:.3f}s)"
+            with open(self.ruta, "w", encoding="utf-8") as f:
+                json.dump(self.a_speedscope(titulo), f, ensure_ascii=False)
+        return self.ruta
+
+@contextmanager
+def perfilar(activo, prefijo="chat", id_peticion=None, carpeta=CARPETA_PERFILES):
+    """Perfila el bloque si 'activo'; si no, no hace nada (devuelve None).
+
+    El bloque puede añadir etiquetas (p. ej. la clasificación) en
+    perfilador.etiquetas; forman parte del nombre del fichero. Tras el
+    bloque, perfilador.ruta contiene la ruta del perfil guardado.
+    """
+    if not activo:
+        yield None
+        return
+
+    perfilador = PerfiladorMuestreo()
+    perfilador.etiquetas["id"] = id_peticion
+    perfilador.iniciar()
+    try:
+        yield perfilador
+    finally:
+        perfilador.detener()
+        ruta = perfilador.guardar(carpeta, prefijo)
+        print(f"🔬 Perfil guardado en {ruta} ({perfilador.duracion:.3f}s, "
+              f"{sum(len(m) for m in perfilador._muestras.values())} muestras)")
@@ -0,0 +1,305 @@
+"""Prueba de carga con usuarios concurrentes para el pipeline de chat.
+
+Reproduce una mezcla configurable de preguntas (SEMANTICA/LEXICA de todas las
+categorías) con N usuarios simultáneos, contra chat_response en el propio
+proceso o contra la API HTTP (api.py). Las llamadas a OpenAI se sirven desde
+servidor_stub.py con distribuciones de latencia configurables, de modo que se
+mide el comportamiento del sistema (colas, semáforos, memoria) sin coste ni red.
+
+Informa de throughput, latencias p50/p95/p99, tasa de errores y saturación
+(MENSAJE_SATURADO / 503) y la evolución de la memoria residente (RSS).
+
+Uso:
+    # En proceso: arranca el stub y llama a main.chat_response
+    python prueba_carga.py --usuarios 32 --duracion 60 --latencia-llm lognormal:0.8,0.4
+
+    # Contra la API: el servidor debe apuntar al stub que arranca este script
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python api.py
+    python prueba_carga.py --modo http --url http://127.0.0.1:8000 --pid <PID de api.py>
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+from servidor_stub import iniciar_servidor_stub
+
+# --- CONFIGURACIÓN ---
+PUERTO_STUB = 8765
+INTERVALO_MUESTREO = 1.0  # segundos entre muestras de RSS y throughput
+MARCA_ERROR = "❌ Error"
+
+# Mezcla por defecto: cada categoría con ambos tipos de búsqueda. El stub
+# clasifica cada pregunta con la categoría y el tipo indicados aquí.
+MEZCLA_POR_DEFECTO = [
+    {"pregunta": "¿Cómo funciona el escaneo de códigos QR?", "categoria": "FUNCIONAL", "tipo_busqueda": "SEMANTICA", "peso": 3},
+    {"pregunta": "¿Dónde aparece el campo 'importe_total'?", "categoria": "FUNCIONAL", "tipo_busqueda": "LEXICA", "peso": 1},
+    {"pregunta": "¿Qué arquitectura tiene el módulo de apuntes contables?", "categoria": "TECNICA", "tipo_busqueda": "SEMANTICA", "peso": 3},
+    {"pregunta": "¿Qué tablas usan el campo 'id_ticket'?", "categoria": "TECNICA", "tipo_busqueda": "LEXICA", "peso": 1},
+    {"pregunta": "¿Cuál es la planificación del módulo de consultas?", "categoria": "GESTION", "tipo_busqueda": "SEMANTICA", "peso": 2},
+    {"pregunta": "¿En qué documentos se menciona 'Sprint'?", "categoria": "GESTION", "tipo_busqueda": "LEXICA", "peso": 1},
+]
+
+def cargar_mezcla(ruta):
+    """Lee la mezcla de preguntas de un JSON (lista de objetos como MEZCLA_POR_DEFECTO)."""
+    if not ruta:
+        return MEZCLA_POR_DEFECTO
+    with open(ruta, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def leer_rss_mb(pid=None):
+    """Memoria residente (MB) del proceso indicado (por defecto, el actual)."""
+    try:
+        with open(f"/proc/{pid or 'self'}/status", "r") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid is None:
+        # Sin /proc (macOS, Windows con WSL1...): pico de memoria del proceso
+        import resource
+        import sys
+        maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maximo / (1024 * 1024) if sys.platform == "darwin" else maximo / 1024
+    return None
+
+def percentil(valores_ordenados, p):
+    """Percentil p (0-100) por rango más cercano sobre una lista ya ordenada."""
+    if not valores_ordenados:
+        return 0.0
+    indice = max(0, min(len(valores_ordenados) - 1, int(round(p / 100 * len(valores_ordenados) + 0.5)) - 1))
+    return valores_ordenados[indice]
+
+def crear_objetivo_proceso():
+    """Devuelve una función pregunta -> estado que llama a main.chat_response."""
+    import main
+
+    def objetivo(pregunta):
+        respuesta = main.chat_response(pregunta, [], False, True)
+        if respuesta == main.MENSAJE_SATURADO:
+            return "saturado"
+        return "error" if MARCA_ERROR in respuesta else "ok"
+
+    return objetivo
+
+def crear_objetivo_http(url, usuarios, timeout):
+    """Devuelve una función pregunta -> estado que llama a POST /v1/chat."""
+    import httpx
+
+    cliente = httpx.Client(
+        base_url=url,
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=usuarios, max_keepalive_connections=usuarios)
+    )
+
+    def objetivo(pregunta):
+        respuesta = cliente.post("/v1/chat", json={"pregunta": pregunta})
+        if respuesta.status_code == 503:
+            return "saturado"
+        if respuesta.status_code != 200 or MARCA_ERROR in respuesta.json().get("respuesta", ""):
+            return "error"
+        return "ok"
+
+    return objetivo
+
+class PruebaCarga:
+    """Usuarios concurrentes en bucle cerrado contra un objetivo (pregunta -> estado)."""
+
+    def __init__(self, objetivo, mezcla, usuarios, duracion, max_peticiones=None,
+                 rampa=0.0, pausa=0.0, pid=None):
+        self.objetivo = objetivo
+        self.mezcla = mezcla
+        self.usuarios = usuarios
+        self.duracion = duracion
+        self.max_peticiones = max_peticiones
+        self.rampa = rampa
+        self.pausa = pausa
+        self.pid = pid
+        self.registros = []  # (instante_fin, latencia_s, estado, categoria, tipo_busqueda)
+        self.muestras = []   # (instante, rss_mb, en_curso)
+        self._lock = threading.Lock()
+        self._fin = threading.Event()
+        self._en_curso = 0
+        self._lanzadas = 0
+        self._inicio = None
+
+    def _siguiente_pregunta(self):
+        """Reserva una petición y elige una pregunta de la mezcla (None si se ha terminado)."""
+        with self._lock:
+            if self._fin.is_set() or (self.max_peticiones and self._lanzadas >= self.max_peticiones):
+                return None
+            self._lanzadas += 1
+            self._en_curso += 1
+        return random.choices(self.mezcla, weights=[e.get("peso", 1) for e in self.mezcla])[0]
+
+    def _usuario(self, indice):
+        if self.rampa:
+            time.sleep(self.rampa * indice / self.usuarios)
+        while not self._fin.is_set():
+            entrada = self._siguiente_pregunta()
+            if entrada is None:
+                return
+            inicio = time.perf_counter()
+            try:
+                estado = self.objetivo(entrada["pregunta"])
+            except Exception:
+                estado = "error"
+            fin = time.perf_counter()
+            with self._lock:
+                self._en_curso -= 1
+                self.registros.append((fin - self._inicio, fin - inicio, estado,
+                                       entrada.get("categoria"), entrada.get("tipo_busqueda")))
+            if self.pausa:
+                time.sleep(random.expovariate(1 / self.pausa))
+
+    def _monitor(self):
+        while not self._fin.wait(INTERVALO_MUESTREO):
+            self.muestras.append((time.perf_counter() - self._inicio, leer_rss_mb(self.pid), self._en_curso))
+
+    def ejecutar(self):
+        """Lanza los usuarios y espera a que termine la duración o el número de peticiones."""
+        self._inicio = time.perf_counter()
+        self.muestras.append((0.0, leer_rss_mb(self.pid), 0))
+        monitor = threading.Thread(target=self._monitor, daemon=True)
+        monitor.start()
+
+        hilos = [threading.Thread(target=self._usuario, args=(i,), daemon=True) for i in range(self.usuarios)]
+        for hilo in hilos:
+            hilo.start()
+
+        limite = self._inicio + self.duracion
+        while any(hilo.is_alive() for hilo in hilos) and time.perf_counter() < limite:
+            time.sleep(0.1)
+        # Se dejan terminar las peticiones ya lanzadas para no perder sus latencias
+        self._fin.set()
+        for hilo in hilos:
+            hilo.join()
+        self.duracion_real = time.perf_counter() - self._inicio
+        self.muestras.append((self.duracion_real, leer_rss_mb(self.pid), 0))
+        return self.informe()
+
+    def informe(self):
+        """Resumen global, por tipo de pregunta y serie temporal."""
+        def resumen(registros, duracion):
+            latencias = sorted(r[1] for r in registros)
+            total = len(registros)
+            return {
+                "peticiones": total,
+                "throughput_rps": total / duracion if duracion else 0.0,
+                "p50_s": percentil(latencias, 50),
+                "p95_s": percentil(latencias, 95),
+                "p99_s": percentil(latencias, 99),
+                "max_s": latencias[-1] if latencias else 0.0,
+                "tasa_error": sum(r[2] == "error" for r in registros) / total if total else 0.0,
+                "tasa_saturacion": sum(r[2] == "saturado" for r in registros) / total if total else 0.0,
+            }
+
+        por_tipo = {}
+        for registro in self.registros:
+            por_tipo.setdefault(f"{registro[3]}/{registro[4]}", []).append(registro)
+
+        serie = []
+        anterior = 0.0
+        for instante, rss, en_curso in self.muestras[1:]:
+            tramo = [r for r in self.registros if anterior < r[0] <= instante]
+            serie.append({
+                "t_s": round(instante, 2),
+                "rps": len(tramo) / (instante - anterior) if instante > anterior else 0.0,
+                "p95_s": percentil(sorted(r[1] for r in tramo), 95),
+                "en_curso": en_curso,
+                "rss_mb": rss,
+            })
+            anterior = instante
+
+        rss_validos = [m[1] for m in self.muestras if m[1] is not None]
+        return {
+            "usuarios": self.usuarios,
+            "duracion_s": self.duracion_real,
+            "global": resumen(self.registros, self.duracion_real),
+            "por_tipo": {clave: resumen(regs, self.duracion_real) for clave, regs in sorted(por_tipo.items())},
+            "rss_mb": {
+                "inicial": rss_validos[0] if rss_validos else None,
+                "final": rss_validos[-1] if rss_validos else None,
+                "maximo": max(rss_validos) if rss_validos else None,
+            },
+            "serie": serie,
+        }
+
+def imprimir_informe(informe):
+    g = informe["global"]
+    print("\n📊 RESULTADOS DE LA PRUEBA DE CARGA")
+    print("=" * 60)
+    print(f"Usuarios: {informe['usuarios']} | Duración: {informe['duracion_s']:.1f}s | Peticiones: {g['peticiones']}")
+    print(f"Throughput: {g['throughput_rps']:.2f} pet/s")
+    print(f"Latencia p50/p95/p99/max: {g['p50_s']:.3f} / {g['p95_s']:.3f} / {g['p99_s']:.3f} / {g['max_s']:.3f} s")
+    print(f"Errores: {g['tasa_error']:.1%} | Saturadas: {g['tasa_saturacion']:.1%}")
+    rss = informe["rss_mb"]
+    if rss["maximo"] is not None:
+        print(f"RSS inicial/final/máximo: {rss['inicial']:.1f} / {rss['final']:.1f} / {rss['maximo']:.1f} MB")
+
+    print("\n🔎 Por tipo de pregunta:")
+    for clave, r in informe["por_tipo"].items():
+        print(f"  {clave:<22} n={r['peticiones']:<5} p50={r['p50_s']:.3f}s p95={r['p95_s']:.3f}s "
+              f"err={r['tasa_error']:.1%} sat={r['tasa_saturacion']:.1%}")
+
+    print("\n📈 Evolución:")
+    print(f"  {'t (s)':>7} {'pet/s':>7} {'p95 (s)':>8} {'en curso':>9} {'RSS (MB)':>9}")
+    for m in informe["serie"]:
+        rss_txt = f"{m['rss_mb']:.1f}" if m["rss_mb"] is not None else "-"
+        print(f"  {m['t_s']:>7.1f} {m['rps']:>7.2f} {m['p95_s']:>8.3f} {m['en_curso']:>9} {rss_txt:>9}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga del pipeline de chat con usuarios concurrentes")
+    parser.add_argument("--modo", choices=["proceso", "http"], default="proceso",
+                        help="Llamar a main.chat_response en este proceso o a la API HTTP")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="URL base de api.py (modo http)")
+    parser.add_argument("--pid", type=int, help="PID del servidor cuyo RSS se muestrea (modo http)")
+    parser.add_argument("--usuarios", type=int, default=16, help="Usuarios concurrentes")
+    parser.add_argument("--duracion", type=float, default=30, help="Duración máxima (s)")
+    parser.add_argument("--peticiones", type=int, help="Número total de peticiones (opcional)")
+    parser.add_argument("--rampa", type=float, default=0, help="Segundos para arrancar todos los usuarios")
+    parser.add_argument("--pausa", type=float, default=0, help="Pausa media entre preguntas de un usuario (s)")
+    parser.add_argument("--mezcla", help="JSON con la mezcla de preguntas")
+    parser.add_argument("--latencia-llm", default="lognormal:0.8,0.4",
+                        help="Latencia del chat en el stub (const:S, uniform:A,B, lognormal:MEDIANA,SIGMA)")
+    parser.add_argument("--latencia-embedding", default="lognormal:0.1,0.3",
+                        help="Latencia de los embeddings en el stub")
+    parser.add_argument("--puerto-stub", type=int, default=PUERTO_STUB)
+    parser.add_argument("--sin-stub", action="store_true",
+                        help="No arrancar el stub (se usa OPENAI_BASE_URL tal cual)")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout por petición HTTP (s)")
+    parser.add_argument("--json", help="Guardar el informe completo en este archivo")
+    args = parser.parse_args()
+
+    mezcla = cargar_mezcla(args.mezcla)
+
+    if not args.sin_stub:
+        clasificaciones = {e["pregunta"]: (e["categoria"], e["tipo_busqueda"]) for e in mezcla}
+        stub = iniciar_servidor_stub(args.puerto_stub, args.latencia_llm, args.latencia_embedding, clasificaciones)
+        url_stub = f"http://127.0.0.1:{stub.server_port}/v1"
+        # Debe fijarse antes de importar main/transporte
+        os.environ["OPENAI_BASE_URL"] = url_stub
+        os.environ.setdefault("OPENAI_API_KEY", "stub")
+        print(f"🧪 Stub OpenAI en {url_stub} (LLM {args.latencia_llm}, embeddings {args.latencia_embedding})")
+
+    if args.modo == "proceso":
+        objetivo = crear_objetivo_proceso()
+    else:
+        objetivo = crear_objetivo_http(args.url, args.usuarios, args.timeout)
+        if not args.sin_stub:
+            print(f"ℹ️ El servidor de {args.url} debe usar OPENAI_BASE_URL={url_stub}")
+
+    print(f"🚀 {args.usuarios} usuarios durante {args.duracion}s ({args.modo})...")
+    prueba = PruebaCarga(objetivo, mezcla, args.usuarios, args.duracion, args.peticiones,
+                         args.rampa, args.pausa, args.pid)
+    informe = prueba.ejecutar()
+    imprimir_informe(informe)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(informe, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Informe guardado en {args.json}")
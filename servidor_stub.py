@@ -0,0 +1,181 @@
+"""Servidor stub local compatible con la API de OpenAI (chat y embeddings).
+
+Permite ejecutar main.py, api.py e ingest.py sin red ni coste, con latencias
+configurables, apuntando el transporte compartido a él:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python main.py
+
+Los embeddings son deterministas (mismo texto -> mismo vector de 1536
+dimensiones, como text-embedding-3-small). El chat responde a las peticiones
+del orquestador con la clasificación registrada para esa pregunta (o la
+clasificación por defecto), a las de generación de preguntas precalculadas
+(ingest.py --qa) con un JSON derivado de los títulos de los fragmentos y al
+resto con un texto fijo.
+
+Uso:
+    python servidor_stub.py --puerto 8765 --latencia-llm lognormal:0.8,0.4 --latencia-embedding const:0.05
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- CONFIGURACIÓN ---
+DIMENSIONES_EMBEDDING = 1536
+CLASIFICACION_POR_DEFECTO = ("FUNCIONAL", "SEMANTICA")
+RESPUESTA_CHAT = "Respuesta generada por el servidor stub."
+MARCA_ORQUESTADOR = "Eres un agente clasificador"
+MARCA_GENERADOR_QA = "Genera preguntas frecuentes"
+
+def parse_latencia(especificacion):
+    """Convierte una especificación de latencia en una función sin argumentos (segundos).
+
+    Formatos:
+        const:S              Siempre S segundos
+        uniform:A,B          Uniforme entre A y B
+        lognormal:MEDIANA,SIGMA  Log-normal con esa mediana (cola larga realista)
+    """
+    tipo, _, valores = especificacion.partition(":")
+    numeros = [float(v) for v in valores.split(",") if v]
+    if tipo == "const":
+        return lambda: numeros[0]
+    if tipo == "uniform":
+        return lambda: random.uniform(numeros[0], numeros[1])
+    if tipo == "lognormal":
+        mu = math.log(numeros[0])
+        return lambda: random.lognormvariate(mu, numeros[1])
+    raise ValueError(f"Distribución de latencia no soportada: {especificacion}")
+
+def embedding_determinista(texto, dimensiones=DIMENSIONES_EMBEDDING):
+    """Vector unitario pseudoaleatorio derivado del hash del texto."""
+    generador = random.Random(hashlib.sha1(texto.encode("utf-8")).hexdigest())
+    vector = [generador.gauss(0, 1) for _ in range(dimensiones)]
+    norma = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norma for x in vector]
+
+def crear_manejador(latencia_llm, latencia_embedding, clasificaciones):
+    """Crea la clase manejadora HTTP con la configuración indicada."""
+
+    class ManejadorStub(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _responder(self, datos, estado=200):
+            cuerpo = json.dumps(datos).encode("utf-8")
+            self.send_response(estado)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def do_GET(self):
+            # /v1/models (usado en el precalentamiento)
+            self._responder({"object": "list", "data": [{"id": "stub", "object": "model"}]})
+
+        def do_POST(self):
+            longitud = int(self.headers.get("Content-Length", 0))
+            peticion = json.loads(self.rfile.read(longitud) or b"{}")
+
+            if self.path.endswith("/embeddings"):
+                time.sleep(latencia_embedding())
+                textos = peticion.get("input", [])
+                textos = [textos] if isinstance(textos, str) else textos
+                self._responder({
+                    "object": "list",
+                    "model": peticion.get("model"),
+                    "data": [
+                        {"object": "embedding", "index": i, "embedding": embedding_determinista(t)}
+                        for i, t in enumerate(textos)
+                    ],
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0}
+                })
+                return
+
+            if self.path.endswith("/chat/completions"):
+                time.sleep(latencia_llm())
+                self._responder({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": peticion.get("model"),
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": responder_chat(peticion, clasificaciones)}
+                    }],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+                })
+                return
+
+            self._responder({"error": {"message": f"Ruta no soportada: {self.path}"}}, estado=404)
+
+    return ManejadorStub
+
+def responder_chat(peticion, clasificaciones):
+    """Contenido de la respuesta de chat según el tipo de prompt recibido."""
+    prompt = peticion.get("messages", [{}])[-1].get("content", "")
+    if MARCA_GENERADOR_QA in prompt:
+        return preguntas_frecuentes_stub(prompt)
+    if MARCA_ORQUESTADOR not in prompt:
+        return RESPUESTA_CHAT
+    pregunta = prompt.rsplit("Pregunta:", 1)[-1].strip()
+    categoria, tipo = clasificaciones.get(pregunta, CLASIFICACION_POR_DEFECTO)
+    return f"Categoría: {categoria}\nTipo de búsqueda: {tipo}\nJustificación: stub"
+
+def preguntas_frecuentes_stub(prompt):
+    """Una pregunta por título markdown de los fragmentos (hasta las pedidas), en JSON."""
+    numero = re.search(r'escribe (\d+) preguntas', prompt)
+    fragmentos = prompt.split("FRAGMENTOS:", 1)[-1]
+    titulos = re.findall(r'^#+\s*(.+?)\s*$', fragmentos, re.MULTILINE)
+    pares = [
+        {"pregunta": f"¿Qué se indica sobre {titulo}?", "respuesta": f"Según la documentación, {titulo}."}
+        for titulo in dict.fromkeys(titulos)
+    ]
+    return json.dumps(pares[:int(numero.group(1)) if numero else 3], ensure_ascii=False)
+
+def iniciar_servidor_stub(puerto=8765, latencia_llm="const:0", latencia_embedding="const:0",
+                          clasificaciones=None, host="127.0.0.1"):
+    """Arranca el servidor stub en un hilo en segundo plano.
+
+    Args:
+        puerto (int): Puerto de escucha (0 = uno libre)
+        latencia_llm (str): Distribución de latencia del chat (ver parse_latencia)
+        latencia_embedding (str): Distribución de latencia de los embeddings
+        clasificaciones (dict): pregunta -> (categoria, tipo_busqueda) para el orquestador
+        host (str): Interfaz de escucha
+
+    Returns:
+        ThreadingHTTPServer: Servidor en marcha; su URL base es
+            f"http://{host}:{servidor.server_port}/v1"
+    """
+    manejador = crear_manejador(
+        parse_latencia(latencia_llm), parse_latencia(latencia_embedding), clasificaciones or {}
+    )
+    servidor = ThreadingHTTPServer((host, puerto), manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="servidor-stub", daemon=True).start()
+    return servidor
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor stub compatible con la API de OpenAI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--latencia-llm", default="const:0")
+    parser.add_argument("--latencia-embedding", default="const:0")
+    args = parser.parse_args()
+
+    servidor = iniciar_servidor_stub(args.puerto, args.latencia_llm, args.latencia_embedding, host=args.host)
+    print(f"🧪 Servidor stub en http://{args.host}:{servidor.server_port}/v1 (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
@@ -0,0 +1,329 @@
+"""
+Exportación e importación portátil de la BBDD vectorial (snapshots).
+
+Un snapshot es una carpeta con:
+    manifest.json      Versión de formato, origen, modelo, espacio de distancia,
+                       dimensiones, recuento por categoría y sha256 de cada fichero
+    embeddings.npy     Matriz float32 (N x dimensiones), una fila por chunk
+    records.jsonl      id, documento, metadatos y colección de origen por fila
+                       (records.parquet con --format parquet, requiere pyarrow)
+
+La importación verifica la integridad y carga los vectores en bloque en una
+colección nueva sin llamar al modelo de embeddings, así que arrancar un nodo
+depende del disco y no del rate limit de OpenAI.
+
+Uso:
+    python snapshot.py export ./snapshots/2026-10 [--categories FUNCIONAL TECNICA] [--format parquet]
+    python snapshot.py verify ./snapshots/2026-10
+    python snapshot.py import ./snapshots/2026-10 [--db-path ./bbdd] [--categories GESTION] [--replace]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+
+import chromadb
+import numpy as np
+from dotenv import load_dotenv
+from transporte import crear_funcion_embeddings
+
+# Cargar variables de entorno (.env)
+load_dotenv()
+
+# --- CONFIGURACIÓN ---
+DB_PATH = './bbdd'    # Ruta a la BBDD Chroma
+COLLECTION_NAME = "documentacion_openai"
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+PAGE_SIZE = 1000  # Filas leídas por llamada a collection.get
+GENERATION_SEPARATOR = ".v"  # Colecciones de una generación de ingest.py --rebuild: '<nombre>.v<N>'
+
+class SnapshotError(Exception):
+    """El snapshot está incompleto, corrupto o no es compatible."""
+
+def file_sha256(path):
+    """sha256 de un fichero leyéndolo por bloques."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def category_filter(categories):
+    """Filtro 'where' de Chroma para una lista de categorías (None = todas)."""
+    if not categories:
+        return None
+    # Los chunks deduplicados por ingest.py pertenecen también a las categorías de 'categories'
+    return {"$or": [{"category": {"$in": list(categories)}}] +
+                   [{"categories": {"$contains": category}} for category in categories]}
+
+def write_records(path, records, fmt):
+    """Guarda la tabla de registros en JSONL o Parquet."""
+    if fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SnapshotError("El formato parquet requiere 'pyarrow' (pip install pyarrow)")
+        table = pa.table({
+            "id": [r["id"] for r in records],
+            "document": [r["document"] for r in records],
+            "metadata": [json.dumps(r["metadata"], ensure_ascii=False) for r in records],
+            "collection": [r["collection"] for r in records],
+        })
+        pq.write_table(table, path)
+        return
+
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def read_records(path, fmt):
+    """Lee la tabla de registros guardada por write_records."""
+    if fmt == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SnapshotError("El formato parquet requiere 'pyarrow' (pip install pyarrow)")
+        rows = pq.read_table(path).to_pylist()
+        for row in rows:
+            row["metadata"] = json.loads(row["metadata"])
+        return rows
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def published_generation(db_path):
+    """Generación de colecciones publicada en db_path (0 = colecciones sin sufijo)."""
+    try:
+        with open(os.path.join(db_path, 'index_version.json'), 'r', encoding='utf-8') as f:
+            return json.load(f).get('generation', 0)
+    except (OSError, ValueError):
+        return 0
+
+def logical_collection_name(name):
+    """Nombre de la colección sin el sufijo de generación."""
+    return re.sub(rf'{re.escape(GENERATION_SEPARATOR)}\d+$', '', name)
+
+def export_snapshot(output_dir, db_path=DB_PATH, collection_names=None, categories=None, fmt="jsonl"):
+    """
+    Exporta ids, documentos, metadatos y embeddings de las colecciones indicadas
+    (por defecto la principal y sus particiones por categoría de la generación
+    publicada) a output_dir. Cada registro guarda el nombre lógico de su
+    colección, sin generación. Devuelve el manifiesto escrito.
+    """
+    client = chromadb.PersistentClient(path=db_path)
+    if not collection_names:
+        generation = published_generation(db_path)
+        suffix = f"{GENERATION_SEPARATOR}{generation}" if generation else ""
+        collection_names = sorted(
+            c.name for c in client.list_collections()
+            if (c.name == COLLECTION_NAME + suffix
+                or re.fullmatch(rf'{re.escape(COLLECTION_NAME)}__[a-z0-9_]+{re.escape(suffix)}', c.name))
+        )
+    if not collection_names:
+        raise SnapshotError(f"No hay colecciones que exportar en {db_path}")
+
+    records = []
+    blocks = []
+    config = None
+    for name in collection_names:
+        collection = client.get_collection(name)
+        config = config or collection.configuration_json
+        offset = 0
+        while True:
+            page = collection.get(
+                where=category_filter(categories),
+                include=['embeddings', 'documents', 'metadatas'],
+                limit=PAGE_SIZE,
+                offset=offset
+            )
+            if not page['ids']:
+                break
+            blocks.append(np.asarray(page['embeddings'], dtype=np.float32))
+            records.extend(
+                {"id": i, "document": d, "metadata": m or {},
+                 "collection": logical_collection_name(name)}
+                for i, d, m in zip(page['ids'], page['documents'], page['metadatas'])
+            )
+            offset += len(page['ids'])
+        print(f"📤 {name}: {offset} vectores")
+
+    if not records:
+        raise SnapshotError("El filtro no ha dejado ningún vector que exportar")
+
+    embeddings = np.concatenate(blocks)
+    os.makedirs(output_dir, exist_ok=True)
+    records_file = f"records.{fmt}"
+    np.save(os.path.join(output_dir, EMBEDDINGS_FILE), embeddings)
+    write_records(os.path.join(output_dir, records_file), records, fmt)
+
+    counts = {}
+    for record in records:
+        category = record["metadata"].get("category", "")
+        counts[category] = counts.get(category, 0) + 1
+
+    embedding_function = config.get('embedding_function') or {}
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "source": {"db_path": os.path.abspath(db_path), "collections": collection_names},
+        "embedding_function": {
+            "name": embedding_function.get('name'),
+            "model_name": (embedding_function.get('config') or {}).get('model_name')
+        },
+        "space": (config.get('hnsw') or {}).get('space', 'l2'),
+        "count": len(records),
+        "dimensions": int(embeddings.shape[1]),
+        "dtype": "float32",
+        "categories": counts,
+        "records_format": fmt,
+        "files": {
+            file_name: {
+                "sha256": file_sha256(os.path.join(output_dir, file_name)),
+                "bytes": os.path.getsize(os.path.join(output_dir, file_name))
+            }
+            for file_name in (EMBEDDINGS_FILE, records_file)
+        }
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ Snapshot exportado en {output_dir}: {manifest['count']} vectores de "
+          f"{manifest['dimensions']} dimensiones ({', '.join(f'{k}: {v}' for k, v in counts.items())})")
+    return manifest
+
+def verify_snapshot(snapshot_dir):
+    """
+    Comprueba manifiesto, checksums, forma de la matriz, unicidad de ids y que
+    no haya valores no finitos. Devuelve (manifest, embeddings, records);
+    la matriz se abre con mmap para no duplicarla en memoria.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Manifiesto ilegible: {e}")
+
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise SnapshotError(f"Versión de formato no soportada: {manifest.get('format_version')}")
+
+    for file_name, info in manifest["files"].items():
+        path = os.path.join(snapshot_dir, file_name)
+        if not os.path.isfile(path):
+            raise SnapshotError(f"Falta el fichero {file_name}")
+        if os.path.getsize(path) != info["bytes"] or file_sha256(path) != info["sha256"]:
+            raise SnapshotError(f"Checksum incorrecto en {file_name}")
+
+    embeddings = np.load(os.path.join(snapshot_dir, EMBEDDINGS_FILE), mmap_mode='r')
+    records = read_records(os.path.join(snapshot_dir, f"records.{manifest['records_format']}"),
+                           manifest['records_format'])
+
+    if embeddings.shape != (manifest["count"], manifest["dimensions"]) or len(records) != manifest["count"]:
+        raise SnapshotError(f"Tamaños inconsistentes: matriz {embeddings.shape}, "
+                            f"{len(records)} registros, manifiesto {manifest['count']}")
+    if len({r["id"] for r in records}) != len(records):
+        raise SnapshotError("Hay ids duplicados")
+    if not np.isfinite(embeddings).all():
+        raise SnapshotError("La matriz contiene valores NaN o infinitos")
+
+    return manifest, embeddings, records
+
+def import_snapshot(snapshot_dir, db_path=DB_PATH, categories=None, collection_name=None, replace=False):
+    """
+    Importa un snapshot verificado en db_path, en bloque y con los embeddings
+    guardados (sin llamar a OpenAI). Cada registro vuelve a su colección de
+    origen (en la generación publicada de db_path) salvo que se indique
+    collection_name. Las colecciones destino deben
+    no existir o estar vacías (o usar replace=True para recrearlas).
+    Devuelve el número de vectores importados.
+    """
+    manifest, embeddings, records = verify_snapshot(snapshot_dir)
+    print(f"🔒 Snapshot verificado: {manifest['count']} vectores, modelo {manifest['embedding_function']['model_name']}")
+
+    # Agrupar filas por colección destino aplicando el filtro de categorías
+    generation = published_generation(db_path)
+    rows_by_collection = {}
+    for row, record in enumerate(records):
+        record_categories = record["metadata"].get("categories") or [record["metadata"].get("category")]
+        if categories and not set(record_categories) & set(categories):
+            continue
+        target = collection_name or record["collection"]
+        if not collection_name and generation:
+            target = f"{logical_collection_name(target)}{GENERATION_SEPARATOR}{generation}"
+        rows_by_collection.setdefault(target, []).append(row)
+
+    client = chromadb.PersistentClient(path=db_path)
+    existing = {c.name for c in client.list_collections()}
+    embedding_function = crear_funcion_embeddings(manifest['embedding_function']['model_name'])
+    batch_size = client.get_max_batch_size()
+
+    imported = 0
+    for name, rows in rows_by_collection.items():
+        if name in existing:
+            if replace:
+                client.delete_collection(name)
+            elif client.get_collection(name).count():
+                raise SnapshotError(f"La colección {name} ya tiene datos (usa --replace)")
+        collection = client.get_or_create_collection(
+            name=name,
+            embedding_function=embedding_function,
+            configuration={"hnsw": {"space": manifest["space"]}}
+        )
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            collection.add(
+                ids=[records[i]["id"] for i in batch],
+                documents=[records[i]["document"] for i in batch],
+                metadatas=[records[i]["metadata"] for i in batch],
+                embeddings=np.asarray(embeddings[batch])
+            )
+        if collection.count() != len(rows):
+            raise SnapshotError(f"{name}: se esperaban {len(rows)} vectores y hay {collection.count()}")
+        imported += len(rows)
+        print(f"📥 {name}: {len(rows)} vectores")
+
+    print(f"✅ Importados {imported} vectores en {db_path}")
+    if imported and os.path.abspath(db_path) == os.path.abspath(DB_PATH):
+        # Avisar a los main.py en marcha para que recarguen sus colecciones
+        from ingest import publish_index_version
+        publish_index_version()
+    return imported
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exportar/importar snapshots portátiles de la BBDD vectorial")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Exportar la BBDD a una carpeta de snapshot")
+    export_parser.add_argument("snapshot_dir")
+    export_parser.add_argument("--db-path", default=DB_PATH)
+    export_parser.add_argument("--collections", nargs="+", help="Colecciones a exportar (por defecto todas las del proyecto)")
+    export_parser.add_argument("--categories", nargs="+", help="Exportar solo estas categorías")
+    export_parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+
+    verify_parser = subparsers.add_parser("verify", help="Comprobar la integridad de un snapshot")
+    verify_parser.add_argument("snapshot_dir")
+
+    import_parser = subparsers.add_parser("import", help="Importar un snapshot sin recalcular embeddings")
+    import_parser.add_argument("snapshot_dir")
+    import_parser.add_argument("--db-path", default=DB_PATH)
+    import_parser.add_argument("--categories", nargs="+", help="Importar solo estas categorías")
+    import_parser.add_argument("--collection", help="Importar todo en esta colección en lugar de la de origen")
+    import_parser.add_argument("--replace", action="store_true", help="Recrear las colecciones destino si ya existen")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "export":
+            export_snapshot(args.snapshot_dir, args.db_path, args.collections, args.categories, args.format)
+        elif args.command == "verify":
+            manifest, _, _ = verify_snapshot(args.snapshot_dir)
+            print(f"✅ Snapshot correcto: {manifest['count']} vectores ({manifest['categories']})")
+        else:
+            import_snapshot(args.snapshot_dir, args.db_path, args.categories, args.collection, args.replace)
+    except SnapshotError as e:
+        print(f"❌ {e}")
+        raise SystemExit(1)
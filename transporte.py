@@ -0,0 +1,189 @@
+"""Transporte HTTP compartido para todas las llamadas a modelos (LLM y embeddings).
+
+main.py, ingest.py y bbdd.py hablan con la API de OpenAI a través de un único
+cliente httpx con pool de conexiones keep-alive, timeouts explícitos y una
+política de reintentos con espera exponencial y jitter. Así se evitan
+handshakes TLS repetidos y que una petición colgada retenga un worker de
+Gradio durante el timeout por defecto de la librería.
+
+Configuración (variables de entorno):
+    OPENAI_BASE_URL: URL base de la API (p.ej. un servidor stub local para pruebas)
+    RAG_HTTP_MAX_CONNECTIONS / RAG_HTTP_MAX_KEEPALIVE / RAG_HTTP_KEEPALIVE_EXPIRY
+    RAG_HTTP_CONNECT_TIMEOUT / RAG_HTTP_READ_TIMEOUT / RAG_HTTP_WRITE_TIMEOUT / RAG_HTTP_POOL_TIMEOUT
+    RAG_HTTP_MAX_RETRIES / RAG_HTTP_BACKOFF_BASE / RAG_HTTP_BACKOFF_MAX
+    RAG_CASSETTE_MODE / RAG_CASSETTE / RAG_CASSETTE_STRICT / RAG_CASSETTE_LATENCY_SCALE
+        (grabación y reproducción de las llamadas, ver casete.py)
+"""
+
+import os
+import random
+import threading
+import time
+from dotenv import load_dotenv
+
+# Cargar variables de entorno (.env) antes de leer la configuración
+load_dotenv()
+
+# --- CONFIGURACIÓN ---
+BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+MAX_CONEXIONES = int(os.getenv("RAG_HTTP_MAX_CONNECTIONS", "32"))
+MAX_KEEPALIVE = int(os.getenv("RAG_HTTP_MAX_KEEPALIVE", "16"))
+EXPIRACION_KEEPALIVE = float(os.getenv("RAG_HTTP_KEEPALIVE_EXPIRY", "60"))
+TIMEOUT_CONEXION = float(os.getenv("RAG_HTTP_CONNECT_TIMEOUT", "5"))
+TIMEOUT_LECTURA = float(os.getenv("RAG_HTTP_READ_TIMEOUT", "60"))
+TIMEOUT_ESCRITURA = float(os.getenv("RAG_HTTP_WRITE_TIMEOUT", "10"))
+TIMEOUT_POOL = float(os.getenv("RAG_HTTP_POOL_TIMEOUT", "5"))
+MAX_REINTENTOS = int(os.getenv("RAG_HTTP_MAX_RETRIES", "2"))
+ESPERA_BASE = float(os.getenv("RAG_HTTP_BACKOFF_BASE", "0.5"))
+ESPERA_MAXIMA = float(os.getenv("RAG_HTTP_BACKOFF_MAX", "8"))
+MODO_CASETE = os.getenv("RAG_CASSETTE_MODE", "off").lower()  # off | record | replay
+
+# En reproducción no se llega a contactar con OpenAI: basta una clave ficticia
+CLAVE_CASETE = "sk-casete"
+
+# Códigos de estado que merece la pena reintentar
+ESTADOS_REINTENTABLES = {408, 409, 429, 500, 502, 503, 504}
+
+_lock = threading.Lock()
+_http_client = None
+_openai_client = None
+
+def calcular_espera(intento, retry_after=None):
+    """Espera antes del reintento 'intento' (0, 1, ...) con jitter completo.
+
+    Si el servidor indica Retry-After (en segundos) se respeta, acotado a
+    ESPERA_MAXIMA; si no, se elige al azar entre 0 y ESPERA_BASE * 2^intento.
+    """
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), ESPERA_MAXIMA)
+        except ValueError:
+            pass
+    return random.uniform(0, min(ESPERA_MAXIMA, ESPERA_BASE * (2 ** intento)))
+
+def crear_transporte_con_reintentos(transporte, max_reintentos=MAX_REINTENTOS):
+    """Envuelve un httpx.BaseTransport con reintentos ante fallos transitorios.
+
+    Se reintentan los errores de conexión/timeout y las respuestas con código
+    de ESTADOS_REINTENTABLES. Los reintentos se hacen aquí (y no en el SDK de
+    OpenAI) para que el presupuesto de reintentos sea el mismo en todas las
+    llamadas del proyecto.
+    """
+    import httpx
+
+    class TransporteConReintentos(httpx.BaseTransport):
+        def handle_request(self, request):
+            intento = 0
+            while True:
+                try:
+                    respuesta = transporte.handle_request(request)
+                except (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadTimeout,
+                        httpx.RemoteProtocolError):
+                    if intento >= max_reintentos:
+                        raise
+                    espera = calcular_espera(intento)
+                else:
+                    if respuesta.status_code not in ESTADOS_REINTENTABLES or intento >= max_reintentos:
+                        return respuesta
+                    espera = calcular_espera(intento, respuesta.headers.get("retry-after"))
+                    respuesta.read()
+                    respuesta.close()
+                time.sleep(espera)
+                intento += 1
+
+        def close(self):
+            transporte.close()
+
+    return TransporteConReintentos()
+
+def get_api_key():
+    """OPENAI_API_KEY, o una clave ficticia si se reproducen llamadas grabadas."""
+    clave = os.getenv("OPENAI_API_KEY")
+    if not clave and MODO_CASETE == "replay":
+        return CLAVE_CASETE
+    return clave
+
+def get_http_client():
+    """Devuelve el cliente httpx compartido (pool keep-alive + timeouts + reintentos).
+
+    Con RAG_CASSETTE_MODE=record|replay se intercala el casete entre los
+    reintentos y la red: se graban las respuestas tal como llegan y, al
+    reproducir, los reintentos no intervienen.
+    """
+    global _http_client
+
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                import httpx
+                limites = httpx.Limits(
+                    max_connections=MAX_CONEXIONES,
+                    max_keepalive_connections=MAX_KEEPALIVE,
+                    keepalive_expiry=EXPIRACION_KEEPALIVE
+                )
+                transporte = httpx.HTTPTransport(limits=limites)
+                if MODO_CASETE in ("record", "replay"):
+                    from casete import crear_transporte_casete
+                    transporte = crear_transporte_casete(transporte, modo=MODO_CASETE)
+                _http_client = httpx.Client(
+                    transport=crear_transporte_con_reintentos(transporte),
+                    timeout=get_timeout()
+                )
+    return _http_client
+
+def get_timeout():
+    """Timeouts de conexión, lectura, escritura y espera de pool."""
+    import httpx
+    return httpx.Timeout(
+        connect=TIMEOUT_CONEXION,
+        read=TIMEOUT_LECTURA,
+        write=TIMEOUT_ESCRITURA,
+        pool=TIMEOUT_POOL
+    )
+
+def get_openai_client():
+    """Devuelve el cliente openai.OpenAI compartido sobre el transporte común."""
+    global _openai_client
+
+    if _openai_client is None:
+        http_client = get_http_client()
+        with _lock:
+            if _openai_client is None:
+                import openai
+                _openai_client = openai.OpenAI(
+                    api_key=get_api_key(),
+                    base_url=BASE_URL,
+                    http_client=http_client,
+                    timeout=get_timeout(),
+                    max_retries=0  # los reintentos los gestiona el transporte
+                )
+    return _openai_client
+
+def crear_funcion_embeddings(model_name):
+    """Función de embeddings de Chroma para OpenAI que usa el cliente compartido.
+
+    Se mantiene la clase nativa OpenAIEmbeddingFunction (su nombre y
+    configuración quedan persistidos en las colecciones existentes) y solo se
+    sustituye su cliente interno.
+    """
+    from chromadb.utils import embedding_functions
+
+    funcion = embedding_functions.OpenAIEmbeddingFunction(
+        api_key=get_api_key(),
+        model_name=model_name
+    )
+    funcion.client = get_openai_client()
+    return funcion
+
+def crear_chat_openai(**kwargs):
+    """ChatOpenAI de LangChain sobre el cliente HTTP compartido."""
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        api_key=get_api_key(),
+        base_url=BASE_URL,
+        http_client=get_http_client(),
+        timeout=get_timeout(),
+        max_retries=0,
+        **kwargs
+    )